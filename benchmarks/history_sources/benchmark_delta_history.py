@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+
+import argparse
+import gzip
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "..",
+        "lambdas",
+        "history_sources"))
+
+import delta_history
+
+"""
+Compares the storage taken by the history of the source of a page when every
+revision is stored in full with that taken by the chunks of delta_history, for
+several chunk sizes, and measures how long it takes to store a revision and to
+reconstruct one.
+
+The history is either read from a directory containing the source of each
+revision in a file named by its revision number, or generated: a page of
+paragraphs which in each revision has a few lines changed, inserted or deleted,
+as is typical of edits to the nLab.
+"""
+
+def _generated_history(revisions, paragraphs, seed):
+    generator = random.Random(seed)
+    words = [
+        "category", "functor", "limit", "sheaf", "topos", "monad", "adjoint",
+        "homotopy", "$\\infty$-groupoid", "[[fibration]]", "of", "the", "is"
+    ]
+    def line():
+        return " ".join(generator.choice(words) for _ in range(14))
+    lines = []
+    for paragraph in range(paragraphs):
+        lines.append("## Section {}".format(paragraph))
+        lines.append("")
+        lines.extend(line() for _ in range(generator.randint(2, 8)))
+        lines.append("")
+    history = [ "\n".join(lines) ]
+    for _ in range(revisions - 1):
+        for _ in range(generator.randint(1, 4)):
+            position = generator.randrange(len(lines))
+            edit = generator.random()
+            if edit < 0.6:
+                lines[position] = line()
+            elif edit < 0.85:
+                lines.insert(position, line())
+            elif len(lines) > 1:
+                del lines[position]
+        history.append("\n".join(lines))
+    return history
+
+def _history_from_directory(directory):
+    revision_numbers = sorted(
+        int(file_name) for file_name in os.listdir(directory))
+    history = []
+    for revision_number in revision_numbers:
+        with open(os.path.join(directory, str(revision_number)), "r") as source:
+            history.append(source.read())
+    return history
+
+def _percentile(values, fraction):
+    return sorted(values)[min(len(values) - 1, int(fraction * len(values)))]
+
+def _benchmark(history, size, samples, seed):
+    chunks = dict()
+    store_times = []
+    for revision_number, source in enumerate(history, 1):
+        index = delta_history.chunk_index(revision_number, size)
+        start = time.perf_counter()
+        chunk = chunks.get(index)
+        if chunk is not None:
+            chunk = delta_history.decode_chunk(chunk)
+        chunks[index] = delta_history.encode_chunk(
+            delta_history.with_revision(chunk, revision_number, source))
+        store_times.append(time.perf_counter() - start)
+    generator = random.Random(seed)
+    reconstruct_times = []
+    for _ in range(samples):
+        revision_number = generator.randint(1, len(history))
+        start = time.perf_counter()
+        source = delta_history.revision_source(
+            delta_history.decode_chunk(chunks[
+                delta_history.chunk_index(revision_number, size)]),
+            revision_number)
+        reconstruct_times.append(time.perf_counter() - start)
+        if source != history[revision_number - 1]:
+            raise Exception(
+                "Revision {} not reconstructed".format(revision_number))
+    return {
+        "size": sum(len(chunk) for chunk in chunks.values()),
+        "objects": len(chunks),
+        "store_median": statistics.median(store_times),
+        "store_max": max(store_times),
+        "reconstruct_median": statistics.median(reconstruct_times),
+        "reconstruct_p95": _percentile(reconstruct_times, 0.95),
+        "reconstruct_max": max(reconstruct_times)
+    }
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description = "Benchmark delta_history against full copies")
+    argument_parser.add_argument(
+        "--sources",
+        help = "Directory of sources named by revision number, rather than a " +
+            "generated history")
+    argument_parser.add_argument("--revisions", type = int, default = 500)
+    argument_parser.add_argument("--paragraphs", type = int, default = 300)
+    argument_parser.add_argument(
+        "--chunk-sizes",
+        type = lambda sizes: [ int(size) for size in sizes.split(",") ],
+        default = [ 16, 32, 64, 128 ])
+    argument_parser.add_argument("--samples", type = int, default = 200)
+    argument_parser.add_argument("--seed", type = int, default = 0)
+    arguments = argument_parser.parse_args()
+    if arguments.sources:
+        history = _history_from_directory(arguments.sources)
+    else:
+        history = _generated_history(
+            arguments.revisions,
+            arguments.paragraphs,
+            arguments.seed)
+    full_size = sum(len(source.encode("utf-8")) for source in history)
+    gzip_size = sum(
+        len(gzip.compress(source.encode("utf-8"), mtime = 0))
+        for source in history)
+    print("{} revisions, newest {} bytes".format(
+        len(history),
+        len(history[-1].encode("utf-8"))))
+    print("Full copies: {} bytes, {} gzip-encoded, {} objects".format(
+        full_size,
+        gzip_size,
+        len(history)))
+    print("{:>6} {:>12} {:>8} {:>9} {:>13} {:>13} {:>13} {:>13}".format(
+        "chunk",
+        "bytes",
+        "objects",
+        "of full",
+        "store median",
+        "rebuild med.",
+        "rebuild p95",
+        "rebuild max"))
+    for size in arguments.chunk_sizes:
+        results = _benchmark(history, size, arguments.samples, arguments.seed)
+        print(("{:>6} {:>12} {:>8} {:>8.2%}" + " {:>11.2f}ms" * 4).format(
+            size,
+            results["size"],
+            results["objects"],
+            results["size"] / full_size,
+            1000 * results["store_median"],
+            1000 * results["reconstruct_median"],
+            1000 * results["reconstruct_p95"],
+            1000 * results["reconstruct_max"]))
+
+if __name__ == "__main__":
+    main()
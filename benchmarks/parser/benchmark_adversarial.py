@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "..",
+        "lambdas",
+        "parse_nlab_source"))
+
+# Read by the parser when it is imported. They only affect the URLs of links
+os.environ.setdefault("ROOT_URL", "https://ncatlab.org")
+os.environ.setdefault("FILE_ROOT_URL", "/nlab/files/")
+os.environ.setdefault("PAGE_ROOT_URL", "/nlab/show/")
+
+import environment_or_equation_reference_parser
+import include_parser
+import latex_parser
+import nlab_markdown_parser
+import page_link_parser
+
+"""
+Measures how long the custom span tokens take to find their matches in
+paragraphs built to be as slow as possible to search with their patterns alone:
+many opening delimiters which are never closed, or are only closed after a
+character which the pattern does not allow, on a single line. Each paragraph is
+searched both by the find method of the span token, which is what Mistletoe
+calls, and by the finditer method of its pattern, and rendered by the parser.
+
+The time per KiB taken by find, and by rendering, should stay about the same as
+the paragraphs grow, whereas that taken by finditer grows with them.
+"""
+
+# For each paragraph, the span token, the text which is repeated, and the text
+# which ends the paragraph
+_adversarial_paragraphs = {
+    "unclosed \\[": (latex_parser.StandAloneLatexToken, "\\[ x ", ""),
+    "unclosed [[": (page_link_parser.SimplePageLinkToken, "[[a ", ""),
+    "[[ closed after |": (
+        page_link_parser.SimplePageLinkToken,
+        "[[a ",
+        "|]]"),
+    "unclosed [[ with display text": (
+        page_link_parser.PageLinkWithDisplayTextToken,
+        "[[a ",
+        ""),
+    "unclosed \\ref{": (
+        environment_or_equation_reference_parser
+            .EnvironmentOrEquationReferenceToken,
+        "\\ref{a",
+        ""),
+    "unended eq:": (
+        environment_or_equation_reference_parser.EquationReferenceToken,
+        "eq:a",
+        ""),
+    "unclosed [[!include": (
+        include_parser.IncludeToken,
+        "[[!include a ",
+        "")
+}
+
+def _median_seconds(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def _render(paragraph):
+    nlab_markdown_parser._block_cache.clear()
+    # Text first, so that the paragraph does not begin a LaTeX block
+    nlab_markdown_parser.Renderer().render("x " + paragraph)
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description = "Benchmark the span tokens on adversarial paragraphs")
+    argument_parser.add_argument(
+        "--repetitions",
+        type = lambda repetitions: [
+            int(size) for size in repetitions.split(",")
+        ],
+        default = [ 1000, 2000, 4000, 8000 ],
+        help = "Numbers of times the unclosed delimiter is repeated")
+    argument_parser.add_argument("--repeats", type = int, default = 3)
+    arguments = argument_parser.parse_args()
+    print("{:>30} {:>8} {:>14} {:>14} {:>14}".format(
+        "paragraph",
+        "KiB",
+        "find/KiB",
+        "finditer/KiB",
+        "render/KiB"))
+    for name, (span_token, repeated, ending) in \
+            _adversarial_paragraphs.items():
+        for repetitions in arguments.repetitions:
+            paragraph = repeated * repetitions + ending
+            kibibytes = len(paragraph.encode("utf-8")) / 1024
+            seconds = [
+                _median_seconds(function, arguments.repeats)
+                for function in [
+                    lambda: list(span_token.find(paragraph)),
+                    lambda: list(span_token.pattern.finditer(paragraph)),
+                    lambda: _render(paragraph)
+                ]
+            ]
+            print("{:>30} {:>8.0f}".format(name, kibibytes) + "".join(
+                " {:>12.3f}ms".format(1000 * time / kibibytes)
+                for time in seconds))
+
+if __name__ == "__main__":
+    main()
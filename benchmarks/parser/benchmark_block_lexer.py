@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+
+import argparse
+import importlib.util
+import os
+import statistics
+import sys
+import time
+
+_parser_directory = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "..",
+    "lambdas",
+    "parse_nlab_source")
+
+sys.path.insert(0, _parser_directory)
+
+# Read by the parser when it is imported. They only affect the URLs of links
+os.environ.setdefault("ROOT_URL", "https://ncatlab.org")
+os.environ.setdefault("FILE_ROOT_URL", "/nlab/files/")
+os.environ.setdefault("PAGE_ROOT_URL", "/nlab/show/")
+
+import image_from_file_parser
+import latex_parser
+import nlab_markdown_parser
+import nlab_mistletoe
+
+import nlab_corpus
+
+"""
+Measures how long the parser takes to split the long pages of nlab_corpus, of
+increasing size, into their blocks, and to dispatch each block to be rendered,
+with the rendering itself (by Mistletoe, of LaTeX, and of images) replaced by a
+function which does nothing, since that is the same whichever way the blocks
+were found.
+
+The time per line should stay the same as the pages grow. If a copy of the
+parse_nlab_source directory from an earlier revision is given, its
+nlab_markdown_parser is measured on the same pages, for comparison.
+"""
+
+def _load_baseline(directory):
+    specification = importlib.util.spec_from_file_location(
+        "baseline_nlab_markdown_parser",
+        os.path.join(directory, "nlab_markdown_parser.py"))
+    module = importlib.util.module_from_spec(specification)
+    specification.loader.exec_module(module)
+    return module
+
+def _time(parser, source, repeats):
+    times = []
+    for _ in range(repeats):
+        # Otherwise every render after the first would only look up its blocks
+        parser._block_cache.clear()
+        start = time.perf_counter()
+        parser.Renderer().render(source)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description = "Benchmark splitting pages into blocks")
+    argument_parser.add_argument(
+        "--baseline",
+        help = "Copy of the parse_nlab_source directory from an earlier " +
+            "revision, to compare against")
+    argument_parser.add_argument(
+        "--sections",
+        type = lambda sections: [ int(size) for size in sections.split(",") ],
+        default = [ 10, 100, 1000, 10000 ])
+    argument_parser.add_argument("--repeats", type = int, default = 5)
+    argument_parser.add_argument("--seed", type = int, default = 0)
+    arguments = argument_parser.parse_args()
+    nlab_mistletoe.render = lambda source: ""
+    latex_parser.render_latex = lambda latex, display: ""
+    image_from_file_parser.render = lambda block: ""
+    parsers = [ ("current", nlab_markdown_parser) ]
+    if arguments.baseline:
+        parsers.append(("baseline", _load_baseline(arguments.baseline)))
+    print("{:>9} {:>9}".format("sections", "lines") + "".join(
+        " {:>12} {:>10}".format(name, "us/line") for name, _ in parsers) +
+        (" {:>8}".format("speedup") if len(parsers) > 1 else ""))
+    for sections in arguments.sections:
+        source = nlab_corpus.long_page(sections, arguments.seed)
+        lines = source.count("\n") + 1
+        times = [
+            _time(parser, source, arguments.repeats) for _, parser in parsers
+        ]
+        print("{:>9} {:>9}".format(sections, lines) + "".join(
+            " {:>10.2f}ms {:>10.2f}".format(
+                1000 * seconds,
+                1000000 * seconds / lines)
+            for seconds in times) +
+            (" {:>7.2f}x".format(times[1] / times[0])
+                if len(times) > 1 else ""))
+
+if __name__ == "__main__":
+    main()
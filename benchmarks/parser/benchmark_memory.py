@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "..",
+        "lambdas",
+        "parse_nlab_source"))
+
+# Read by the parser when it is imported. They only affect the URLs of links
+os.environ.setdefault("ROOT_URL", "https://ncatlab.org")
+os.environ.setdefault("FILE_ROOT_URL", "/nlab/files/")
+os.environ.setdefault("PAGE_ROOT_URL", "/nlab/show/")
+
+import image_from_file_parser
+import latex_parser
+import nlab_markdown_parser
+
+import nlab_corpus
+
+"""
+Measures the peak memory allocated whilst the parse lambda handles a request to
+render each of the long pages of nlab_corpus, of increasing size, as HTML and as
+a structured document, and whilst the same is done as the lambda did before
+pages were streamed, by building the whole rendered page in memory with
+Renderer.render and joining it, then finding its formulas and encoding the
+document as JSON.
+
+The memory of the request itself is not counted, but that of its parsed body
+is. The body of the response is the whole rendered page, so the peak memory
+grows with the page either way. For HTML it is about the same, the lines of
+the page and the body joined from them. For a structured document, it should be
+about half, the fragments and formulas being encoded as JSON as the page is
+rendered, rather than the document being built from the whole page and then
+encoded. The block cache of the parser, which is bounded but holds the
+renderings of many blocks, is made as small as the option given, so that it
+does not hide this.
+"""
+
+def _peak_memory(render):
+    tracemalloc.start()
+    try:
+        render()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def _event(source, body_format):
+    body = { "source": source }
+    if body_format is not None:
+        body["format"] = body_format
+    return {
+        "headers": dict(),
+        "requestContext": { "http": { "method": "PUT" } },
+        "body": json.dumps(body)
+    }
+
+def _buffered(event):
+    event_body = json.loads(event["body"])
+    rendered_source = "\n".join(
+        nlab_markdown_parser.Renderer().render(event_body["source"]))
+    if event_body.get("format") == "structured":
+        structured_document = latex_parser.StructuredDocumentWriter()
+        structured_document.write(rendered_source)
+        rendered_source = json.dumps(structured_document.document())
+    return rendered_source
+
+def _streamed(event):
+    return nlab_markdown_parser.lambda_handler(event, None)["body"]
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description = "Benchmark the peak memory of rendering large pages")
+    argument_parser.add_argument(
+        "--sections",
+        type = lambda sections: [ int(size) for size in sections.split(",") ],
+        default = [ 100, 1000, 3000 ])
+    argument_parser.add_argument(
+        "--block-cache-size",
+        type = int,
+        default = 16,
+        help = "Number of blocks the block cache of the parser may hold")
+    argument_parser.add_argument("--seed", type = int, default = 0)
+    arguments = argument_parser.parse_args()
+    image_from_file_parser._check_exists = lambda file_name: None
+    nlab_markdown_parser._block_cache_size = arguments.block_cache_size
+    formats = [ ("html", None), ("structured", "structured") ]
+    print("{:>9} {:>12}".format("sections", "source") + "".join(
+        " {:>18} {:>18}".format(
+            "{} buffered".format(name),
+            "{} streamed".format(name))
+        for name, _ in formats))
+    for sections in arguments.sections:
+        source = nlab_corpus.long_page(sections, arguments.seed)
+        peaks = []
+        for _, body_format in formats:
+            event = _event(source, body_format)
+            bodies = []
+            for render in [ _buffered, _streamed ]:
+                nlab_markdown_parser._block_cache.clear()
+                peaks.append(_peak_memory(
+                    lambda: bodies.append(render(event))))
+            if bodies[0] != bodies[1]:
+                raise Exception("Different responses for {} sections".format(
+                    sections))
+            bodies.clear()
+        print("{:>9} {:>9.0f}KiB".format(
+            sections,
+            len(source.encode("utf-8")) / 1024) + "".join(
+                " {:>15.0f}KiB".format(peak / 1024) for peak in peaks))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "..",
+        "lambdas",
+        "parse_nlab_source"))
+
+# Read by the parser when it is imported. They only affect the URLs of links
+os.environ.setdefault("ROOT_URL", "https://ncatlab.org")
+os.environ.setdefault("FILE_ROOT_URL", "/nlab/files/")
+os.environ.setdefault("PAGE_ROOT_URL", "/nlab/show/")
+
+import environment_or_equation_reference_parser
+import image_from_file_parser
+import include_parser
+import latex_parser
+import nlab_markdown_parser
+import page_link_parser
+
+import nlab_corpus
+
+"""
+Benchmarks parse_nlab_source on the synthetic pages of nlab_corpus, of
+increasing size. For every page it measures the median time taken by
+Renderer.render, and so the number of renders per second, and the peak memory
+allocated during a render. For the largest page of each kind, it also measures
+the time spent in each of the custom span tokens: finding their matches,
+creating them, and rendering them.
+
+The block cache is cleared before every render, as otherwise every render after
+the first would only look up its blocks. The check that the file of an
+imagefromfile block exists, which is a request to the site, is skipped, so that
+the results do not depend on the network.
+
+The results can be saved as JSON, and compared with those saved from an earlier
+revision, in which case the exit status is 1 if any page has become slower, or
+needs more memory, by more than the tolerance.
+"""
+
+_default_sizes = {
+    "long": [ 10, 100, 1000 ],
+    "nested": [ 14, 56, 224 ],
+    "formulas": [ 100, 1000, 5000 ],
+    "links": [ 100, 1000, 5000 ],
+    "blocks": [ 10, 100, 500 ]
+}
+
+_span_tokens = [
+    latex_parser.InlineLatexToken,
+    latex_parser.StandAloneLatexToken,
+    page_link_parser.SimplePageLinkToken,
+    page_link_parser.PageLinkWithDisplayTextToken,
+    environment_or_equation_reference_parser
+        .EnvironmentOrEquationReferenceToken,
+    environment_or_equation_reference_parser.EquationReferenceToken,
+    include_parser.IncludeToken
+]
+
+def _render(source):
+    nlab_markdown_parser._block_cache.clear()
+    nlab_markdown_parser.Renderer().render(source)
+
+def _median_seconds(source, repeats):
+    _render(source)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        _render(source)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def _peak_memory(source):
+    tracemalloc.start()
+    try:
+        _render(source)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def _timed(method, seconds):
+    def timed_method(*arguments):
+        start = time.perf_counter()
+        result = method(*arguments)
+        seconds[0] += time.perf_counter() - start
+        return result
+    return timed_method
+
+@contextlib.contextmanager
+def _profiled_span_tokens():
+    # Yields, for each span token, the number of matches found and the seconds
+    # spent finding, creating and rendering them, which are added to whilst
+    # within the context
+    profile = dict()
+    originals = []
+    for span_token in _span_tokens:
+        token_statistics = {
+            "matches": 0,
+            "find_seconds": [ 0 ],
+            "create_seconds": [ 0 ],
+            "render_seconds": [ 0 ]
+        }
+        profile[span_token.__name__] = token_statistics
+        find = span_token.find
+        def counted_find(
+                cls,
+                string,
+                find = find,
+                token_statistics = token_statistics):
+            start = time.perf_counter()
+            matches = list(find(string))
+            token_statistics["find_seconds"][0] += time.perf_counter() - start
+            token_statistics["matches"] += len(matches)
+            return matches
+        for attribute, replacement in [
+                ("find", classmethod(counted_find)),
+                ("__init__", _timed(
+                    span_token.__init__,
+                    token_statistics["create_seconds"])),
+                ("render", _timed(
+                    span_token.render,
+                    token_statistics["render_seconds"]))]:
+            originals.append(
+                (span_token, attribute, span_token.__dict__.get(attribute)))
+            setattr(span_token, attribute, replacement)
+    try:
+        yield profile
+    finally:
+        for span_token, attribute, original in reversed(originals):
+            if original is None:
+                delattr(span_token, attribute)
+            else:
+                setattr(span_token, attribute, original)
+        for token_statistics in profile.values():
+            for key in [ "find_seconds", "create_seconds", "render_seconds" ]:
+                token_statistics[key] = token_statistics[key][0]
+
+def _span_token_profile(source):
+    with _profiled_span_tokens() as profile:
+        _render(source)
+    return profile
+
+def _benchmark(pages, sizes, repeats, seed):
+    results = []
+    for page in pages:
+        for size in sizes or _default_sizes[page]:
+            source = nlab_corpus.pages[page](size, seed)
+            seconds = _median_seconds(source, repeats)
+            result = {
+                "page": page,
+                "size": size,
+                "bytes": len(source.encode("utf-8")),
+                "lines": source.count("\n") + 1,
+                "seconds": seconds,
+                "operations_per_second": 1 / seconds,
+                "peak_memory": _peak_memory(source)
+            }
+            print("{:>9} {:>6} {:>9} {:>10.2f}ms {:>10.1f} {:>9.0f}KiB".format(
+                page,
+                size,
+                result["bytes"],
+                1000 * seconds,
+                result["operations_per_second"],
+                result["peak_memory"] / 1024))
+            results.append(result)
+        results[-1]["span_tokens"] = _span_token_profile(source)
+    return results
+
+def _print_span_token_profiles(results):
+    print()
+    print("{:>9} {:>6} {:>36} {:>8} {:>10} {:>10} {:>10}".format(
+        "page",
+        "size",
+        "span token",
+        "matches",
+        "find",
+        "create",
+        "render"))
+    for result in results:
+        for name, profile in sorted(result.get("span_tokens", {}).items()):
+            print("{:>9} {:>6} {:>36} {:>8} {:>8.2f}ms {:>8.2f}ms {:>8.2f}ms"
+                .format(
+                    result["page"],
+                    result["size"],
+                    name,
+                    profile["matches"],
+                    1000 * profile["find_seconds"],
+                    1000 * profile["create_seconds"],
+                    1000 * profile["render_seconds"]))
+
+def _regressions(results, baseline_results, tolerance):
+    baseline = {
+        (result["page"], result["size"]): result
+        for result in baseline_results
+    }
+    regressions = []
+    for result in results:
+        baseline_result = baseline.get((result["page"], result["size"]))
+        if baseline_result is None:
+            continue
+        for key in [ "seconds", "peak_memory" ]:
+            ratio = result[key] / baseline_result[key]
+            if ratio > 1 + tolerance:
+                regressions.append("{} {}: {} {:.2f}x baseline".format(
+                    result["page"],
+                    result["size"],
+                    key,
+                    ratio))
+    return regressions
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description = "Benchmark the nLab parser on synthetic pages")
+    argument_parser.add_argument(
+        "--pages",
+        type = lambda pages: pages.split(","),
+        default = sorted(nlab_corpus.pages),
+        help = "Kinds of page, of: " + ", ".join(sorted(nlab_corpus.pages)))
+    argument_parser.add_argument(
+        "--sizes",
+        type = lambda sizes: [ int(size) for size in sizes.split(",") ],
+        help = "Sizes of every kind of page, rather than the default ones")
+    argument_parser.add_argument("--repeats", type = int, default = 5)
+    argument_parser.add_argument("--seed", type = int, default = 0)
+    argument_parser.add_argument(
+        "--output",
+        help = "File to save the results to, as JSON")
+    argument_parser.add_argument(
+        "--compare",
+        help = "File of results saved from an earlier revision")
+    argument_parser.add_argument(
+        "--tolerance",
+        type = float,
+        default = 0.2,
+        help = "Fraction by which a page may become slower, or need more " +
+            "memory, before it counts as a regression")
+    arguments = argument_parser.parse_args()
+    image_from_file_parser._check_exists = lambda file_name: None
+    print("{:>9} {:>6} {:>9} {:>12} {:>10} {:>12}".format(
+        "page",
+        "size",
+        "bytes",
+        "median",
+        "renders/s",
+        "peak memory"))
+    results = _benchmark(
+        arguments.pages,
+        arguments.sizes,
+        arguments.repeats,
+        arguments.seed)
+    _print_span_token_profiles(results)
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            json.dump(results, output_file, indent = 2)
+    if arguments.compare:
+        with open(arguments.compare, "r") as baseline_file:
+            regressions = _regressions(
+                results,
+                json.load(baseline_file),
+                arguments.tolerance)
+        print()
+        for regression in regressions:
+            print(regression)
+        print("{} regressions".format(len(regressions)))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import random
+
+"""
+Generates synthetic sources of nLab pages for benchmarking the parser. Each
+kind of page stresses one part of it, and grows with its size: the number of
+sections of a long page, the depth of nesting of theorem environments, the
+number of inline formulas, of links, or of centre and imagefromfile blocks.
+Every page is valid nLab source, and the same size and seed always give the
+same page.
+"""
+
+_words = [
+    "category", "functor", "limit", "colimit", "sheaf", "topos", "monad",
+    "adjoint", "homotopy", "of", "the", "is", "a", "every", "which",
+    "[[fibration]]", "$\\infty$-groupoid"
+]
+
+# Theorem environments no name of which is the beginning of another, since the
+# end of an environment is found by the beginning of its \end
+_theorem_environments = [
+    "theorem", "proof", "defn", "lemma", "remark", "example", "corollary",
+    "notation", "conjecture", "exercise", "statement", "assumption",
+    "scholium", "terminology"
+]
+
+def _sentence(generator, words = 12):
+    return " ".join(generator.choice(_words) for _ in range(words)) + "."
+
+def _formula(generator):
+    return "{}_{{{}}} \\to {}".format(
+        generator.choice("ABCXYZ"),
+        generator.randint(0, 99),
+        generator.choice([ "\\infty", "\\mathbb{N}", "x^2", "\\Omega" ]))
+
+def _link(generator, index):
+    page_name = "{} {}".format(generator.choice(_words), index)
+    link = generator.random()
+    if link < 0.6:
+        return "[[{}]]".format(page_name)
+    if link < 0.85:
+        return "[[{}|{} ${}$]]".format(
+            page_name,
+            generator.choice(_words),
+            _formula(generator))
+    if link < 0.9:
+        return "[[!include {}]]".format(page_name)
+    if link < 0.95:
+        return "\\ref{{Theorem{}}}".format(index)
+    return "(eq:Equation{})".format(index)
+
+def _paragraph(generator, lines):
+    return [ _sentence(generator) for _ in range(lines) ] + [ "" ]
+
+def long_page(size, seed = 0):
+    # A page of size sections, each of a few paragraphs and one LaTeX block,
+    # theorem environment or centre block
+    generator = random.Random(seed)
+    lines = [ "\\tableofcontents", "", "\\context_menu[category theory]", "" ]
+    for section in range(size):
+        lines.extend([
+            "## Section {} {{#Section{}}}".format(section, section),
+            ""
+        ])
+        for _ in range(generator.randint(1, 3)):
+            lines.extend(_paragraph(generator, generator.randint(2, 6)))
+        block = generator.random()
+        if block < 0.3:
+            lines.extend([
+                "$$",
+                _formula(generator),
+                "\\label{{Equation{}}}".format(section),
+                "$$",
+                ""
+            ])
+        elif block < 0.45:
+            lines.extend([ "\\[", _formula(generator), "\\]", "" ])
+        elif block < 0.8:
+            environment = generator.choice(_theorem_environments)
+            lines.append("\\begin{" + environment + "}")
+            lines.extend(
+                _sentence(generator) + "\\linebreak" for _ in range(3))
+            lines.extend([
+                "",
+                _sentence(generator),
+                "\\end{" + environment + "}",
+                ""
+            ])
+        else:
+            lines.extend([
+                "\\begin{centre}",
+                _sentence(generator),
+                "\\end{centre}",
+                ""
+            ])
+    return "\n".join(lines)
+
+def nested_page(size, seed = 0):
+    # size theorem environments, in stacks of environments each nested within
+    # the one before, as deep as the environments of different kinds allow,
+    # with a paragraph before and after each
+    generator = random.Random(seed)
+    lines = []
+    for stack in range(0, size, len(_theorem_environments)):
+        environments = _theorem_environments[:size - stack]
+        for depth, environment in enumerate(environments):
+            lines.append("\\begin{" + environment + "}")
+            if depth == 0:
+                lines.append("\\label{{Theorem{}}}".format(stack))
+            lines.extend([ "" ] + _paragraph(generator, 2))
+        for environment in reversed(environments):
+            lines.extend(_paragraph(generator, 2))
+            lines.extend([ "\\end{" + environment + "}", "" ])
+    return "\n".join(lines)
+
+def formulas_page(size, seed = 0):
+    # Paragraphs with size inline formulas in all
+    generator = random.Random(seed)
+    lines = [ "## Formulas", "" ]
+    for formula in range(0, size, 20):
+        lines.extend(
+            "{} ${}$ {}".format(
+                generator.choice(_words),
+                _formula(generator),
+                generator.choice(_words))
+            for _ in range(min(20, size - formula)))
+        lines.append("")
+    return "\n".join(lines)
+
+def links_page(size, seed = 0):
+    # Paragraphs with size links, with display text, inclusions and references
+    # among them
+    generator = random.Random(seed)
+    lines = [ "## Links", "" ]
+    for link in range(0, size, 20):
+        lines.extend(
+            "{} {} {}".format(
+                generator.choice(_words),
+                _link(generator, index),
+                generator.choice(_words))
+            for index in range(link, min(link + 20, size)))
+        lines.append("")
+    return "\n".join(lines)
+
+def blocks_page(size, seed = 0):
+    # size centre and imagefromfile blocks, alternately, with a paragraph
+    # between each
+    generator = random.Random(seed)
+    lines = [ "## Blocks", "" ]
+    for block in range(size):
+        if block % 2:
+            lines.extend([
+                "\\begin{imagefromfile}",
+                "\"file_name\": \"diagram_{}.png\",".format(block),
+                "\"width\": {},".format(generator.randint(100, 600)),
+                "\"float\": \"right\",",
+                "\"caption\": \"{} ${}$\"".format(
+                    generator.choice(_words),
+                    _formula(generator)).replace("\\", "\\\\"),
+                "\\end{imagefromfile}",
+                ""
+            ])
+        else:
+            environment = generator.choice([ "centre", "center" ])
+            lines.extend([
+                "\\begin{" + environment + "}",
+                "{} ${}$".format(_sentence(generator), _formula(generator)),
+                "\\end{" + environment + "}",
+                ""
+            ])
+        lines.extend(_paragraph(generator, 2))
+    return "\n".join(lines)
+
+pages = {
+    "long": long_page,
+    "nested": nested_page,
+    "formulas": formulas_page,
+    "links": links_page,
+    "blocks": blocks_page
+}
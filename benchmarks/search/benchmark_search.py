@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import random
+import re
+import statistics
+import string
+import sys
+import time
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "..",
+        "lambdas",
+        "search"))
+
+import page_name_matcher
+
+"""
+Compares the time taken to match search expressions against a list of page
+names by page_name_matcher, which is what the search lambda does, with that
+taken by the re module, which it did before.
+
+The page names are generated from words typical of nLab page names. The
+expressions are those typed into search, which page_name_matcher matches as a
+piece of text or the beginning of a page name, and ordinary regular
+expressions. Then there are expressions which take re a time exponential in
+the length of a page name of the form aaa...a!, which is added to the list
+with lengths increasing. For those, page_name_matcher should take about the
+same time whatever the length, whereas re takes twice as long or more for each
+character added.
+
+Finally, there are expressions which are too slow to match against every page
+name however they are matched, the automaton of which is so large that few of
+its states can be cached. These are only matched by page_name_matcher, with the
+deadline which the search lambda gives it, by which it should give up, having
+taken no longer than that.
+"""
+
+_words = [
+    "category", "functor", "limit", "sheaf", "topos", "monad", "adjoint",
+    "homotopy", "(infinity,1)-category", "fibration", "theory", "of", "in",
+    "cohomology", "higher", "model", "structure", "type", "space"
+]
+
+_expressions = [
+    "cat",
+    "^higher",
+    "homotopy type theory",
+    "categor(y|ies)$",
+    "^(co)?homology",
+    "\\(infinity,\\d\\)-",
+    "sheaf.*topos"
+]
+
+_adversarial_expressions = [
+    "(a+)+$",
+    "(a|aa)*$",
+    "(a*)*b"
+]
+
+_timed_out_expressions = [
+    "[aeiou].{10}(\\w?\\s?){2300}\\d"
+]
+
+def _page_names(count, seed):
+    generator = random.Random(seed)
+    page_names = set()
+    while len(page_names) < count:
+        page_names.add(" ".join(
+            generator.choice(_words) for _ in range(generator.randint(1, 4))))
+    return sorted(page_names)
+
+def _median_seconds(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def _re_expression(expression):
+    # As search did before, but with the set it used, [x|X], corrected
+    if expression[0] in string.ascii_letters:
+        return "[{}{}]{}".format(
+            expression[0].lower(),
+            expression[0].upper(),
+            expression[1:])
+    return expression
+
+def _with_re(expression, page_names):
+    regex = re.compile(_re_expression(expression))
+    return [ page_name for page_name in page_names if regex.search(page_name) ]
+
+def _with_matcher(expression, page_names, deadline = None):
+    # As the search lambda does, except that it finds the page names beginning
+    # with the prefixes by a binary search
+    matcher = page_name_matcher.PageNameMatcher(expression)
+    if matcher.prefixes is not None:
+        prefixes = tuple(matcher.prefixes)
+        return [
+            page_name for page_name in page_names
+            if page_name.startswith(prefixes)
+        ]
+    if matcher.literals_regex is not None:
+        return [
+            page_name for page_name in page_names
+            if matcher.literals_regex.search(page_name)
+        ]
+    return [
+        page_name for page_name in page_names
+        if matcher.matches(page_name, deadline)
+    ]
+
+def _timed_out(expression, page_names, search_seconds):
+    # Whether matching gave up at its deadline, and the time taken
+    start = time.perf_counter()
+    try:
+        _with_matcher(
+            expression,
+            page_names,
+            time.monotonic() + search_seconds)
+    except page_name_matcher.SearchTimedOutException:
+        return True, time.perf_counter() - start
+    return False, time.perf_counter() - start
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description = "Benchmark matching search expressions to page names")
+    argument_parser.add_argument("--page-names", type = int, default = 20000)
+    argument_parser.add_argument(
+        "--lengths",
+        type = lambda lengths: [ int(length) for length in lengths.split(",") ],
+        default = [ 16, 18, 20, 22 ],
+        help = "Lengths of the page name added for adversarial expressions")
+    argument_parser.add_argument("--repeats", type = int, default = 3)
+    argument_parser.add_argument(
+        "--search-seconds",
+        type = float,
+        default = 2,
+        help = "Time after which the search lambda gives up matching")
+    argument_parser.add_argument("--seed", type = int, default = 0)
+    arguments = argument_parser.parse_args()
+    page_names = _page_names(arguments.page_names, arguments.seed)
+    print("{:>24} {:>8} {:>10} {:>10} {:>10}".format(
+        "expression",
+        "length",
+        "matches",
+        "re",
+        "matcher"))
+    cases = [ (expression, None) for expression in _expressions ] + [
+        (expression, length)
+        for expression in _adversarial_expressions
+        for length in arguments.lengths
+    ]
+    for expression, length in cases:
+        case_page_names = page_names
+        if length is not None:
+            case_page_names = page_names + [ "a" * length + "!" ]
+        matches = _with_matcher(expression, case_page_names)
+        if matches != _with_re(expression, case_page_names):
+            raise Exception("Different matches for {}".format(expression))
+        seconds = [
+            _median_seconds(
+                lambda: function(expression, case_page_names),
+                arguments.repeats)
+            for function in [ _with_re, _with_matcher ]
+        ]
+        print("{:>24} {:>8} {:>10}".format(
+            expression,
+            "" if length is None else length,
+            len(matches)) + "".join(
+                " {:>8.1f}ms".format(1000 * time) for time in seconds))
+    for expression in _timed_out_expressions:
+        timed_out, seconds = _timed_out(
+            expression,
+            page_names,
+            arguments.search_seconds)
+        print("{} {}: {:.1f}ms".format(
+            expression,
+            "timed out" if timed_out else "matched",
+            1000 * seconds))
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,43 @@
+// Pages with a table of contents which do not include other pages are numbered,
+// and their references filled in, when they are parsed, in which case their
+// table of contents is marked as numbered
+function numbered_when_parsed() {
+  var table_of_contents = document.getElementById("table_of_contents")
+  return (table_of_contents !== null) && table_of_contents.hasAttribute("data-numbered")
+}
+
+// A page numbered when it was parsed may be included in a page which is not,
+// which numbers the content included in it along with its own. The numbers of
+// the included page, and the ids which depend on them, are removed first, so
+// that they are neither shown twice nor duplicated
+function remove_included_numbering() {
+  document.querySelectorAll(".page_inclusion [data-theorem-number]").forEach(element => {
+    var number_suffix = " " + element.getAttribute("data-theorem-number")
+    if (element.textContent.endsWith(number_suffix)) {
+      element.textContent = element.textContent.slice(0, -number_suffix.length)
+    }
+    element.removeAttribute("id")
+    element.removeAttribute("data-theorem-number")
+  })
+  document.querySelectorAll(".page_inclusion [data-equation-number]").forEach(element => {
+    element.querySelectorAll(":scope > span.equation").forEach(equation => equation.remove())
+    element.removeAttribute("data-equation-number")
+  })
+  document.querySelectorAll(".page_inclusion :is(h2, h3, h4, h5, h6)[id^=\"section-\"]").forEach(element => {
+    element.removeAttribute("id")
+    var first_child = element.firstChild
+    if ((element.tagName == "H2") && first_child && (first_child.nodeType == Node.TEXT_NODE)) {
+      first_child.textContent = first_child.textContent.replace(/^[0-9]+\. /, "")
+    }
+  })
+  document.querySelectorAll(".page_inclusion a.environment_or_equation_reference").forEach(element => {
+    element.textContent = ""
+  })
+}
+
 function contents_and_environment_numbering() {
   var table_of_contents = document.getElementById("table_of_contents")
-  if (!table_of_contents) {
+  if (!table_of_contents || numbered_when_parsed()) {
     return
   }
   var table_of_contents_list = document.createElement("ol")
@@ -52,6 +89,9 @@ function contents_and_environment_numbering() {
 }
 
 function environment_and_equation_references() {
+  if (numbered_when_parsed()) {
+    return
+  }
   document.querySelectorAll("a.environment_or_equation_reference").forEach(element => {
     var environment_or_equation_id = element.getAttribute("href").substr(1);
     var environment_or_equation = document.getElementById(environment_or_equation_id);
@@ -77,6 +117,9 @@ function environment_and_equation_references() {
 }
 
 function equation_numbering() {
+  if (numbered_when_parsed()) {
+    return
+  }
   var counter = 0
   document.querySelectorAll("span.katex-display").forEach(element => {
     counter += 1
@@ -1,7 +1,9 @@
+const CONTEXT_FRAGMENTS_ROOT_URL = "/nlab/context/fragment/"
 const CONTEXT_PAGES_ROOT_URL = "/nlab/context/show/"
 const DISCUSSION_THREAD_ROOT_URL = "https://nforum.ncatlab.org/nforum_discussion_thread/"
 const FORUM_NAME = "nForum"
 const FORUM_ROOT_URL = "https://nforum.ncatlab.org"
+const FRAGMENTS_ROOT_URL = "/nlab/fragment/"
 const LATEST_REVISION_ROOT_URL = "https://9q67bfe8i1.execute-api.us-east-2.amazonaws.com/latest_revision"
 const NFORUM_ANNOUNCEMENT_URL = "https://nforum.ncatlab.org/nforum_edit_announcement"
 const PAGES_ROOT_URL = "/nlab/show/"
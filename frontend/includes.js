@@ -1,33 +1,54 @@
-function render_includes() {
-  const page_inclusions = document.getElementsByClassName("page_inclusion")
-  if (page_inclusions === undefined || page_inclusions.length == 0) {
-    contents_and_environment_numbering()
-    equation_numbering()
-    environment_and_equation_references()
-    render_context_menu()
-    return
-  }
-  for (var i=0; i < page_inclusions.length; i++) {
-    const page_inclusion_div = page_inclusions[i]
-    const page_name = page_inclusion_div.dataset.pageToInclude
-    fetch(PAGES_ROOT_URL + page_name)
-      .then(response => {
-        if (response.status != 200) {
-          return ""
-        }
+const PAGE_CONTENT_START = "<span class=\"page_content_start\"></span>"
+const PAGE_CONTENT_END = "<span class=\"page_content_end\"></span>"
+
+// The content of a page, from its fragment, or from the whole page if it was
+// stored before fragments were. Empty if the page cannot be fetched
+function fetch_page_content(page_name) {
+  return fetch(FRAGMENTS_ROOT_URL + page_name)
+    .then(response => {
+      if (response.status == 200) {
         return response.text()
-      })
-      .then(page_to_include => {
-        if (page_to_include) {
+      }
+      return fetch(PAGES_ROOT_URL + page_name)
+        .then(response => {
+          if (response.status != 200) {
+            return ""
+          }
+          return response.text()
+        })
+        .then(page => {
+          if (!page.includes(PAGE_CONTENT_START)) {
+            return ""
+          }
+          return page.split(PAGE_CONTENT_START)[1].split(PAGE_CONTENT_END)[0]
+        })
+    })
+}
+
+// Inclusions expanded when the page was stored (data-included) are already in
+// the page. The others are fetched concurrently, and the page is numbered once,
+// when all of them have been included, any numbering of the included pages
+// themselves having been removed
+function render_includes() {
+  const page_inclusions = Array.from(
+    document.getElementsByClassName("page_inclusion")).filter(
+      page_inclusion_div => !("included" in page_inclusion_div.dataset))
+  Promise.all(page_inclusions.map(page_inclusion_div =>
+    fetch_page_content(page_inclusion_div.dataset.pageToInclude)
+      .catch(() => "")
+      .then(page_content => {
+        if (page_content) {
           page_inclusion_div.style.paddingTop = "0em"
-          page_inclusion_div.innerHTML = page_to_include.split("<span class=\"page_content_start\"></span>")[1].split("<span class=\"page_content_end\"></span>")[0]
+          page_inclusion_div.innerHTML = page_content
         }
-        contents_and_environment_numbering()
-        equation_numbering()
-        environment_and_equation_references()
-        render_context_menu()
-      })
-  }
+      })))
+    .then(() => {
+      remove_included_numbering()
+      contents_and_environment_numbering()
+      equation_numbering()
+      environment_and_equation_references()
+      render_context_menu()
+    })
 }
 
 document.addEventListener("DOMContentLoaded", function () {
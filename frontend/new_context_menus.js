@@ -1,13 +1,30 @@
 var context_header_set = false
 
+// The #for_display element of a context page, or null. Only the fragment holding
+// the content of the page is fetched and parsed, unless the page was stored
+// before fragments were, in which case the whole page is. Either is parsed as a
+// fragment, in a template, rather than as a document
+function fetch_for_display(context_name) {
+  return fetch(CONTEXT_FRAGMENTS_ROOT_URL + context_name)
+    .then(response => {
+      if (response.status == 200) {
+        return response.text()
+      }
+      return fetch(CONTEXT_PAGES_ROOT_URL + context_name)
+        .then(response => response.text())
+    })
+    .then(content => {
+      var template = document.createElement("template")
+      template.innerHTML = content
+      return template.content.querySelector("#for_display")
+    })
+}
+
 function fetch_content(element) {
   var context_name = element.id.replace("context_", "").replace(/_/g, " ")
   var header_name =  element.id + "_header"
-  fetch(CONTEXT_PAGES_ROOT_URL + context_name)
-    .then(response => response.text())
-    .then(content => {
-      var parsed_content = new DOMParser().parseFromString(content, 'text/html');
-      var content_element = parsed_content.querySelector("#for_display")
+  fetch_for_display(context_name)
+    .then(content_element => {
       if (content_element === null) {
         return
       }
@@ -32,7 +49,7 @@ function fetch_content(element) {
       var context_content = document.createElement("div")
       context_content.id = element.id + "_content"
       context_content.style.display = "none"
-      context_content.innerHTML = content_element.innerHTML
+      context_content.append(...content_element.childNodes)
       document.getElementById(element.id).appendChild(context_header)
       document.getElementById(element.id).appendChild(context_content)
   })
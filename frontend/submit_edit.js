@@ -114,7 +114,11 @@ function parse_render_and_store() {
           document.getElementById("preview").innerHTML = ""
           document.getElementById("preview_separator").style.display = "none"
         } else {
-          window.location = ROOT_URL + "/show/" + document.getElementById("title").getAttribute("page_name")
+          // The query string is part of the CloudFront cache key, so that the
+          // new revision is shown even before the invalidation of the page at
+          // the edge has completed
+          window.location = ROOT_URL + "/show/" + document.getElementById("title").getAttribute("page_name") +
+            "?revision=" + (parseInt(document.getElementById("title").getAttribute("latest_revision")) + 1)
         }
       })
     } else {
@@ -0,0 +1,265 @@
+import concurrent.futures
+import contextlib
+import json
+import os
+import re
+import requests
+import threading
+import time
+
+try:
+    import render_engine
+except ImportError:
+    render_engine = None
+
+_new_diagram_root_url = os.environ["NEW_DIAGRAM_ROOT_URL"]
+_parse_source_root_url = os.environ["PARSE_SOURCE_ROOT_URL"]
+_render_latex_root_url = os.environ["RENDER_LATEX_ROOT_URL"]
+_render_page_root_url = os.environ["RENDER_PAGE_ROOT_URL"]
+
+_max_diagram_workers = 8
+_latex_diagrams_regex = re.compile(
+    r"(\\begin{tikzpicture}(.*?)\\end{tikzpicture})|" +
+        r"(\\begin{tikzcd}(.*?)\\end{tikzcd})|" +
+        r"(\\begin{xymatrix}(.*?)\\end{xymatrix})",
+    re.DOTALL)
+
+"""
+Renders the source of an edit to a page, creating its diagrams and then
+rendering the page, as both store_edit and preview_edit do, with which this
+must be packaged. The page is rendered by render_engine if it is packaged too,
+and otherwise, or if its worker cannot be started, by the chain of HTTP
+requests to the parse, render_latex and render_nlab_page lambdas.
+"""
+
+class FailedToRenderDiagramException(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+class FailedToParseException(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+class FailedToRenderException(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+class FailedToRenderLatexException(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+"""
+Records the duration of each stage of handling a request, and the sizes of the
+input and output of the stage, so that it can be seen where the time taken by
+a slow request went. Stages may be recorded from several threads at once.
+"""
+class StageTimings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = []
+        self.lock = threading.Lock()
+
+    def record(
+            self,
+            stage,
+            seconds,
+            input_bytes = None,
+            output_bytes = None,
+            detail = None):
+        timing = { "stage": stage, "seconds": round(seconds, 6) }
+        if input_bytes is not None:
+            timing["input_bytes"] = input_bytes
+        if output_bytes is not None:
+            timing["output_bytes"] = output_bytes
+        if detail is not None:
+            timing["detail"] = detail
+        with self.lock:
+            self.stages.append(timing)
+
+    @contextlib.contextmanager
+    def stage(self, stage, input_bytes = None, detail = None):
+        # The output size, if there is one, is set as "output_bytes" on the
+        # yielded dictionary
+        sizes = dict()
+        start = time.perf_counter()
+        try:
+            yield sizes
+        finally:
+            self.record(
+                stage,
+                time.perf_counter() - start,
+                input_bytes,
+                sizes.get("output_bytes"),
+                detail)
+
+    def log(self, **fields):
+        with self.lock:
+            print(json.dumps({
+                **fields,
+                "total_seconds": round(time.perf_counter() - self.start, 6),
+                "stages": self.stages
+            }))
+
+    def server_timing_header(self):
+        # The details, which may be page names or S3 keys, and so need not be
+        # valid in a header, are only logged
+        with self.lock:
+            return ", ".join(
+                "{};dur={:.1f}".format(
+                    timing["stage"],
+                    1000 * timing["seconds"])
+                for timing in self.stages)
+
+def _diagram_type_and_source(diagram_source_match):
+    if diagram_source_match.group(1) is not None:
+        return "tikz", diagram_source_match.group(1)
+    elif diagram_source_match.group(3) is not None:
+        return "tikzcd", diagram_source_match.group(3)
+    return "xypic", diagram_source_match.group(5)
+
+def _extract_diagrams(source):
+    return [
+        (match.start(), match.end(), *_diagram_type_and_source(match))
+        for match in _latex_diagrams_regex.finditer(source)
+    ]
+
+def _create_diagram(metadata, diagram_type, diagram, timings, preview):
+    # Returns the response of new_latex_diagram
+    new_diagram = {
+        "type": diagram_type,
+        "source": diagram,
+        "author": metadata["author"],
+        "ip_address": metadata["ip_address"]
+    }
+    if preview:
+        new_diagram["preview"] = True
+    with timings.stage(
+            "diagram",
+            len(diagram.encode("utf-8")),
+            diagram_type) as sizes:
+        response = requests.post(_new_diagram_root_url, json = new_diagram)
+        sizes["output_bytes"] = len(response.content)
+    if response.status_code != 200:
+        raise FailedToRenderDiagramException(
+            response.status_code,
+            "An error occurred when trying to render the following " +
+            "diagram.\n\n{}\n\nError: {}".format(
+                diagram,
+                response.text))
+    return response
+
+def _create_diagrams(metadata, diagrams, timings, preview):
+    # Each distinct diagram is rendered once, all of them concurrently. If any
+    # of them fail, the errors for all of them are reported together, in the
+    # order in which the diagrams appear in the source
+    responses = dict()
+    failures = dict()
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers = _max_diagram_workers) as executor:
+        futures = {
+            executor.submit(
+                _create_diagram,
+                metadata,
+                diagram_type,
+                diagram,
+                timings,
+                preview): (diagram_type, diagram)
+            for diagram_type, diagram in dict.fromkeys(diagrams)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                responses[futures[future]] = future.result()
+            except FailedToRenderDiagramException as exception:
+                failures[futures[future]] = exception
+    if failures:
+        exceptions = [
+            failures[diagram] for diagram in dict.fromkeys(diagrams)
+            if diagram in failures
+        ]
+        raise FailedToRenderDiagramException(
+            exceptions[0].status_code,
+            "\n\n".join(str(exception) for exception in exceptions))
+    return responses
+
+def render_diagrams(metadata, source, timings, diagram_tag, preview = False):
+    # The source with each diagram replaced by diagram_tag of the response of
+    # new_latex_diagram for it. A preview diagram is only rendered into a
+    # short-lived preview area if it has not been submitted before
+    diagrams = _extract_diagrams(source)
+    if not diagrams:
+        return source
+    responses = _create_diagrams(
+        metadata,
+        [ (diagram_type, diagram) for _, _, diagram_type, diagram in diagrams ],
+        timings,
+        preview)
+    with_img_tags = []
+    previous_end = 0
+    for start, end, diagram_type, diagram in diagrams:
+        with_img_tags.append(source[previous_end:start])
+        with_img_tags.append(diagram_tag(responses[(diagram_type, diagram)]))
+        previous_end = end
+    with_img_tags.append(source[previous_end:])
+    return "".join(with_img_tags)
+
+def _render_page_over_http(source, page_name, timings):
+    # Sanitising is carried out by the render_nlab_page lambda, so is included
+    # in the render_page stage
+    with timings.stage("parse", len(source.encode("utf-8"))) as sizes:
+        response = requests.put(
+            _parse_source_root_url,
+            json = {
+                "source": source,
+                "format": "structured"
+            })
+        sizes["output_bytes"] = len(response.content)
+    if response.status_code != 200:
+        raise FailedToParseException(response.status_code, response.text)
+    # The structured document, in which the formulas have already been found,
+    # unless the parse lambda predates it
+    if response.headers.get("Content-Type") == "application/json":
+        parsed_source = response.json()
+    else:
+        parsed_source = response.text
+
+    with timings.stage("render_latex", len(response.content)) as sizes:
+        response = requests.put(
+            _render_latex_root_url,
+            json = {
+                "source": parsed_source
+            })
+        sizes["output_bytes"] = len(response.content)
+    if response.status_code != 200:
+        raise FailedToRenderLatexException(response.status_code, response.text)
+
+    with timings.stage("render_page", len(response.content)) as sizes:
+        response = requests.put(
+            _render_page_root_url,
+            json = {
+                "page_name": page_name,
+                "parsed_source": response.text
+            })
+        sizes["output_bytes"] = len(response.content)
+    if response.status_code != 200:
+        raise FailedToRenderException(response.status_code, response.text)
+    return response.text
+
+def render_page(source, page_name, timings):
+    if render_engine is None:
+        return _render_page_over_http(source, page_name, timings)
+    try:
+        return render_engine.render_page(source, page_name, timings)
+    except render_engine.RenderEngineUnavailableException:
+        return _render_page_over_http(source, page_name, timings)
+    except render_engine.FailedToParseException as exception:
+        raise FailedToParseException(exception.status_code, str(exception))
+    except render_engine.FailedToRenderLatexException as exception:
+        raise FailedToRenderLatexException(
+            exception.status_code,
+            str(exception))
+    except render_engine.FailedToSanitiseException as exception:
+        raise FailedToRenderException(exception.status_code, str(exception))
@@ -0,0 +1,74 @@
+import boto3
+import collections
+import hashlib
+import json
+import os
+
+_cloudfront_client = boto3.client("cloudfront")
+
+_cloudfront_distribution_id = os.environ["CLOUDFRONT_DISTRIBUTION_ID"]
+
+# CloudFront allows 3000 paths, of which 15 with wildcards, to be being
+# invalidated at once
+_max_paths = 3000
+_max_paths_per_directory = 100
+_max_wildcard_paths = 15
+
+"""
+Invalidates in CloudFront the paths queued by store_edit and
+update_page_history, when pages, sources or history pages change.
+
+This is triggered by the SQS invalidation queue, with a batch size of 10000 and
+a batching window of 10 seconds, so that it runs once there are 10000 queued
+messages, or 10 seconds after the first of them, whichever is sooner. All of the
+paths of a batch are invalidated together in a single invalidation, with
+duplicates removed. If many paths in a batch are in the same directory, the
+whole directory is invalidated instead.
+
+If the invalidation fails (for instance because too many are in progress), an
+exception is raised, so that SQS retries the whole batch. The caller reference
+of an invalidation is determined by the messages of the batch, so that a retry
+of a batch whose invalidation was in fact created does not invalidate again.
+"""
+
+def _coalesced(paths):
+    paths_by_directory = collections.defaultdict(set)
+    for path in paths:
+        paths_by_directory[path.rsplit("/", 1)[0]].add(path)
+    coalesced = []
+    for directory, directory_paths in sorted(paths_by_directory.items()):
+        if len(directory_paths) > _max_paths_per_directory:
+            coalesced.append(directory + "/*")
+        else:
+            coalesced.extend(sorted(directory_paths))
+    wildcard_paths = [ path for path in coalesced if path.endswith("*") ]
+    if (len(coalesced) > _max_paths) or \
+            (len(wildcard_paths) > _max_wildcard_paths):
+        return [ "/*" ]
+    return coalesced
+
+def lambda_handler(event, context):
+    paths = set()
+    message_ids = []
+    for record in event["Records"]:
+        paths.update(json.loads(record["body"])["paths"])
+        message_ids.append(record["messageId"])
+    if not paths:
+        return
+    paths = _coalesced(paths)
+    caller_reference = hashlib.sha256(
+        "\n".join(sorted(message_ids)).encode("utf-8")).hexdigest()
+    _cloudfront_client.create_invalidation(
+        DistributionId = _cloudfront_distribution_id,
+        InvalidationBatch = {
+            "Paths": {
+                "Quantity": len(paths),
+                "Items": paths
+            },
+            "CallerReference": caller_reference
+        })
+    print(json.dumps({
+        "messages": len(message_ids),
+        "paths": len(paths),
+        "caller_reference": caller_reference
+    }))
@@ -0,0 +1,214 @@
+import difflib
+import gzip
+import json
+
+"""
+Stores the history of the source of a page as reverse deltas, rather than as a
+full copy of the source for every revision.
+
+The revisions of a page are grouped into chunks of chunk_size consecutive
+revisions, each stored as a single object. A chunk holds the full source of its
+newest revision, and for each older revision in it a delta from the revision
+after it. So the newest source of a page is always stored in full, and any
+revision is reconstructed from the chunk containing it by applying at most
+chunk_size - 1 deltas.
+
+A delta is a list of operations on the lines of the newer source, each either a
+pair [start, end], meaning the lines from start up to but not including end of
+the newer source, or a string, meaning that text itself. The older source is the
+concatenation of the results of the operations.
+
+Pages whose history was stored before this was used may have no chunk for their
+earlier revisions, and a chunk may begin part of the way into its range, with
+the first revision stored after this began to be used. Revisions not in any
+chunk are read from the full copies of the sources under the legacy root, if
+one is given.
+"""
+
+chunk_size = 64
+
+class RevisionNotFoundException(Exception):
+    pass
+
+class NonConsecutiveRevisionException(Exception):
+    pass
+
+def delta(newer, older):
+    newer_lines = newer.splitlines(keepends = True)
+    older_lines = older.splitlines(keepends = True)
+    operations = []
+    # With its heuristic for lines which occur very often (blank ones, in
+    # particular) turned off, SequenceMatcher is an order of magnitude slower on
+    # large pages, for deltas hardly any smaller
+    matcher = difflib.SequenceMatcher(None, newer_lines, older_lines)
+    for tag, newer_start, newer_end, older_start, older_end in \
+            matcher.get_opcodes():
+        if tag == "equal":
+            operations.append([ newer_start, newer_end ])
+        elif tag in [ "insert", "replace" ]:
+            operations.append("".join(older_lines[older_start:older_end]))
+    return operations
+
+def apply_delta(newer, operations):
+    newer_lines = newer.splitlines(keepends = True)
+    return "".join(
+        "".join(newer_lines[operation[0]:operation[1]])
+            if isinstance(operation, list) else operation
+        for operation in operations)
+
+def chunk_index(revision_number, size = chunk_size):
+    return (revision_number - 1) // size
+
+def new_chunk(revision_number, source):
+    return {
+        "first_revision": revision_number,
+        "last_revision": revision_number,
+        "snapshot": source,
+        "deltas": []
+    }
+
+def with_revision(chunk, revision_number, source):
+    if chunk is None:
+        return new_chunk(revision_number, source)
+    if revision_number != chunk["last_revision"] + 1:
+        raise NonConsecutiveRevisionException(
+            "Revision {} cannot follow revision {}".format(
+                revision_number,
+                chunk["last_revision"]))
+    return {
+        "first_revision": chunk["first_revision"],
+        "last_revision": revision_number,
+        "snapshot": source,
+        "deltas": chunk["deltas"] + [ delta(source, chunk["snapshot"]) ]
+    }
+
+def without_last_revision(chunk):
+    # Returns None if the chunk would be left empty
+    if chunk["first_revision"] == chunk["last_revision"]:
+        return None
+    return {
+        "first_revision": chunk["first_revision"],
+        "last_revision": chunk["last_revision"] - 1,
+        "snapshot": apply_delta(chunk["snapshot"], chunk["deltas"][-1]),
+        "deltas": chunk["deltas"][:-1]
+    }
+
+def contains(chunk, revision_number):
+    return (chunk is not None) and \
+        (chunk["first_revision"] <= revision_number <= chunk["last_revision"])
+
+def revision_source(chunk, revision_number):
+    if not contains(chunk, revision_number):
+        raise RevisionNotFoundException()
+    source = chunk["snapshot"]
+    for index in range(
+            chunk["last_revision"] - chunk["first_revision"] - 1,
+            revision_number - chunk["first_revision"] - 1,
+            -1):
+        source = apply_delta(source, chunk["deltas"][index])
+    return source
+
+def encode_chunk(chunk):
+    return gzip.compress(
+        json.dumps(chunk, separators = (",", ":")).encode("utf-8"),
+        mtime = 0)
+
+def decode_chunk(encoded_chunk):
+    return json.loads(gzip.decompress(encoded_chunk).decode("utf-8"))
+
+"""
+Chunks stored in S3, under root_url/<page name>/<chunk index>. A chunk is only
+ever overwritten conditionally on it not having changed since it was read, and
+only ever created conditionally on it not existing, so that two revisions of a
+page stored at once cannot lose one another.
+"""
+class DeltaHistory:
+    def __init__(
+            self,
+            s3_client,
+            bucket_name,
+            root_url,
+            legacy_root_url = None,
+            size = chunk_size):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.root_url = root_url
+        self.legacy_root_url = legacy_root_url
+        self.size = size
+
+    def chunk_key(self, page_name, index):
+        return "{}/{}/{}".format(self.root_url, page_name, index)
+
+    def read_chunk(self, page_name, index):
+        # Returns the chunk and its ETag, or None twice if there is no chunk
+        try:
+            response = self.s3_client.get_object(
+                Bucket = self.bucket_name,
+                Key = self.chunk_key(page_name, index))
+        except self.s3_client.exceptions.NoSuchKey:
+            return None, None
+        return decode_chunk(response["Body"].read()), response["ETag"]
+
+    def _chunk_put_object_request(self, page_name, index, chunk, etag):
+        put_object_request = {
+            "Body": encode_chunk(chunk),
+            "ContentEncoding": "gzip",
+            "ContentType": "application/json",
+            "Key": self.chunk_key(page_name, index)
+        }
+        if etag is None:
+            put_object_request["IfNoneMatch"] = "*"
+        else:
+            put_object_request["IfMatch"] = etag
+        return put_object_request
+
+    def put_object_request(self, page_name, revision_number, source):
+        # The request, without a Bucket, with which to store the revision
+        index = chunk_index(revision_number, self.size)
+        chunk, etag = self.read_chunk(page_name, index)
+        return self._chunk_put_object_request(
+            page_name,
+            index,
+            with_revision(chunk, revision_number, source),
+            etag)
+
+    def remove_revision(self, page_name, revision_number):
+        # Undoes storing the revision, if it was stored and is still the latest
+        index = chunk_index(revision_number, self.size)
+        chunk, etag = self.read_chunk(page_name, index)
+        if (chunk is None) or (chunk["last_revision"] != revision_number):
+            return
+        chunk = without_last_revision(chunk)
+        if chunk is None:
+            self.s3_client.delete_object(
+                Bucket = self.bucket_name,
+                Key = self.chunk_key(page_name, index))
+            return
+        self.s3_client.put_object(
+            Bucket = self.bucket_name,
+            **self._chunk_put_object_request(page_name, index, chunk, etag))
+
+    def _legacy_source(self, page_name, revision_number):
+        if self.legacy_root_url is None:
+            raise RevisionNotFoundException()
+        try:
+            response = self.s3_client.get_object(
+                Bucket = self.bucket_name,
+                Key = "{}/{}/{}".format(
+                    self.legacy_root_url,
+                    page_name,
+                    revision_number))
+        except self.s3_client.exceptions.NoSuchKey:
+            raise RevisionNotFoundException()
+        body = response["Body"].read()
+        if response.get("ContentEncoding") == "gzip":
+            body = gzip.decompress(body)
+        return body.decode("utf-8")
+
+    def source(self, page_name, revision_number):
+        chunk, _ = self.read_chunk(
+            page_name,
+            chunk_index(revision_number, self.size))
+        if contains(chunk, revision_number):
+            return revision_source(chunk, revision_number)
+        return self._legacy_source(page_name, revision_number)
@@ -0,0 +1,82 @@
+import boto3
+import os
+
+import delta_history
+
+_s3_client = boto3.client("s3")
+
+_delta_history_sources_root_url = os.environ["DELTA_HISTORY_SOURCES_ROOT_URL"]
+_history_sources_root_url = os.environ["HISTORY_SOURCES_ROOT_URL"]
+_pages_bucket_name = os.environ["PAGES_BUCKET_NAME"]
+
+_delta_history = delta_history.DeltaHistory(
+    _s3_client,
+    _pages_bucket_name,
+    _delta_history_sources_root_url,
+    _history_sources_root_url)
+
+"""
+Serves the source of a revision of a page, reconstructed from the reverse
+deltas of delta_history (or read from its full copy, for a revision stored
+before delta_history was used). The source of a revision never changes, so may
+be cached indefinitely.
+"""
+
+def _handle_cors(event):
+    headers = dict()
+    try:
+        origin_header = event["headers"]["origin"]
+        if ("nlab-pages.s3.us-east-2.amazonaws.com" in origin_header) or \
+                ("ncatlab.org" in origin_header):
+            headers["Access-Control-Allow-Origin"] = origin_header
+            headers["Access-Control-Allow-Headers"] = "Content-Type"
+            headers["Access-Control-Allow-Methods"] = "OPTIONS, GET"
+    except KeyError:
+        pass
+    if event["requestContext"]["http"]["method"] == "OPTIONS":
+        if not headers:
+            return (
+                {
+                    "isBase64Encoded": False,
+                    "statusCode": 200,
+                },
+                None)
+        return (
+            {
+                "isBase64Encoded": False,
+                "statusCode": 200,
+                "headers": headers
+            },
+            None)
+    return None, headers
+
+def lambda_handler(event, context):
+    response, headers = _handle_cors(event)
+    if response is not None:
+        return response
+    page_name = event["pathParameters"]["page_name"]
+    try:
+        revision_number = int(event["pathParameters"]["revision_number"])
+        source = _delta_history.source(page_name, revision_number)
+    except (ValueError, delta_history.RevisionNotFoundException):
+        return {
+            "isBase64Encoded": False,
+            "statusCode": 404,
+            "headers": headers
+        }
+    except Exception:
+        headers["Content-Type"] = "text/plain"
+        return {
+            "isBase64Encoded": False,
+            "statusCode": 500,
+            "headers": headers,
+            "body": "An unexpected error occurred"
+        }
+    headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    headers["Content-Type"] = "text/plain; charset=utf-8"
+    return {
+        "isBase64Encoded": False,
+        "statusCode": 200,
+        "headers": headers,
+        "body": source
+    }
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+import os
+
+import delta_history
+import history_sources
+
+_brotli_variants_root_url = os.environ["BROTLI_VARIANTS_ROOT_URL"]
+
+"""
+Moves the history of the sources of pages, stored as a full copy of the source
+of every revision, into the chunks of reverse deltas of delta_history. Revisions
+which store_edit has already stored in a chunk are kept, and the earlier
+revisions of the chunk are added to it. Every revision of a chunk is checked to
+be reconstructed exactly before the chunk is written. The full copies are only
+deleted if asked for, and only once the chunks containing them are written,
+together with the brotli-encoded variants which store_edit stored of them, under
+BROTLI_VARIANTS_ROOT_URL.
+"""
+
+def _legacy_revisions():
+    revisions = collections.defaultdict(list)
+    paginator = history_sources._s3_client.get_paginator("list_objects_v2")
+    prefix = "{}/".format(history_sources._history_sources_root_url)
+    for list_response in paginator.paginate(
+            Bucket = history_sources._pages_bucket_name,
+            Prefix = prefix):
+        for revision in list_response.get("Contents", []):
+            page_name, revision_number = revision["Key"][len(prefix):].rsplit(
+                "/",
+                1)
+            revisions[page_name].append(
+                (int(revision_number), revision["Size"]))
+    return revisions
+
+def _chunk_sources(page_name, index, legacy_revision_numbers):
+    # The source of every revision which is to be in the chunk, in order, and
+    # the existing chunk with its ETag
+    history = history_sources._delta_history
+    chunk, etag = history.read_chunk(page_name, index)
+    sources = dict()
+    for revision_number in legacy_revision_numbers:
+        if not delta_history.contains(chunk, revision_number):
+            sources[revision_number] = history._legacy_source(
+                page_name,
+                revision_number)
+    if chunk is not None:
+        for revision_number in range(
+                chunk["first_revision"],
+                chunk["last_revision"] + 1):
+            sources[revision_number] = delta_history.revision_source(
+                chunk,
+                revision_number)
+    return sorted(sources.items()), chunk, etag
+
+def _migrate_chunk(page_name, index, legacy_revision_numbers, dry_run):
+    # Returns the size of the chunk, or None if it does not need to be migrated
+    history = history_sources._delta_history
+    sources, existing_chunk, etag = _chunk_sources(
+        page_name,
+        index,
+        legacy_revision_numbers)
+    if (existing_chunk is not None) and \
+            (existing_chunk["first_revision"] <= sources[0][0]):
+        return None
+    chunk = None
+    for revision_number, source in sources:
+        chunk = delta_history.with_revision(chunk, revision_number, source)
+    for revision_number, source in sources:
+        if delta_history.revision_source(chunk, revision_number) != source:
+            raise Exception("Revision {} of {} not reconstructed".format(
+                revision_number,
+                page_name))
+    put_object_request = history._chunk_put_object_request(
+        page_name,
+        index,
+        chunk,
+        etag)
+    if not dry_run:
+        history_sources._s3_client.put_object(
+            Bucket = history_sources._pages_bucket_name,
+            **put_object_request)
+    return len(put_object_request["Body"])
+
+def _delete_legacy(page_name, revision_numbers):
+    keys = []
+    for revision_number in revision_numbers:
+        key = "{}/{}/{}".format(
+            history_sources._history_sources_root_url,
+            page_name,
+            revision_number)
+        keys += [ key, "{}/{}".format(_brotli_variants_root_url, key) ]
+    for start in range(0, len(keys), 1000):
+        history_sources._s3_client.delete_objects(
+            Bucket = history_sources._pages_bucket_name,
+            Delete = {
+                "Objects": [
+                    { "Key": key } for key in keys[start:start + 1000]
+                ],
+                "Quiet": True
+            })
+
+def _migrate(page_name, legacy_revisions, dry_run, delete_legacy):
+    # Returns the total size of the full copies and of the chunks written
+    history = history_sources._delta_history
+    revision_numbers_by_chunk = collections.defaultdict(list)
+    for revision_number, _ in legacy_revisions:
+        revision_numbers_by_chunk[
+            delta_history.chunk_index(revision_number, history.size)].append(
+                revision_number)
+    legacy_size = sum(size for _, size in legacy_revisions)
+    chunks_size = 0
+    for index, revision_numbers in sorted(revision_numbers_by_chunk.items()):
+        chunk_size = _migrate_chunk(
+            page_name,
+            index,
+            sorted(revision_numbers),
+            dry_run)
+        if chunk_size is not None:
+            chunks_size += chunk_size
+    if delete_legacy and not dry_run:
+        _delete_legacy(
+            page_name,
+            sorted(revision_number for revision_number, _ in legacy_revisions))
+    return legacy_size, chunks_size
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description = "Move the history of page sources into delta chunks")
+    argument_parser.add_argument(
+        "--page",
+        action = "append",
+        help = "Only migrate this page (may be given more than once)")
+    argument_parser.add_argument(
+        "--dry-run",
+        action = "store_true",
+        help = "Build and check the chunks, but do not write them")
+    argument_parser.add_argument(
+        "--delete-legacy",
+        action = "store_true",
+        help = "Delete the full copies of the sources once migrated")
+    arguments = argument_parser.parse_args()
+    total_legacy_size = 0
+    total_chunks_size = 0
+    for page_name, legacy_revisions in sorted(_legacy_revisions().items()):
+        if arguments.page and (page_name not in arguments.page):
+            continue
+        try:
+            legacy_size, chunks_size = _migrate(
+                page_name,
+                legacy_revisions,
+                arguments.dry_run,
+                arguments.delete_legacy)
+        except delta_history.NonConsecutiveRevisionException as exception:
+            print("{}: not migrated: {}".format(page_name, exception))
+            continue
+        print("{}: {} revisions, {} bytes as {} bytes".format(
+            page_name,
+            len(legacy_revisions),
+            legacy_size,
+            chunks_size))
+        total_legacy_size += legacy_size
+        total_chunks_size += chunks_size
+    print("{} bytes {} as {} bytes".format(
+        total_legacy_size,
+        "to store" if arguments.dry_run else "stored",
+        total_chunks_size))
+
+if __name__ == "__main__":
+    main()
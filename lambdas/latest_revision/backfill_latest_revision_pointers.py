@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+
+import argparse
+import botocore.exceptions
+
+import latest_revision
+
+"""
+Writes the latest revision pointer (see store_edit) of every page which has a
+history, by listing the whole of the page history once. A pointer which already
+exists is only overwritten if it is behind the history, and only if it has not
+changed since it was read, so that this can safely be run whilst edits are
+being made: a pointer moved on by an edit in between is read again.
+"""
+
+def _latest_revisions_from_history():
+    latest_revisions = dict()
+    paginator = latest_revision._s3_client.get_paginator("list_objects_v2")
+    prefix = "{}/".format(latest_revision._history_pages_root_url)
+    for list_response in paginator.paginate(
+            Bucket = latest_revision._pages_bucket_name,
+            Prefix = prefix):
+        for revision in list_response.get("Contents", []):
+            page_name, revision_number = revision["Key"][len(prefix):].rsplit(
+                "/",
+                1)
+            latest_revisions[page_name] = max(
+                int(revision_number),
+                latest_revisions.get(page_name, 0))
+    return latest_revisions
+
+def _pointer_key(page_name):
+    return "{}/{}".format(
+        latest_revision._latest_revision_pointers_root_url,
+        page_name)
+
+def _pointer(page_name):
+    # The revision number of the pointer and its ETag, or None twice if there
+    # is no pointer
+    try:
+        response = latest_revision._s3_client.get_object(
+            Bucket = latest_revision._pages_bucket_name,
+            Key = _pointer_key(page_name))
+    except latest_revision._s3_client.exceptions.NoSuchKey:
+        return None, None
+    return int(response["Body"].read().decode("utf-8")), response["ETag"]
+
+def _put_pointer(page_name, revision_number, etag):
+    # Returns whether the pointer was written, which it is not if it has been
+    # written or created since it was read
+    if etag is None:
+        condition = { "IfNoneMatch": "*" }
+    else:
+        condition = { "IfMatch": etag }
+    try:
+        latest_revision._s3_client.put_object(
+            Body = str(revision_number).encode("utf-8"),
+            Bucket = latest_revision._pages_bucket_name,
+            ContentType = "text/plain",
+            Key = _pointer_key(page_name),
+            **condition)
+    except botocore.exceptions.ClientError as exception:
+        if exception.response["Error"]["Code"] in [
+                "ConditionalRequestConflict",
+                "PreconditionFailed" ]:
+            return False
+        raise exception
+    return True
+
+def _backfill(page_name, latest_revision_number, dry_run):
+    while True:
+        existing, etag = _pointer(page_name)
+        if (existing is not None) and (existing >= latest_revision_number):
+            return False
+        if dry_run or _put_pointer(page_name, latest_revision_number, etag):
+            return True
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description = "Backfill the latest revision pointer of every page")
+    argument_parser.add_argument(
+        "--dry-run",
+        action = "store_true",
+        help = "Only print the pointers which would be written")
+    arguments = argument_parser.parse_args()
+    written = 0
+    for page_name, latest_revision_number in sorted(
+            _latest_revisions_from_history().items()):
+        if _backfill(page_name, latest_revision_number, arguments.dry_run):
+            print("{}: {}".format(page_name, latest_revision_number))
+            written += 1
+    print("{} pointers {}".format(
+        written,
+        "to write" if arguments.dry_run else "written"))
+
+if __name__ == "__main__":
+    main()
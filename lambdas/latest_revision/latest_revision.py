@@ -5,15 +5,27 @@ import os
 _s3_client = boto3.client("s3")
 
 _history_pages_root_url = os.environ["HISTORY_PAGES_ROOT_URL"]
+_latest_revision_pointers_root_url = os.environ[
+    "LATEST_REVISION_POINTERS_ROOT_URL"]
 _pages_bucket_name = os.environ["PAGES_BUCKET_NAME"]
 
 class NoHistoryException(Exception):
     pass
 
-def latest_revision(page_name):
+def _latest_revision_from_pointer(page_name):
+    try:
+        return int(_s3_client.get_object(
+            Bucket = _pages_bucket_name,
+            Key = "{}/{}".format(
+                _latest_revision_pointers_root_url,
+                page_name))["Body"].read().decode("utf-8"))
+    except _s3_client.exceptions.NoSuchKey:
+        return None
+
+def _latest_revision_from_history(page_name):
     list_response = _s3_client.list_objects_v2(
         Bucket = _pages_bucket_name,
-        Prefix = "{}/{}".format(
+        Prefix = "{}/{}/".format(
             _history_pages_root_url,
             page_name))
     latest_revision_number = 0
@@ -30,11 +42,20 @@ def latest_revision(page_name):
             return latest_revision_number
         list_response = _s3_client.list_objects_v2(
             Bucket = _pages_bucket_name,
-            Prefix = "{}/{}".format(
+            Prefix = "{}/{}/".format(
                 _history_pages_root_url,
                 page_name),
             ContinuationToken = list_response["NextContinuationToken"])
 
+def latest_revision(page_name):
+    # store_edit maintains a pointer to the latest revision of each page. Pages
+    # which have not been edited since this was introduced, and for which the
+    # pointer has not been backfilled, fall back to listing their history
+    latest_revision_number = _latest_revision_from_pointer(page_name)
+    if latest_revision_number is None:
+        return _latest_revision_from_history(page_name)
+    return latest_revision_number
+
 def _handle_cors(event):
     headers = dict()
     try:
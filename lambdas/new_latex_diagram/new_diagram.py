@@ -1,7 +1,10 @@
 import boto3
+import botocore.exceptions
 import datetime
+import hashlib
 import json
 import os
+import re
 import requests
 
 _s3_client = boto3.client("s3")
@@ -13,9 +16,15 @@ _diagrams_history_metadata_root_url = os.environ[
     "DIAGRAMS_HISTORY_METADATA_ROOT_URL"]
 _diagrams_history_sources_root_url = os.environ[
     "DIAGRAMS_HISTORY_SOURCES_ROOT_URL"]
+_diagrams_index_root_url = os.environ["DIAGRAMS_INDEX_ROOT_URL"]
+_diagrams_previews_root_url = os.environ["DIAGRAMS_PREVIEWS_ROOT_URL"]
 _diagrams_root_url = os.environ["DIAGRAMS_ROOT_URL"]
 _pages_bucket_name = os.environ["PAGES_BUCKET_NAME"]
 
+_horizontal_whitespace_regex = re.compile(r"[ \t\f\v]+")
+_blank_lines_regex = re.compile(r"\n{3,}")
+_immutable_cache_control = "public, max-age=31536000, immutable"
+
 class FailedToRenderDiagramException(Exception):
     def __init__(self, status_code, message):
         super().__init__(message)
@@ -24,6 +33,91 @@ class FailedToRenderDiagramException(Exception):
 def _diagram_id():
     return datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
 
+def _normalised_source(source):
+    # Whitespace within or at the ends of a line makes no difference to how a
+    # diagram is rendered. Blank lines can (they are paragraph breaks), so
+    # these are kept, though a run of them is treated as a single one
+    lines = [
+        _horizontal_whitespace_regex.sub(" ", line).strip()
+        for line in source.strip().splitlines()
+    ]
+    return _blank_lines_regex.sub("\n\n", "\n".join(lines))
+
+def _diagram_hash(diagram_type, source):
+    return hashlib.sha256("{}\n{}".format(
+        diagram_type,
+        _normalised_source(source)).encode("utf-8")).hexdigest()
+
+def _indexed_diagram_id(diagram_hash):
+    try:
+        return _s3_client.get_object(
+            Bucket = _pages_bucket_name,
+            Key = "{}/{}".format(
+                _diagrams_index_root_url,
+                diagram_hash))["Body"].read().decode("utf-8")
+    except _s3_client.exceptions.NoSuchKey:
+        return None
+
+def _store_in_index(diagram_hash, diagram_id):
+    _s3_client.put_object(
+        Body = diagram_id.encode("utf-8"),
+        Bucket = _pages_bucket_name,
+        ContentType = "text/plain",
+        Key = "{}/{}".format(
+            _diagrams_index_root_url,
+            diagram_hash))
+
+def _preview_diagram(diagram_hash):
+    try:
+        return _s3_client.get_object(
+            Bucket = _pages_bucket_name,
+            Key = "{}/{}".format(
+                _diagrams_previews_root_url,
+                diagram_hash))["Body"].read().decode("utf-8")
+    except _s3_client.exceptions.NoSuchKey:
+        return None
+
+def _is_preview_diagram(diagram_hash):
+    # Only the existence of the preview is checked, without downloading it
+    try:
+        _s3_client.head_object(
+            Bucket = _pages_bucket_name,
+            Key = "{}/{}".format(
+                _diagrams_previews_root_url,
+                diagram_hash))
+        return True
+    except botocore.exceptions.ClientError as exception:
+        if exception.response["Error"]["Code"] in [ "404", "NotFound" ]:
+            return False
+        raise exception
+
+def _store_as_preview(diagram_hash, rendered_diagram):
+    _s3_client.put_object(
+        ACL = "public-read",
+        Body = rendered_diagram.encode("utf-8"),
+        Bucket = _pages_bucket_name,
+        ContentType = "image/svg+xml",
+        Key = "{}/{}".format(_diagrams_previews_root_url, diagram_hash))
+
+def _render_diagram_for_preview(metadata_and_source, diagram_hash):
+    # Diagrams rendered for a preview are not stored permanently, since most of
+    # them are never submitted. Each is instead stored once under its hash, in a
+    # scratch area whose objects are expired by an S3 lifecycle rule after a
+    # day or so. A preview of the same diagram, or its submission, reuses the
+    # rendering from there whilst it lasts. A diagram which has already been
+    # stored permanently is used as it is
+    diagram_id = _indexed_diagram_id(diagram_hash)
+    if diagram_id is not None:
+        return { "diagram_id": diagram_id }
+    if not _is_preview_diagram(diagram_hash):
+        _store_as_preview(
+            diagram_hash,
+            _render_diagram({
+                "type": metadata_and_source["type"],
+                "source": metadata_and_source["source"]
+            }))
+    return { "preview_id": diagram_hash }
+
 def _edit_time():
     return datetime.datetime.utcnow().strftime("%B %d, %Y at %H:%M:%S (UTC)")
 
@@ -38,16 +132,20 @@ def _render_diagram(request_body):
     return response.text
 
 def _store_current(diagram_id, rendered_diagram, source):
+    # Diagrams are immutable, so are never invalidated, and can be cached for as
+    # long as anybody likes
     _s3_client.put_object(
         ACL = "public-read",
         Body = rendered_diagram.encode("utf-8"),
         Bucket = _pages_bucket_name,
+        CacheControl = _immutable_cache_control,
         ContentType = "image/svg+xml",
         Key = "{}/{}".format(_diagrams_root_url, diagram_id))
     _s3_client.put_object(
         ACL = "public-read",
         Body = source.encode("utf-8"),
         Bucket = _pages_bucket_name,
+        CacheControl = _immutable_cache_control,
         ContentType = "text/plain",
         Key = "{}/{}".format(_diagrams_sources_root_url, diagram_id))
     return diagram_id
@@ -85,7 +183,7 @@ def _store_in_history(diagram_id, rendered_diagram, metadata_and_source):
             _diagrams_history_metadata_root_url,
             diagram_id))
 
-def _store(rendered_diagram, metadata_and_source):
+def _store(rendered_diagram, metadata_and_source, diagram_hash):
     diagram_id = _diagram_id()
     try:
         _store_current(
@@ -93,6 +191,7 @@ def _store(rendered_diagram, metadata_and_source):
             rendered_diagram,
             metadata_and_source["source"])
         _store_in_history(diagram_id, rendered_diagram, metadata_and_source)
+        _store_in_index(diagram_hash, diagram_id)
         return diagram_id
     except Exception as exception:
         try:
@@ -134,11 +233,34 @@ def _remove_as_current(diagram_id):
 def _render_and_store_diagram(headers, metadata_and_source):
     source = metadata_and_source["source"]
     try:
-        rendered_diagram = _render_diagram({
-            "type": metadata_and_source["type"],
-            "source": source
-        })
-        diagram_id = _store(rendered_diagram, metadata_and_source)
+        # Diagrams are immutable, so a diagram whose source is the same as
+        # that of one which already exists (up to whitespace) is not rendered
+        # or stored again: the existing one is used
+        diagram_hash = _diagram_hash(metadata_and_source["type"], source)
+        if metadata_and_source["preview"]:
+            headers["Content-Type"] = "application/json"
+            return {
+                "isBase64Encoded": False,
+                "statusCode": 200,
+                "headers": headers,
+                "body": json.dumps(_render_diagram_for_preview(
+                    metadata_and_source,
+                    diagram_hash))
+            }
+        diagram_id = _indexed_diagram_id(diagram_hash)
+        if diagram_id is None:
+            # A diagram which was previewed before being submitted does not
+            # need to be rendered again
+            rendered_diagram = _preview_diagram(diagram_hash)
+            if rendered_diagram is None:
+                rendered_diagram = _render_diagram({
+                    "type": metadata_and_source["type"],
+                    "source": source
+                })
+            diagram_id = _store(
+                rendered_diagram,
+                metadata_and_source,
+                diagram_hash)
         headers["Content-Type"] = "text/plain"
         return {
             "isBase64Encoded": False,
@@ -183,7 +305,8 @@ def _extract_metadata_and_source(event, headers):
                 "type": event_body["type"],
                 "source": event_body["source"],
                 "author": event_body["author"],
-                "ip_address": event["requestContext"]["http"]["sourceIp"]
+                "ip_address": event["requestContext"]["http"]["sourceIp"],
+                "preview": event_body.get("preview", False) is True
             }
         )
     except KeyError as exception:
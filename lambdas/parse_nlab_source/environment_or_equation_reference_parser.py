@@ -2,6 +2,8 @@ import re
 
 import mistletoe.span_token
 
+import nlab_span_scanner
+
 """
 Matches \ref{...} and converts to a link with no text whose href points to
 # + the string inside the {...}. The text of the link (numbering of the
@@ -10,6 +12,24 @@ relevant environment or equation) will be added client-side.
 class EnvironmentOrEquationReferenceToken(mistletoe.span_token.SpanToken):
     pattern = re.compile(r"\\ref\{(.*?)\}")
 
+    @staticmethod
+    def _can_match(string):
+        closings = nlab_span_scanner.Occurrences(string, "}")
+        newlines = nlab_span_scanner.Occurrences(string, "\n")
+        def can_match(start):
+            closing = closings.at_or_after(start + 5)
+            newline = newlines.at_or_after(start + 5)
+            return (closing != -1) and ((newline == -1) or (newline > closing))
+        return can_match
+
+    @classmethod
+    def find(cls, string):
+        return nlab_span_scanner.matches(
+            cls.pattern,
+            string,
+            [ "\\ref{" ],
+            cls._can_match)
+
     def __init__(self, match):
         self.reference = match.group(1).strip()
 
@@ -27,6 +47,22 @@ relevant equation) will be added client-side.
 """
 class EquationReferenceToken(mistletoe.span_token.SpanToken):
     pattern = re.compile(r"eq:(.*?)([\s|)])")
+    _ending_regex = re.compile(r"[\s|)]")
+
+    @classmethod
+    def _can_match(cls, string):
+        # A newline is itself an ending, so the first ending after eq: is
+        # always reached
+        endings = nlab_span_scanner.Occurrences(string, cls._ending_regex)
+        return lambda start: endings.at_or_after(start + 3) != -1
+
+    @classmethod
+    def find(cls, string):
+        return nlab_span_scanner.matches(
+            cls.pattern,
+            string,
+            [ "eq:" ],
+            cls._can_match)
 
     def __init__(self, match):
         self.reference = match.group(1).strip()
@@ -2,6 +2,7 @@ import enum
 import json
 import os
 import requests
+import time
 import urllib.parse
 
 import nlab_mistletoe
@@ -9,6 +10,13 @@ import nlab_parsing_errors
 
 _root_url = os.environ["ROOT_URL"]
 _file_root_url = os.environ["FILE_ROOT_URL"]
+_file_manifest_url = os.environ.get("FILE_MANIFEST_URL")
+
+# Seconds for which a fetched file manifest is used before it is fetched again
+_file_manifest_ttl = 300
+
+_file_manifest = None
+_file_manifest_fetched_at = None
 
 class SizeUnit(enum.Enum):
     PIXELS = "px"
@@ -37,6 +45,42 @@ def _check_exists(file_name):
     if response.status_code != 200:
         raise _ImageFileDoesNotExistException()
 
+def _current_file_manifest():
+    # The manifest maintained by update_file_manifest, fetched at most once
+    # every _file_manifest_ttl seconds. If it cannot be fetched, the one fetched
+    # before is kept, or None if there is none
+    global _file_manifest, _file_manifest_fetched_at
+    if _file_manifest_url is None:
+        return None
+    now = time.monotonic()
+    if (_file_manifest_fetched_at is not None) and \
+            (now - _file_manifest_fetched_at < _file_manifest_ttl):
+        return _file_manifest
+    # Also when the fetch fails, so that it is not tried again for every block
+    _file_manifest_fetched_at = now
+    try:
+        response = requests.get(
+            os.path.join(_root_url, _file_manifest_url.lstrip("/")),
+            timeout = 5)
+        if response.status_code == 200:
+            _file_manifest = response.json()
+        else:
+            print("Failed to fetch file manifest: status {}".format(
+                response.status_code))
+    except (requests.RequestException, ValueError) as exception:
+        print("Failed to fetch file manifest: {}".format(exception))
+    return _file_manifest
+
+def _file_information(file_name):
+    # The size, content type, and intrinsic width and height if known, of the
+    # file. A file which is not in the manifest may have been uploaded since it
+    # was fetched, so is checked by a request to the site instead
+    file_manifest = _current_file_manifest()
+    if (file_manifest is not None) and (file_name in file_manifest):
+        return file_manifest[file_name]
+    _check_exists(file_name)
+    return dict()
+
 def _margin(margin_json):
     if not isinstance(margin_json, dict):
         raise _InvalidMarginJsonException(
@@ -90,18 +134,18 @@ def _margin(margin_json):
         left,
         unit.value)
 
-def _parse_file_name(image_from_file_block):
+def _parse_file(image_from_file_block):
     try:
         file_name = image_from_file_block["file_name"]
     except KeyError:
         raise ImageFromFileException(
             "No key 'file_name'")
     try:
-        _check_exists(file_name)
+        file_information = _file_information(file_name)
     except _ImageFileDoesNotExistException:
         raise ImageFromFileException(
             "No image with name {}".format(file_name))
-    return file_name
+    return file_name, file_information
 
 def _parse_width(image_from_file_block):
     try:
@@ -177,11 +221,14 @@ def _parse(image_from_file_block):
         unit = _parse_unit(image_from_file_block)
     else:
         unit = None
+    file_name, file_information = _parse_file(image_from_file_block)
     return {
-        "file_name": _parse_file_name(image_from_file_block),
+        "file_name": file_name,
         "width": width,
         "height": height,
         "unit": unit,
+        "intrinsic_width": file_information.get("width"),
+        "intrinsic_height": file_information.get("height"),
         "alt": _parse_alt(image_from_file_block),
         "float_type": _parse_float_type(image_from_file_block),
         "margin": _parse_margin(image_from_file_block),
@@ -204,9 +251,16 @@ def _create_img_tag(parameters):
            image_html,
            height,
            parameters["unit"].value)
+    if (not width) and (not height) and parameters["intrinsic_width"] and \
+            parameters["intrinsic_height"]:
+        # So that the browser can lay out the page before the image is loaded
+        image_html = "{} width=\"{}\" height=\"{}\"".format(
+            image_html,
+            parameters["intrinsic_width"],
+            parameters["intrinsic_height"])
     alt = parameters["alt"]
     if alt:
-       image_html = "{} alt=\"{}\"".format(alt)
+       image_html = "{} alt=\"{}\"".format(image_html, alt)
     return image_html + "/>"
 
 def _create_figure(parameters):
@@ -248,6 +302,7 @@ def _create_figure(parameters):
         return "<div style=\"margin: {}\">\n{}\n</div>".format(
             margin,
             figure)
+    return figure
 
 def render(image_from_file_block):
     image_from_file_block = image_from_file_block.strip()
@@ -2,6 +2,8 @@ import re
 
 import mistletoe.span_token
 
+import nlab_span_scanner
+
 """
 Matches anything within [[!include and ]] and converts it to a div whose
 content will be (using javascript) the rendered HTML of the page whose name is
@@ -9,6 +11,28 @@ equal to the match.
 """
 class IncludeToken(mistletoe.span_token.SpanToken):
     pattern = re.compile(r"\[\[\s*!include(.*?)\]\]")
+    _opening_regex = re.compile(r"\[\[\s*!include")
+
+    @classmethod
+    def _can_match(cls, string):
+        closings = nlab_span_scanner.Occurrences(string, "]]")
+        newlines = nlab_span_scanner.Occurrences(string, "\n")
+        def can_match(start):
+            opening = cls._opening_regex.match(string, start)
+            if opening is None:
+                return False
+            closing = closings.at_or_after(opening.end())
+            newline = newlines.at_or_after(opening.end())
+            return (closing != -1) and ((newline == -1) or (newline > closing))
+        return can_match
+
+    @classmethod
+    def find(cls, string):
+        return nlab_span_scanner.matches(
+            cls.pattern,
+            string,
+            [ "[[" ],
+            cls._can_match)
 
     def __init__(self, match):
         self.page_to_include = match.group(1).strip()
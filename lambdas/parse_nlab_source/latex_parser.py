@@ -1,8 +1,11 @@
+import html
+import json
 import re
 
 import mistletoe.span_token
 
 import nlab_parsing_errors
+import nlab_span_scanner
 
 def render_latex(latex, display):
     label = None
@@ -23,6 +26,77 @@ def render_latex(latex, display):
             "<span class=\"latex\" data-latex=\"{}\" ".format(latex) +
             "data-display-mode=\"block\"></span>\n")
 
+# Matches the opening tag of each of the spans created by render_latex, which
+# are always empty, and which are given the number of the equation if the page
+# is numbered when it is parsed
+_latex_span_regex = re.compile(
+    r"<span class=\"latex\" data-latex=\"([^\"]*)\"" +
+    r"( data-display-mode=(?:\"block\"|'block'))?(?: id='[^']*')?" +
+    r"(?: data-equation-number=\"([0-9]+)\")?[^>]*>(?=</span>)")
+
+"""
+Builds the rendered HTML of a page, written to it a piece at a time, as a
+document for render_latex in which the formulas have already been found: a list
+of HTML fragments, and a list of formulas, each of which is to be rendered
+between the fragment of the same index and the next one, that is, within its
+empty span. The HTML is therefore not parsed again to find the formulas. A span
+must be written within a single piece, as it is by Renderer.render_to, which
+writes each block whole
+"""
+class StructuredDocumentWriter:
+    def __init__(self):
+        self.fragments = []
+        self.formulas = []
+        self.pending = []
+
+    def _hold(self, fragment_or_formula):
+        # How each fragment and formula is held once it is complete
+        return fragment_or_formula
+
+    def write(self, html_source):
+        previous_end = 0
+        for match in _latex_span_regex.finditer(html_source):
+            self.pending.append(html_source[previous_end:match.end()])
+            self.fragments.append(self._hold("".join(self.pending)))
+            self.pending.clear()
+            self.formulas.append(self._hold({
+                "latex": html.unescape(match.group(1)),
+                "display_mode": match.group(2) is not None,
+                "equation_number": match.group(3)
+            }))
+            previous_end = match.end()
+        self.pending.append(html_source[previous_end:])
+
+    def document(self):
+        return {
+            "fragments": self.fragments + [ self._hold("".join(self.pending)) ],
+            "formulas": self.formulas
+        }
+
+"""
+As StructuredDocumentWriter, but each fragment and formula is encoded as JSON as
+soon as it is complete, and document returns the document as JSON, exactly as
+json.dumps would, so that the document is not held both as objects and as JSON
+"""
+class StructuredDocumentJsonWriter(StructuredDocumentWriter):
+    def _hold(self, fragment_or_formula):
+        return json.dumps(fragment_or_formula)
+
+    def document(self):
+        # Joined once, rather than each list and then the whole
+        document = super().document()
+        parts = []
+        for key in [ "fragments", "formulas" ]:
+            parts.append("{}{}: [".format(
+                ", " if parts else "{",
+                json.dumps(key)))
+            for index, value in enumerate(document[key]):
+                if index > 0:
+                    parts.append(", ")
+                parts.append(value)
+            parts.append("]")
+        parts.append("}")
+        return "".join(parts)
 
 """
 Matches anything within $ and $, not beginning with $$, and prepares it for
@@ -50,6 +124,24 @@ processing with katex
 class StandAloneLatexToken(mistletoe.span_token.SpanToken):
     pattern = re.compile(r"(\$\$(.*?)\$\$)|(\\\[(.*?)\\\])", re.DOTALL)
 
+    @staticmethod
+    def _can_match(string):
+        closing_dollars = nlab_span_scanner.Occurrences(string, "$$")
+        closing_brackets = nlab_span_scanner.Occurrences(string, "\\]")
+        def can_match(start):
+            if string.startswith("$$", start):
+                return closing_dollars.at_or_after(start + 2) != -1
+            return closing_brackets.at_or_after(start + 2) != -1
+        return can_match
+
+    @classmethod
+    def find(cls, string):
+        return nlab_span_scanner.matches(
+            cls.pattern,
+            string,
+            [ "$$", "\\[" ],
+            cls._can_match)
+
     def __init__(self, match):
         if match.group(2) is not None:
             self.latex = match.group(2)
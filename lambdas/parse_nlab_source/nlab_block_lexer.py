@@ -0,0 +1,288 @@
+import re
+
+from nlab_parsing_errors import NLabSyntaxError, NotYetSupportedError
+
+"""
+Splits the source of a page into its top-level blocks, in a single pass over its
+lines: headings, the table of contents, context menus, LaTeX blocks, theorem
+environments, centre and imagefromfile blocks, and paragraphs and other
+markdown, which are rendered by Mistletoe. Blank lines between blocks are
+dropped.
+
+A line which is not within a block is dispatched on its first character, to the
+few kinds of block which can begin with it, rather than being checked against
+every kind of block in turn. Every pattern is compiled once, when the module is
+loaded.
+"""
+
+_page_anchor_regex = re.compile(r"\{#(.*?)\}")
+_heading_regex = re.compile(r"^([#]+)(.*?)($|#)")
+_context_menu_regex = re.compile(r"\\context_menu\[(.*?)\]")
+
+"""
+A block of the source of a page. The lines are those of the source of the
+block, including the blank line which ends a markdown block. The argument
+depends upon the kind of block: the text of a heading, the contexts of a context
+menu, or the name of a theorem environment.
+"""
+class Block:
+    def __init__(self, kind, lines, argument = None):
+        self.kind = kind
+        self.lines = lines
+        self.argument = argument
+
+def _preprocessed(line):
+    # Old-syntax page anchors, and line breaks
+    if "{#" in line:
+        line = _page_anchor_regex.sub(
+            "<span id=\"" + r"\g<1>" + "\"></span>",
+            line)
+    if "\\linebreak" in line:
+        line = line.replace("\\linebreak", "<br>")
+    return line
+
+def _lines(source):
+    # The lines of the source, one at a time, so that no copy of the whole
+    # source is made
+    start = 0
+    end = source.find("\n")
+    while end != -1:
+        yield _preprocessed(source[start:end])
+        start = end + 1
+        end = source.find("\n", start)
+    yield _preprocessed(source[start:])
+
+class BlockLexer:
+    def __init__(
+            self,
+            theorem_environment_parser,
+            require_blank_lines_after = True):
+        self.theorem_environment_parser = theorem_environment_parser
+        self.require_blank_lines_after = require_blank_lines_after
+        self.mode = ""
+        self.argument = None
+        self.lines = []
+        self.beginning_or_follows_blank = True
+        self.is_start_line = False
+
+    def _begin(self, mode, argument = None):
+        self.beginning_or_follows_blank = False
+        self.mode = mode
+        self.argument = argument
+
+    def _heading(self, line):
+        self.beginning_or_follows_blank = False
+        # Some versions of markdown allow the heading text to come immediately
+        # after the ###s without any spaces, but Mistletoe does not. Thus we
+        # ensure that there is a space.
+        match = _heading_regex.search(line)
+        if len(match.group(1)) == 1:
+            raise NLabSyntaxError(
+                "Use of # (i.e. <h1>) is not permitted. Use ## for " +
+                "top-level sections.")
+        return Block(
+            "heading",
+            [ line ],
+            match.group(1) + " " + match.group(2))
+
+    def _latex_double_dollar(self, line):
+        self._begin("latex_double_dollar")
+        self.is_start_line = True
+
+    def _latex_square_bracket(self, line):
+        self._begin("latex_square_bracket")
+
+    def _redirects(self, line):
+        raise NLabSyntaxError("Redirects no longer handled in source editing")
+
+    def _table_of_contents(self, line):
+        self.beginning_or_follows_blank = False
+        return Block("table_of_contents", [ line ])
+
+    def _old_table_of_contents(self, line):
+        raise NLabSyntaxError(
+            "Old syntax for table of contents no longer supported. " +
+            "Use a line\n\n{}\n\ninstead.".format("\\tableofcontents"))
+
+    def _category(self, line):
+        raise NLabSyntaxError(
+            "Page categories no longer handled in source editing")
+
+    def _old_context_menu(self, line):
+        raise NLabSyntaxError(
+            "Old syntax for context menus no longer supported. Use\n\n" +
+            "{}\n\ninstead, replacing ... by the name of the ".format(
+                "\\context_menu[...]") +
+            "context menu.")
+
+    def _context_menu(self, line):
+        return Block(
+            "context_menu",
+            [ line ],
+            _context_menu_regex.search(line).group(1))
+
+    def _centre(self, line):
+        self._begin("centre")
+
+    def _center(self, line):
+        self._begin("center")
+
+    def _image_from_file(self, line):
+        self._begin("imagefromfile")
+
+    def _start(self, line):
+        # Called for a line which is not within a block. Returns the block if
+        # the line is a block of its own, and otherwise begins the block which
+        # the line starts, if any
+        line = line.lstrip()
+        first_character = line[:1]
+        for prefix, start in _line_starts.get(first_character, []):
+            if line.startswith(prefix):
+                return start(self, line)
+        if "<nowiki>" in line:
+            raise NotYetSupportedError(
+                "<nowiki>...</nowiki> not supported yet")
+        for prefix, start in _environment_starts.get(first_character, []):
+            if line.startswith(prefix):
+                return start(self, line)
+        theorem_environment = self.theorem_environment_parser.match_new(line)
+        if theorem_environment is not None:
+            self._begin("theorem_environment_new", theorem_environment)
+            return None
+        if self.theorem_environment_parser.match_old(line) is not None:
+            raise NLabSyntaxError(
+                "Old syntax for theorem environments no longer supported. " +
+                "Use \\begin{theorem} ... \\end{theorem} or similar instead")
+        if not line:
+            self.beginning_or_follows_blank = True
+        elif (not self.beginning_or_follows_blank) and \
+                self.require_blank_lines_after:
+            raise NLabSyntaxError(
+                "Line should be blank as it follows a markdown environment: " +
+                line)
+        else:
+            self.mode = "mistletoe"
+        return None
+
+    def _ends_mistletoe(self, line):
+        return not line.strip()
+
+    def _ends_theorem_environment_new(self, line):
+        return ("\\end{" + self.argument) in line
+
+    def _ends_latex_double_dollar(self, line):
+        if self.is_start_line:
+            self.is_start_line = False
+            double_dollar_parts = line.split("$$")
+            if ((len(double_dollar_parts) > 3) or (
+                    (len(double_dollar_parts) == 3) and \
+                    double_dollar_parts[2].strip())):
+                raise NLabSyntaxError(
+                    "Closing $$ of a stand-alone LaTeX block should not " +
+                    "have anything after it on the same line. Line: " +
+                    line)
+            return not ((len(double_dollar_parts) == 1) or (
+                (len(double_dollar_parts) == 2) and not \
+                double_dollar_parts[1].strip()))
+        if "$$" not in line:
+            return False
+        if line.split("$$")[1].rstrip():
+            raise NLabSyntaxError(
+                "Closing $$ of a stand-alone LaTeX block should not have " +
+                "anything after it on the same line. Line: " +
+                line)
+        return True
+
+    def _ends_latex_square_bracket(self, line):
+        if "\\]" not in line:
+            return False
+        if line.split("\\]")[1].rstrip():
+            raise NLabSyntaxError(
+                "Closing \\]\\] of a stand-alone LaTeX block should not " +
+                "have anything after it on the same line. Line: " +
+                line)
+        return True
+
+    def _ends_environment(self, line, end):
+        if end not in line:
+            return False
+        if line.split(end)[1].rstrip():
+            raise NLabSyntaxError(
+                "{} should not have anything after it on the same ".format(
+                    end) +
+                "line. Line: {}".format(line))
+        return True
+
+    def _ends_centre(self, line):
+        return self._ends_environment(line, "\\end{centre}")
+
+    def _ends_center(self, line):
+        return self._ends_environment(line, "\\end{center}")
+
+    def _ends_image_from_file(self, line):
+        return self._ends_environment(line, "\\end{imagefromfile}")
+
+    _ends = {
+        "mistletoe": _ends_mistletoe,
+        "theorem_environment_new": _ends_theorem_environment_new,
+        "latex_double_dollar": _ends_latex_double_dollar,
+        "latex_square_bracket": _ends_latex_square_bracket,
+        "centre": _ends_centre,
+        "center": _ends_center,
+        "imagefromfile": _ends_image_from_file
+    }
+
+    def _end(self):
+        block = Block(self.mode, self.lines, self.argument)
+        self.mode = ""
+        self.argument = None
+        self.lines = []
+        return block
+
+    def blocks(self, source):
+        for line in _lines(source):
+            if not self.mode:
+                block = self._start(line)
+                if block is not None:
+                    yield block
+                if not self.mode:
+                    continue
+            self.lines.append(line)
+            if self._ends[self.mode](self, line):
+                yield self._end()
+        if self.mode == "mistletoe":
+            yield self._end()
+        elif self.mode:
+            raise NLabSyntaxError(
+                "The following belongs to an environment of type " +
+                self.mode +
+                " that was not closed: " +
+                "\n".join(self.lines))
+
+def _dispatch_table(starts):
+    # The starts of each kind of block, in the order in which they are to be
+    # checked, by the first character of the line which begins the block
+    dispatch_table = dict()
+    for prefix, start in starts:
+        dispatch_table.setdefault(prefix[0], []).append((prefix, start))
+    return dispatch_table
+
+# A line containing <nowiki> is an error unless it begins one of these kinds of
+# block
+_line_starts = _dispatch_table([
+    ("#", BlockLexer._heading),
+    ("$$", BlockLexer._latex_double_dollar),
+    ("\\[", BlockLexer._latex_square_bracket),
+    ("[[!redirects", BlockLexer._redirects),
+    ("\\tableofcontents", BlockLexer._table_of_contents),
+    ("* table of contents", BlockLexer._old_table_of_contents),
+    ("category:", BlockLexer._category)
+])
+
+_environment_starts = _dispatch_table([
+    ("+-- {: .rightHandSide}", BlockLexer._old_context_menu),
+    ("\\context_menu", BlockLexer._context_menu),
+    ("\\begin{centre}", BlockLexer._centre),
+    ("\\begin{center}", BlockLexer._center),
+    ("\\begin{imagefromfile}", BlockLexer._image_from_file)
+])
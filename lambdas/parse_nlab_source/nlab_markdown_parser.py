@@ -1,11 +1,17 @@
 #!/usr/bin/python3
 
+import collections
+import hashlib
 import json
 import re
+import tempfile
+import threading
 
 import image_from_file_parser
 import latex_parser
+import nlab_block_lexer
 import nlab_mistletoe
+import nlab_page_numbering
 from nlab_parsing_errors import NLabSyntaxError, NotYetSupportedError
 
 _centre_regex = re.compile(r"\\begin{centre}(.*?)\\end{centre}", re.DOTALL)
@@ -13,257 +19,240 @@ _center_regex = re.compile(r"\\begin{center}(.*?)\\end{center}", re.DOTALL)
 _image_from_file_regex = re.compile(
     r"\\begin{imagefromfile}(.*?)\\end{imagefromfile}",
     re.DOTALL)
+_label_regex = re.compile(r"\\label\{(.*?)\}")
+
+# The rendered content of a page is spooled to a file in /tmp once it is larger
+# than this, whilst the page is streamed
+_spool_size = 1024 * 1024
+
+_block_cache_size = 4096
+_block_cache = collections.OrderedDict()
+_block_cache_lock = threading.Lock()
+_block_cache_hits = 0
+_block_cache_misses = 0
+
+def _render_block(block_type, block, render):
+    # Every top-level block (a paragraph, a heading, a LaTeX block, a theorem
+    # environment, etc) is rendered independently of the rest of the page, so
+    # its rendering can be reused whenever a block of the same type with
+    # exactly the same source is met again, as is typical when a page is edited
+    # and then previewed or submitted. A block whose rendering raises an error
+    # is not cached. Nor is an imagefromfile block, or a block containing one,
+    # the rendering of which depends on whether the file exists and on its
+    # size, which may change without the source of the block changing
+    global _block_cache_hits, _block_cache_misses
+    if (block_type == "imagefromfile") or ("\\begin{imagefromfile}" in block):
+        return render()
+    key = hashlib.sha256(
+        "{}\n{}".format(block_type, block).encode("utf-8")).digest()
+    with _block_cache_lock:
+        rendered_block = _block_cache.get(key)
+        if rendered_block is not None:
+            _block_cache.move_to_end(key)
+            _block_cache_hits += 1
+            return rendered_block
+        _block_cache_misses += 1
+    rendered_block = render()
+    with _block_cache_lock:
+        _block_cache[key] = rendered_block
+        _block_cache.move_to_end(key)
+        while len(_block_cache) > _block_cache_size:
+            _block_cache.popitem(last = False)
+    return rendered_block
+
+def block_cache_statistics():
+    with _block_cache_lock:
+        return {
+            "hits": _block_cache_hits,
+            "misses": _block_cache_misses,
+            "size": len(_block_cache)
+        }
 
 class Renderer:
     def __init__(self, top_level = True):
-        self.mode = ""
-        self.theorem_environment = None
-        self.to_parse = []
-        self.beginning_or_follows_blank = True
         self.parsed = []
-        self.is_start_line = False
         self.preamble = []
         self.top_level = top_level
+        self.numbering = None
+        self.table_of_contents_index = None
 
-    def _no_mode(self, line, require_blank_lines_after):
-        line = line.lstrip()
-        if line.startswith("#"):
-            self.beginning_or_follows_blank = False
-            # Some versions of markdown allow the heading text to come
-            # immediately after the ###s without any spaces, but Mistletoe does
-            # not. Thus we ensure that there is a space.
-            match = re.compile(r"^([#]+)(.*?)($|#)").search(line)
-            if len(match.group(1)) == 1:
-                raise NLabSyntaxError(
-                    "Use of # (i.e. <h1>) is not permitted. Use ## for " +
-                    "top-level sections.")
-            self.parsed.append(
-                nlab_mistletoe.render(match.group(1) +
-                " " +
-                match.group(2)))
-            self.mode = "handled"
-        elif line.lstrip().startswith("$$"):
-            self.beginning_or_follows_blank = False
-            self.mode = "latex_double_dollar"
-            self.is_start_line = True
-        elif line.startswith("\\["):
-            self.beginning_or_follows_blank = False
-            self.mode = "latex_square_bracket"
-        elif line.startswith("[[!redirects"):
-            raise NLabSyntaxError(
-                "Redirects no longer handled in source editing")
-        elif line.startswith("\\tableofcontents"):
-            self.beginning_or_follows_blank = False
-            self.preamble.append(
-                "<h2 id=\"contents_header\">Contents</h2>\n" +
-                "<div id=\"table_of_contents\"></div>\n")
-            self.mode = "handled"
-        elif line.startswith("* table of contents"):
-            raise NLabSyntaxError(
-                "Old syntax for table of contents no longer supported. " +
-                "Use a line\n\n{}\n\ninstead.".format(
-                    "\\tableofcontents"))
-        elif line.startswith("category:"):
-            raise NLabSyntaxError(
-                "Page categories no longer handled in source editing")
-        elif "<nowiki>" in line:
-            raise NotYetSupportedError(
-                "<nowiki>...</nowiki> not supported yet")
-        elif line.startswith("+-- {: .rightHandSide}"):
-            raise NLabSyntaxError(
-                "Old syntax for context menus no longer supported. Use\n\n" +
-                "{}\n\ninstead, replacing ... by the name of the ".format(
-                    "\\context_menu[...]") +
-                "context menu.")
-        elif line.startswith("\\context_menu"):
-            contexts = re.compile(
-                r"\\context_menu\[(.*?)\]").search(line).group(1)
-            html = "<div id=\"context_menu\">\n"
-            for context in contexts.split(","):
-                html += "<div id=\"context_" + \
-                    "_".join(context.strip().split()) + \
-                    "\"></div>\n"
-            html += "</div>\n"
-            self.preamble.append(html)
-            self.mode = "handled"
-        elif line.startswith("\\begin{centre}"):
-            self.beginning_or_follows_blank = False
-            self.mode = "centre"
-        elif line.startswith("\\begin{center}"):
-            self.beginning_or_follows_blank = False
-            self.mode = "center"
-        elif line.startswith("\\begin{imagefromfile}"):
-            self.beginning_or_follows_blank = False
-            self.mode = "imagefromfile"
-        else:
-            self.theorem_environment = \
-                TheoremEnvironmentParser.match_new(line)
-            if self.theorem_environment is not None:
-                self.beginning_or_follows_blank = False
-                self.mode = "theorem_environment_new"
-                return
-            self.theorem_environment = \
-                TheoremEnvironmentParser.match_old(line)
-            if self.theorem_environment is not None:
-                raise NLabSyntaxError(
-                    "Old syntax for theorem environments no longer " +
-                    "supported. Use \\begin{theorem} ... \\end{theorem} " +
-                    "or similar instead")
-                self.beginning_or_follows_blank = False
-                self.mode = "theorem_environment_old"
-                return
-            elif not line.strip() :
-                self.beginning_or_follows_blank = True
-                self.mode = "handled"
-            elif (not self.beginning_or_follows_blank) and \
-                    require_blank_lines_after:
-                raise NLabSyntaxError(
-                    "Line should be blank as it follows a markdown " +
-                    "environment: " +
-                    line)
-            else:
-                self.mode = "mistletoe"
+    def _render_heading(self, block):
+        heading = block.argument
+        self.parsed.append(_render_block(
+            "heading",
+            heading,
+            lambda: nlab_mistletoe.render(heading)))
 
-    def render(self, source, require_blank_lines_after = True):
-        for line in source.split("\n"):
-            # Old-syntax page anchors
-            line = re.sub(
-                r"\{#(.*?)\}",
-                "<span id=\"" + r"\g<1>" + "\"></span>",
-                line)
-            # Line breaks
-            line = re.sub(r"\\linebreak", "<br>", line)
-            if not self.mode:
-                self._no_mode(line, require_blank_lines_after)
-            if self.mode == "handled":
-                self.mode = ""
-                continue
-            self.to_parse.append(line)
-            if self.mode == "mistletoe":
-                if not line.strip():
-                    self.parsed.append(nlab_mistletoe.render(self.to_parse))
-                    self.mode = ""
-                    self.to_parse.clear()
-            elif self.mode == "theorem_environment_new":
-                if "\\end{" + self.theorem_environment in line:
-                    self.parsed.append(
-                        TheoremEnvironmentParser.render_new(
-                            self.theorem_environment,
-                            "\n".join(self.to_parse)))
-                    self.mode = ""
-                    self.to_parse.clear()
-                    self.theorem_environment = None
-            elif self.mode == "theorem_environment_old":
-                if "=--" in line:
-                    self.parsed.append(
-                        TheoremEnvironmentParser.render_old(
-                            self.theorem_environment,
-                            "\n".join(self.to_parse)))
-                    self.mode = ""
-                    self.to_parse.clear()
-                    self.theorem_environment = None
-            elif self.mode == "latex_double_dollar":
-                if self.is_start_line:
-                    double_dollar_parts = line.split("$$")
-                    if ((len(double_dollar_parts) > 3) or (
-                            (len(double_dollar_parts) == 3) and \
-                            double_dollar_parts[2].strip())):
-                        raise NLabSyntaxError(
-                            "Closing $$ of a stand-alone LaTeX block should " +
-                            "not have anything after it on the same line. " +
-                            "Line: " +
-                            line)
-                    elif ((len(double_dollar_parts) == 1) or (
-                            (len(double_dollar_parts) == 2) and not \
-                            double_dollar_parts[1].strip())):
-                        self.is_start_line = False
-                    else:
-                        self.parsed.append(latex_parser.render_latex(
-                            "\n".join(self.to_parse).replace(
-                                "$$",""),
-                            "block"))
-                        self.mode = ""
-                        self.to_parse.clear()
-                        self.is_start_line = False
-                elif "$$" in line:
-                    self.parsed.append(latex_parser.render_latex(
-                        "\n".join(self.to_parse).replace(
-                            "$$",""),
-                        "block"))
-                    if line.split("$$")[1].rstrip():
-                        raise NLabSyntaxError(
-                            "Closing $$ of a stand-alone LaTeX block should " +
-                            "not have anything after it on the same line. " +
-                            "Line: " +
-                            line)
-                    self.mode = ""
-                    self.to_parse.clear()
-            elif self.mode == "latex_square_bracket":
-                if "\\]" in line:
-                    self.parsed.append(latex_parser.render_latex(
-                        "\n".join(self.to_parse).replace(
-                            "\\[", "").replace("\\]", ""),
-                        "block"))
-                    if line.split("\\]")[1].rstrip():
-                        raise NLabSyntaxError(
-                            "Closing \\]\\] of a stand-alone LaTeX block " +
-                            "should not have anything after it on the same " +
-                            "line. Line: " +
-                            line)
-                    self.mode = ""
-                    self.to_parse.clear()
-            elif self.mode == "centre":
-                if "\\end{centre}" in line:
-                    if line.split("\\end{centre}")[1].rstrip():
-                        raise NLabSyntaxError(
-                            "\\end{centre} should not have anything after " +
-                            "it on the same line. Line: {}".format(line))
-                    self.parsed.append("{}\n{}\n{}".format(
-                        "<div class=\"centre\">",
-                        "\n".join(Renderer(top_level = False).render(re.match(
-                            _centre_regex,
-                            "\n".join(self.to_parse)).group(1))),
-                        "</div>"))
-                    self.mode = ""
-                    self.to_parse.clear()
-            elif self.mode == "center":
-                if "\\end{center}" in line:
-                    if line.split("\\end{center}")[1].rstrip():
-                        raise NLabSyntaxError(
-                            "\\end{center} should not have anything after " +
-                            "it on the same line. Line: {}".format(line))
-                    self.parsed.append("{}\n{}\n{}".format(
-                        "<div class=\"centre\">",
-                        "\n".join(Renderer(top_level = False).render(re.match(
-                            _center_regex,
-                            "\n".join(self.to_parse)).group(1))),
-                        "</div>"))
-                    self.mode = ""
-                    self.to_parse.clear()
-            elif self.mode == "imagefromfile":
-               if "\\end{imagefromfile}" in line:
-                    if line.split("\\end{imagefromfile}")[1].rstrip():
-                        raise NLabSyntaxError(
-                            "\\end{imagefromfile} should not have anything " +
-                            "after it on the same line. Line: {}".format(line))
-                    self.parsed.append(image_from_file_parser.render(
-                        re.match(
-                            _image_from_file_regex,
-                            "\n".join(self.to_parse)).group(1)))
-                    self.mode = ""
-                    self.to_parse.clear()
-        if self.mode == "mistletoe":
-            self.parsed.append(nlab_mistletoe.render(self.to_parse))
-        elif self.mode:
-            raise NLabSyntaxError(
-                "The following belongs to an environment of type " +
-                self.mode +
-                " that was not closed: " +
-                "\n".join(self.to_parse))
+    def _render_table_of_contents(self, block):
+        if self.table_of_contents_index is None:
+            self.table_of_contents_index = len(self.preamble)
+        self.preamble.append(
+            "<h2 id=\"contents_header\">Contents</h2>\n" +
+            "<div id=\"table_of_contents\"></div>\n")
+
+    def _render_context_menu(self, block):
+        html = "<div id=\"context_menu\">\n"
+        for context in block.argument.split(","):
+            html += "<div id=\"context_" + \
+                "_".join(context.strip().split()) + \
+                "\"></div>\n"
+        html += "</div>\n"
+        self.preamble.append(html)
+
+    def _render_mistletoe_block(self, block):
+        lines = block.lines
+        self.parsed.append(_render_block(
+            "mistletoe",
+            "\n".join(lines),
+            lambda: nlab_mistletoe.render(lines)))
+
+    def _render_latex_block(self, block, *delimiters):
+        latex = "\n".join(block.lines)
+        for delimiter in delimiters:
+            latex = latex.replace(delimiter, "")
+        self.parsed.append(_render_block(
+            "latex",
+            latex,
+            lambda: latex_parser.render_latex(latex, "block")))
+
+    def _render_latex_double_dollar_block(self, block):
+        self._render_latex_block(block, "$$")
+
+    def _render_latex_square_bracket_block(self, block):
+        self._render_latex_block(block, "\\[", "\\]")
+
+    def _render_theorem_environment_block(self, block):
+        theorem_environment = block.argument
+        content = "\n".join(block.lines)
+        self.parsed.append(_render_block(
+            "theorem_environment_new " + theorem_environment,
+            content,
+            lambda: TheoremEnvironmentParser.render_new(
+                theorem_environment,
+                content)))
+
+    def _render_centre_block(self, block, regex):
+        content = regex.match("\n".join(block.lines)).group(1)
+        self.parsed.append(_render_block(
+            "centre",
+            content,
+            lambda: "{}\n{}\n{}".format(
+                "<div class=\"centre\">",
+                "\n".join(Renderer(top_level = False).render(content)),
+                "</div>")))
+
+    def _render_centre_british_block(self, block):
+        self._render_centre_block(block, _centre_regex)
+
+    def _render_centre_american_block(self, block):
+        self._render_centre_block(block, _center_regex)
+
+    def _render_image_from_file_block(self, block):
+        image_from_file_block = _image_from_file_regex.match(
+            "\n".join(block.lines)).group(1)
+        self.parsed.append(_render_block(
+            "imagefromfile",
+            image_from_file_block,
+            lambda: image_from_file_parser.render(image_from_file_block)))
+
+    _block_renderers = {
+        "heading": _render_heading,
+        "table_of_contents": _render_table_of_contents,
+        "context_menu": _render_context_menu,
+        "mistletoe": _render_mistletoe_block,
+        "latex_double_dollar": _render_latex_double_dollar_block,
+        "latex_square_bracket": _render_latex_square_bracket_block,
+        "theorem_environment_new": _render_theorem_environment_block,
+        "centre": _render_centre_british_block,
+        "center": _render_centre_american_block,
+        "imagefromfile": _render_image_from_file_block
+    }
+
+    def render_fragments(self, source, require_blank_lines_after = True):
+        # Yields the rendering of each block, other than those of the preamble
+        # (the table of contents and context menus), as soon as the lexer
+        # reaches its end, so that errors are raised in the order in which they
+        # occur in the source, and so that only the block being rendered need
+        # be held in memory. The preamble is only complete once every fragment
+        # has been yielded. All of the markdown of the page, including that
+        # within nested renderers, is rendered by the same Mistletoe renderer.
+        # If the page may have a table of contents, the fragments are scanned
+        # for what is to be numbered as they are yielded, but are only numbered
+        # if the page turns out to be numbered, by a second pass over them
+        lexer = nlab_block_lexer.BlockLexer(
+            TheoremEnvironmentParser,
+            require_blank_lines_after)
+        if self.top_level and ("\\tableofcontents" in source):
+            self.numbering = nlab_page_numbering.PageNumbering()
+        with nlab_mistletoe.session():
+            for block in lexer.blocks(source):
+                self._block_renderers[block.kind](self, block)
+                for fragment in self.parsed:
+                    if self.numbering is not None:
+                        self.numbering.scan(fragment)
+                    yield fragment
+                self.parsed.clear()
         if self.top_level:
+            if self._is_numbered():
+                self.preamble[self.table_of_contents_index] = (
+                    "<h2 id=\"contents_header\">Contents</h2>\n" +
+                    "<div id=\"table_of_contents\" data-numbered=\"true\">\n" +
+                    self.numbering.table_of_contents() +
+                    "</div>\n")
             self.preamble.append("<span class=\"page_content_start\"></span>")
-            self.parsed.append("<span class=\"page_content_end\"></span>")
-        return self.preamble + self.parsed
+            yield "<span class=\"page_content_end\"></span>"
+
+    def _is_numbered(self):
+        # Pages with a table of contents are numbered when they are parsed,
+        # unless they include other pages, the headings, theorem environments
+        # and equations of which are only known once they have been included
+        # in the browser
+        return (self.numbering is not None) and \
+            (self.table_of_contents_index is not None) and \
+            not self.numbering.has_inclusions
+
+    def render(self, source, require_blank_lines_after = True):
+        parsed = list(self.render_fragments(source, require_blank_lines_after))
+        if self._is_numbered():
+            self.numbering.restart()
+            for index, fragment in enumerate(parsed):
+                parsed[index] = self.numbering.number(fragment)
+        return self.preamble + parsed
+
+    def render_lines(self, source):
+        # Yields the lines returned by render, one at a time. The preamble
+        # comes first, but is only known once the whole page has been rendered,
+        # so the rest of the page is spooled, to a temporary file once it is
+        # large, whilst it is rendered. If the page is numbered, the spooled
+        # fragments are numbered one at a time as they are yielded
+        with tempfile.SpooledTemporaryFile(
+                max_size = _spool_size,
+                mode = "w+",
+                encoding = "utf-8",
+                newline = "") as content:
+            fragment_lengths = []
+            for fragment in self.render_fragments(source):
+                content.write(fragment)
+                fragment_lengths.append(len(fragment))
+            yield from self.preamble
+            content.seek(0)
+            is_numbered = self._is_numbered()
+            if is_numbered:
+                self.numbering.restart()
+            for fragment_length in fragment_lengths:
+                fragment = content.read(fragment_length)
+                if is_numbered:
+                    fragment = self.numbering.number(fragment)
+                yield fragment
+
+    def render_to(self, source, output):
+        # Writes the rendered page, the lines returned by render joined by
+        # newlines, to output, which need only have a write method. Each line
+        # is written whole
+        for index, line in enumerate(self.render_lines(source)):
+            if index > 0:
+                output.write("\n")
+            output.write(line)
 
 # In same file to avoid issues with circular dependencies
 class TheoremEnvironmentParser:
@@ -318,25 +307,23 @@ class TheoremEnvironmentParser:
 
     @classmethod
     def render_new(cls, theorem_environment, content):
-        environment_regex_new = re.compile(
-            r"\\begin\{" +
-            theorem_environment +
-            "\}(.*?)\\\end\{" +
-            theorem_environment +
-            "\}",
-            re.DOTALL)
-        content = environment_regex_new.match(content).group(1)
+        # The content runs from the \begin to the first \end of the
+        # environment, at which the lexer ended the block
+        begin = "\\begin{" + theorem_environment + "}"
+        content_start = content.index(begin) + len(begin)
+        content = content[content_start:content.index(
+            "\\end{" + theorem_environment + "}",
+            content_start)]
         rendered_content = "\n".join(
             Renderer(top_level = False).render(content))
         if rendered_content.startswith("<p>"):
             rendered_content = rendered_content[3:]
         if rendered_content.endswith("</p>"):
             rendered_content = rendered_content[:-4]
-        label_regex = re.compile(r"\\label\{(.*?)\}")
-        label_match = label_regex.search(rendered_content)
+        label_match = _label_regex.search(rendered_content)
         if label_match:
             label = label_match.group(1)
-            rendered_content = re.sub(label_regex, "", rendered_content)
+            rendered_content = _label_regex.sub("", rendered_content)
         else:
             label = None
         return (
@@ -380,11 +367,10 @@ class TheoremEnvironmentParser:
             rendered_content = rendered_content[3:]
         if rendered_content.endswith("</p>"):
             rendered_content = rendered_content[:-4]
-        label_regex = re.compile(r"\\label\{(.*?)\}")
-        label_match = label_regex.search(rendered_content)
+        label_match = _label_regex.search(rendered_content)
         if label_match:
             label = label_match.group(1)
-            content = re.sub(label_regex, "", content)
+            content = _label_regex.sub("", content)
         else:
             label = None
         if theorem_environment.startswith(".num_"):
@@ -430,8 +416,18 @@ def lambda_handler(event, context):
         }
     event_body = json.loads(event["body"])
     try:
-        rendered_source = "\n".join(Renderer().render(event_body["source"]))
-        headers["Content-Type"] = "text/html; charset=utf-8"
+        # The body of the response is necessarily the whole rendered page, but
+        # it is built from the lines of the page as they are rendered, without
+        # the page being held in full in any other form as well
+        if event_body.get("format") == "structured":
+            structured_document = latex_parser.StructuredDocumentJsonWriter()
+            Renderer().render_to(event_body["source"], structured_document)
+            rendered_source = structured_document.document()
+            headers["Content-Type"] = "application/json"
+        else:
+            rendered_source = "\n".join(
+                Renderer().render_lines(event_body["source"]))
+            headers["Content-Type"] = "text/html; charset=utf-8"
         return {
             "isBase64Encoded": False,
             "statusCode": 200,
@@ -1,3 +1,4 @@
+import contextlib
 import mistletoe
 
 import environment_or_equation_reference_parser
@@ -44,7 +45,34 @@ class nLabSourceRenderer(mistletoe.html_renderer.HTMLRenderer):
     def render_include_token(self, token):
         return token.render()
 
+_session_renderer = None
+
+"""
+Renders everything rendered by render within it with a single
+nLabSourceRenderer, rather than with a new one each time, which would register
+the custom span tokens with Mistletoe and then remove them again. Sessions may
+be nested, for instance by the renderers of the content of a theorem
+environment, and the renderer is only removed when the outermost one ends.
+
+Mistletoe keeps the span tokens it is using globally, so, as for any use of
+Mistletoe, only one thread may render at a time.
+"""
+@contextlib.contextmanager
+def session():
+    global _session_renderer
+    if _session_renderer is not None:
+        yield _session_renderer
+        return
+    with nLabSourceRenderer() as renderer:
+        _session_renderer = renderer
+        try:
+            yield renderer
+        finally:
+            _session_renderer = None
+
 def render(source):
+    if _session_renderer is not None:
+        return _session_renderer.render(mistletoe.Document(source))
     with nLabSourceRenderer() as renderer:
         rendered_source = renderer.render(mistletoe.Document(source))
     return rendered_source
@@ -0,0 +1,159 @@
+import re
+
+"""
+Numbers the sections, theorem environments and displayed equations of a page
+with a table of contents when it is parsed, in the same way as
+contents_and_numbering.js would once the page is loaded, builds its table of
+contents, and fills in the text of every reference to a labelled theorem
+environment or equation. The browser then has nothing left to do.
+
+Only the HTML which the parser itself renders for headings, theorem
+environments, displayed LaTeX and references is recognised. The page is passed
+through twice, a fragment at a time and in order: once to find every heading
+and label, and once to number the fragments, so that a reference can be filled
+in whether it comes before or after what it refers to, without the whole page
+being held in memory.
+"""
+
+_numbered_regex = re.compile(
+    r"<h([2-6])>(.*?)</h\1>" +
+    r"|<div class=\"(definition|theorem)_environment\"" +
+    r"(?: id=\"([^\"]*)\")?>\n<p><span class=\"\3_environment\">([^<]*)" +
+    r"</span>" +
+    r"|<span class=\"latex\" data-latex=\"[^\"]*\" " +
+    r"data-display-mode=(?:\"block\"|'block')(?: id='([^']*)')?" +
+    r"|<a class=\"environment_or_equation_reference\" href=\"#([^\"]*)\">" +
+    r"</a>")
+_id_regex = re.compile(r" id=(?:\"[^\"]*\"|'[^']*')")
+
+_section_levels = 5
+
+"""
+A heading of the table of contents, and the headings beneath it.
+"""
+class _Section:
+    def __init__(self, depth, number, html):
+        self.depth = depth
+        self.number = number
+        self.html = html
+        self.subsections = []
+
+def _sections_html(sections, tag):
+    html = "<{}>\n".format(tag)
+    for section in sections:
+        html += (
+            "<li id=\"table_of_contents_section-{}\">".format(section.number) +
+            "<a href=\"#section-{}\">{}</a>".format(
+                section.number,
+                section.html))
+        if section.subsections:
+            html += "\n" + _sections_html(section.subsections, "ul")
+        html += "</li>\n"
+    return html + "</{}>\n".format(tag)
+
+class PageNumbering:
+    def __init__(self):
+        self.sections = []
+        self.labels = dict()
+        self.has_inclusions = False
+        self._open_sections = []
+        self._restart()
+
+    def _restart(self):
+        self.section_counters = [ 0 ] * _section_levels
+        self.theorem_counter = 0
+        self.equation_counter = 0
+
+    def _add_section(self, depth, number, html):
+        # Headings which skip a level are placed beneath the nearest heading
+        # above them of a higher level
+        section = _Section(depth, number, html)
+        while self._open_sections and \
+                (self._open_sections[-1].depth >= depth):
+            self._open_sections.pop()
+        if self._open_sections:
+            self._open_sections[-1].subsections.append(section)
+        else:
+            self.sections.append(section)
+        self._open_sections.append(section)
+
+    def _number_heading(self, match, record):
+        depth = int(match.group(1)) - 2
+        self.section_counters[depth] += 1
+        for deeper in range(depth + 1, _section_levels):
+            self.section_counters[deeper] = 0
+        if depth == 0:
+            self.theorem_counter = 0
+        number = "-".join(
+            str(counter) for counter in self.section_counters[:depth + 1])
+        if record:
+            # Without the ids of any anchors within the heading, which would
+            # otherwise be duplicated
+            self._add_section(depth, number, _id_regex.sub("", match.group(2)))
+        return "<h{} id=\"section-{}\">{}{}</h{}>".format(
+            match.group(1),
+            number,
+            "{}. ".format(self.section_counters[0]) if depth == 0 else "",
+            match.group(2),
+            match.group(1))
+
+    def _number_theorem_environment(self, match, record):
+        self.theorem_counter += 1
+        number = "{}.{}".format(self.section_counters[0], self.theorem_counter)
+        if record and (match.group(4) is not None):
+            self.labels[match.group(4)] = number
+        return (
+            "<div class=\"{}_environment\"".format(match.group(3)) +
+            (" id=\"{}\">\n".format(match.group(4))
+                if match.group(4) is not None else ">\n") +
+            "<p><span class=\"{}_environment\" ".format(match.group(3)) +
+            "id=\"theorem{}\" data-theorem-number=\"{}\">{} {}</span>".format(
+                number,
+                number,
+                match.group(5),
+                number))
+
+    def _number_equation(self, match, record):
+        self.equation_counter += 1
+        if record and (match.group(6) is not None):
+            self.labels[match.group(6)] = str(self.equation_counter)
+        return match.group(0) + " data-equation-number=\"{}\"".format(
+            self.equation_counter)
+
+    def _fill_reference(self, match):
+        # A reference to a label which does not exist is left empty, as it
+        # would be in the browser
+        return (
+            "<a class=\"environment_or_equation_reference\" " +
+            "href=\"#{}\">{}</a>".format(
+                match.group(7),
+                self.labels.get(match.group(7), "")))
+
+    def _numbered(self, match, record):
+        if match.group(1) is not None:
+            return self._number_heading(match, record)
+        if match.group(3) is not None:
+            return self._number_theorem_environment(match, record)
+        if match.group(7) is not None:
+            return self._fill_reference(match)
+        return self._number_equation(match, record)
+
+    def scan(self, fragment):
+        # The first pass, over each fragment of the page in turn
+        if "class=\"page_inclusion\"" in fragment:
+            self.has_inclusions = True
+        for match in _numbered_regex.finditer(fragment):
+            self._numbered(match, True)
+
+    def table_of_contents(self):
+        return _sections_html(self.sections, "ol")
+
+    def restart(self):
+        # Called between the two passes
+        self._restart()
+
+    def number(self, fragment):
+        # The second pass, over each fragment of the page in turn
+        return _numbered_regex.sub(
+            lambda match: self._numbered(match, False),
+            fragment)
@@ -0,0 +1,86 @@
+"""
+Finds the matches of the patterns of the custom span tokens in a time linear in
+the length of the string, whatever the string.
+
+Each of the patterns begins with an opening delimiter, and ends at the first
+closing delimiter after it, provided that no character which the pattern does
+not allow, such as a newline or a |, comes first. Searching with the pattern
+alone, an opening delimiter which is never closed is followed to the end of the
+string, or of the line, and then so is every other opening delimiter after it,
+which is quadratic in the length of a paragraph with many unclosed [[, \\[ or
+eq:. Instead, the next closing delimiter and the next disallowed character are
+looked up for each opening delimiter, and the pattern is only matched at an
+opening delimiter if it is known that the match will succeed, or fail at once.
+The matches are exactly those which finditer would find.
+
+Looking up the delimiters is slower than searching with the pattern when there
+are few opening delimiters, and then, as each of them is followed at most once,
+searching with the pattern alone is still linear. So the delimiters are only
+looked up in strings with more opening delimiters than that.
+"""
+
+_few_openings = 32
+
+"""
+The next occurrence of a substring, or of a match of a compiled pattern, in a
+string, at or after a position. Whilst the positions asked about increase, each
+search begins where the last one ended, or is not needed at all, so that all of
+them together take a time linear in the length of the string.
+"""
+class Occurrences:
+    def __init__(self, string, target):
+        self.string = string
+        self.target = target
+        self.searched_from = None
+        self.found = -1
+
+    def _find(self, position):
+        if isinstance(self.target, str):
+            return self.string.find(self.target, position)
+        match = self.target.search(self.string, position)
+        if match is None:
+            return -1
+        return match.start()
+
+    def at_or_after(self, position):
+        # Returns -1 if there is no occurrence
+        if (self.searched_from is None) or \
+                (position < self.searched_from) or \
+                (0 <= self.found < position):
+            self.found = self._find(position)
+            self.searched_from = position
+        return self.found
+
+def _matches(pattern, string, openings, can_match):
+    next_openings = [ Occurrences(string, opening) for opening in openings ]
+    position = 0
+    while True:
+        starts = [
+            start
+            for start in (
+                next_opening.at_or_after(position)
+                for next_opening in next_openings)
+            if start != -1
+        ]
+        if not starts:
+            return
+        start = min(starts)
+        match = pattern.match(string, start) if can_match(start) else None
+        if match is None:
+            position = start + 1
+        else:
+            yield match
+            position = match.end()
+
+def matches(pattern, string, openings, can_match):
+    # Returns the matches of the pattern in the string, as pattern.finditer
+    # would. Every match begins with one of the openings. can_match is called
+    # with the string, and returns a function which is called with the
+    # position of each opening in turn, and returns whether the pattern can
+    # match there
+    openings_count = 0
+    for opening in openings:
+        openings_count += string.count(opening)
+    if openings_count <= _few_openings:
+        return pattern.finditer(string)
+    return _matches(pattern, string, openings, can_match(string))
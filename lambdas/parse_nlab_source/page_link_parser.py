@@ -5,6 +5,7 @@ import urllib.parse
 import mistletoe.span_token
 
 import latex_parser
+import nlab_span_scanner
 from nlab_parsing_errors import NLabSyntaxError, NotYetSupportedError
 
 _file_root_url = os.environ["FILE_ROOT_URL"]
@@ -17,6 +18,24 @@ a link to page. It is assumed that page links are valid.
 class SimplePageLinkToken(mistletoe.span_token.SpanToken):
     pattern = re.compile(r"\[\[([^\|]+?)\]\]")
 
+    @staticmethod
+    def _can_match(string):
+        closings = nlab_span_scanner.Occurrences(string, "]]")
+        bars = nlab_span_scanner.Occurrences(string, "|")
+        def can_match(start):
+            closing = closings.at_or_after(start + 3)
+            bar = bars.at_or_after(start + 2)
+            return (closing != -1) and ((bar == -1) or (bar > closing))
+        return can_match
+
+    @classmethod
+    def find(cls, string):
+        return nlab_span_scanner.matches(
+            cls.pattern,
+            string,
+            [ "[[" ],
+            cls._can_match)
+
     def __init__(self, match):
         self.page_name = match.group(1).strip()
 
@@ -53,6 +72,35 @@ class PageLinkWithDisplayTextToken(mistletoe.span_token.SpanToken):
     pattern = re.compile(r"(?!\[\[([^\|]+?)\]\])\[\[([^\|]+?)\|([^\|]+?)\]\]")
     precedence = 20
 
+    @staticmethod
+    def _can_match(string):
+        simple_link_closings = nlab_span_scanner.Occurrences(string, "]]")
+        closings = nlab_span_scanner.Occurrences(string, "]]")
+        first_bars = nlab_span_scanner.Occurrences(string, "|")
+        second_bars = nlab_span_scanner.Occurrences(string, "|")
+        def can_match(start):
+            first_bar = first_bars.at_or_after(start + 2)
+            if first_bar < start + 3:
+                return False
+            # A simple page link
+            simple_link_closing = simple_link_closings.at_or_after(start + 3)
+            if (simple_link_closing != -1) and \
+                    (simple_link_closing < first_bar):
+                return False
+            closing = closings.at_or_after(first_bar + 2)
+            second_bar = second_bars.at_or_after(first_bar + 1)
+            return (closing != -1) and \
+                ((second_bar == -1) or (second_bar > closing))
+        return can_match
+
+    @classmethod
+    def find(cls, string):
+        return nlab_span_scanner.matches(
+            cls.pattern,
+            string,
+            [ "[[" ],
+            cls._can_match)
+
     def __init__(self, match):
         self.page_name = match.group(2).strip()
         # Allow for use of LaTeX in display text
@@ -1,116 +1,44 @@
 import json
 import os
-import re
-import requests
 
-_diagrams_root_url = os.environ["DIAGRAMS_ROOT_URL"]
-_new_diagram_root_url = os.environ["NEW_DIAGRAM_ROOT_URL"]
-_parse_source_root_url = os.environ["PARSE_SOURCE_ROOT_URL"]
-_render_latex_root_url = os.environ["RENDER_LATEX_ROOT_URL"]
-_render_page_root_url = os.environ["RENDER_PAGE_ROOT_URL"]
-
-_latex_diagrams_regex = re.compile(
-    r"(\\begin{tikzpicture}(.*?)\\end{tikzpicture})|" +
-        r"(\\begin{tikzcd}(.*?)\\end{tikzcd})|" +
-        r"(\\begin{xymatrix}(.*?)\\end{xymatrix})",
-    re.DOTALL)
-
-class FailedToRenderDiagramException(Exception):
-    def __init__(self, status_code, message):
-        super().__init__(message)
-        self.status_code = status_code
-
-class FailedToParseException(Exception):
-    def __init__(self, status_code, message):
-        super().__init__(message)
-        self.status_code = status_code
+import edit_rendering
 
-class FailedToRenderException(Exception):
-    def __init__(self, status_code, message):
-        super().__init__(message)
-        self.status_code = status_code
+_diagrams_previews_root_url = os.environ["DIAGRAMS_PREVIEWS_ROOT_URL"]
+_diagrams_root_url = os.environ["DIAGRAMS_ROOT_URL"]
 
-class FailedToRenderLatexException(Exception):
-    def __init__(self, status_code, message):
-        super().__init__(message)
-        self.status_code = status_code
+_return_stage_timings = os.environ.get("RETURN_STAGE_TIMINGS") == "true"
 
-def _replace_diagram_source_with_img_tag(metadata, diagram_source_match):
-    if diagram_source_match.group(1) is not None:
-        diagram_type = "tikz"
-        diagram = diagram_source_match.group(1)
-    elif diagram_source_match.group(3) is not None:
-        diagram_type = "tikzcd"
-        diagram = diagram_source_match.group(3)
-    elif diagram_source_match.group(5) is not None:
-        diagram_type = "xypic"
-        diagram = diagram_source_match.group(5)
-    response = requests.post(
-        _new_diagram_root_url,
-        json = {
-            "type": diagram_type,
-            "source": diagram,
-            "author": metadata["author"],
-            "ip_address": metadata["ip_address"]
-        }
-    )
-    if response.status_code != 200:
-        raise FailedToRenderDiagramException(
-            response.status_code,
-            "An error occurred when trying to render the following " +
-            "diagram.\n\n{}\n\nError: {}".format(
-                diagram,
-                response.text))
-    diagram_id = response.text
+def _diagram_tag(response):
+    # A diagram which has not been submitted before is only rendered into a
+    # short-lived preview area, rather than stored permanently
+    created_diagram = response.json()
+    if "diagram_id" in created_diagram:
+        return "<img src=\"{}/{}\">".format(
+            _diagrams_root_url,
+            created_diagram["diagram_id"])
     return "<img src=\"{}/{}\">".format(
-        _diagrams_root_url,
-        diagram_id)
-
-def _render_diagrams(metadata, source):
-    return re.sub(
-        _latex_diagrams_regex,
-        lambda match: _replace_diagram_source_with_img_tag(
-            metadata,
-            match),
-        source)
-
-def _render_page(source, page_name):
-    response = requests.put(
-        _parse_source_root_url,
-        json = {
-            "source": source
-        })
-    if response.status_code != 200:
-        raise FailedToParseException(response.status_code, response.text)
-
-    response = requests.put(
-        _render_latex_root_url,
-        json = {
-            "source": response.text
-        })
-    if response.status_code != 200:
-        raise FailedToRenderLatexException(response.status_code, response.text)
-
-    response = requests.put(
-        _render_page_root_url,
-        json = {
-            "page_name": page_name,
-            "parsed_source": response.text
-        })
-    if response.status_code != 200:
-        raise FailedToRenderException(response.status_code, response.text)
-    return response.text
+        _diagrams_previews_root_url,
+        created_diagram["preview_id"])
 
-def _render_preview(metadata, source):
+def _render_preview(metadata, source, timings):
     page_name = metadata["page_name"]
-    source_with_created_diagrams = _render_diagrams(metadata, source)
-    return _render_page(source_with_created_diagrams, page_name)
-
-def _render_preview_and_handle_errors(metadata, source, headers):
+    source_with_created_diagrams = edit_rendering.render_diagrams(
+        metadata,
+        source,
+        timings,
+        _diagram_tag,
+        preview = True)
+    return edit_rendering.render_page(
+        source_with_created_diagrams,
+        page_name,
+        timings)
+
+def _render_preview_and_handle_errors(metadata, source, headers, timings):
     try:
         rendered_page = _render_preview(
             metadata,
-            source)
+            source,
+            timings)
         headers["Content-Type"] = "text/html"
         print(rendered_page)
         return  {
@@ -120,10 +48,10 @@ def _render_preview_and_handle_errors(metadata, source, headers):
             "body": rendered_page
         }
     except (
-            FailedToParseException,
-            FailedToRenderDiagramException,
-            FailedToRenderLatexException,
-            FailedToRenderException) as exception:
+            edit_rendering.FailedToParseException,
+            edit_rendering.FailedToRenderDiagramException,
+            edit_rendering.FailedToRenderLatexException,
+            edit_rendering.FailedToRenderException) as exception:
         headers["Content-Type"] = "text/plain"
         return {
             "isBase64Encoded": False,
@@ -212,7 +140,15 @@ def lambda_handler(event, context):
         _extract_metadata_and_source(event, headers)
     if response is not None:
         return response
-    return _render_preview_and_handle_errors(
+    timings = edit_rendering.StageTimings()
+    response = _render_preview_and_handle_errors(
         metadata,
         source,
-        headers)
+        headers,
+        timings)
+    timings.log(
+        page_name = metadata["page_name"],
+        status_code = response["statusCode"])
+    if _return_stage_timings:
+        response["headers"]["Server-Timing"] = timings.server_timing_header()
+    return response
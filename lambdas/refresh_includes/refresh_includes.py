@@ -0,0 +1,111 @@
+import botocore.exceptions
+import concurrent.futures
+import gzip
+import json
+
+import store_edit
+
+_max_refresh_workers = 8
+
+"""
+Refreshes the pages which include a page, directly or not, once it has been
+stored by store_edit with INCLUDE_INDEX_ROOT_URL set, so that the content of
+the page expanded into them is current. store_edit must be packaged with this,
+and its environment variables set.
+
+This is triggered by the SQS queue INCLUDE_REFRESH_QUEUE_URL, to which
+store_edit sends the name of each page which it stores. The including pages are
+found in the include index which store_edit keeps. Each of them is refreshed
+from its current stored page, the inclusions of which are expanded again from
+the current fragments of the pages which it includes: it is not rendered again.
+A page and its brotli variant are only written if they have not been stored
+again since they were read, since a page which has been stored again was
+expanded from the current fragments anyway. If anything else fails, an
+exception is raised, so that SQS retries the whole batch, refreshing a page
+again being harmless.
+"""
+
+def _etag(key):
+    # None if there is no such object
+    try:
+        return store_edit._s3_client.head_object(
+            Bucket = store_edit._pages_bucket_name,
+            Key = key)["ETag"]
+    except botocore.exceptions.ClientError as exception:
+        if exception.response["Error"]["Code"] in [ "404", "NotFound" ]:
+            return None
+        raise exception
+
+def _put_object_if_unchanged(put_object_request, etag):
+    # Returns whether the object was written
+    if etag is None:
+        condition = { "IfNoneMatch": "*" }
+    else:
+        condition = { "IfMatch": etag }
+    try:
+        store_edit._s3_client.put_object(
+            Bucket = store_edit._pages_bucket_name,
+            **put_object_request,
+            **condition)
+    except botocore.exceptions.ClientError as exception:
+        if exception.response["Error"]["Code"] in [
+                "ConditionalRequestConflict",
+                "PreconditionFailed" ]:
+            return False
+        raise exception
+    return True
+
+def _refresh(page_name):
+    # Returns whether the page was written
+    page_key = store_edit.current_keys(page_name)[0]
+    try:
+        response = store_edit._s3_client.get_object(
+            Bucket = store_edit._pages_bucket_name,
+            Key = page_key)
+    except store_edit._s3_client.exceptions.NoSuchKey:
+        store_edit._update_include_index(page_name, set())
+        return False
+    rendered_page = response["Body"].read()
+    if response.get("ContentEncoding") == "gzip":
+        rendered_page = gzip.decompress(rendered_page)
+    rendered_page = rendered_page.decode("utf-8")
+    # The ETag of the brotli variant is read at once too, so that a page
+    # stored again whilst this one is refreshed is noticed
+    etags = [ response["ETag"] ]
+    if store_edit.brotli is not None:
+        etags.append(_etag(store_edit._brotli_variant_key(page_key)))
+    expanded_page, included_page_names = store_edit._expanded_includes(
+        page_name,
+        rendered_page)
+    store_edit._update_include_index(page_name, included_page_names)
+    if expanded_page == rendered_page:
+        return False
+    put_object_requests = store_edit._encoded_put_object_requests({
+        "ACL": "public-read",
+        "Body": expanded_page.encode("utf-8"),
+        "CacheControl": store_edit._current_cache_control,
+        "ContentType": "text/html",
+        "Key": page_key
+    })
+    for put_object_request, etag in zip(put_object_requests, etags):
+        if not _put_object_if_unchanged(put_object_request, etag):
+            return False
+    store_edit._queue_invalidation([ page_key ])
+    return True
+
+def lambda_handler(event, context):
+    page_names = dict.fromkeys(
+        json.loads(record["body"])["page_name"]
+        for record in event["Records"])
+    dependent_page_names = list(dict.fromkeys(
+        dependent_page_name
+        for page_name in page_names
+        for dependent_page_name in store_edit._dependent_page_names(page_name)))
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers = _max_refresh_workers) as executor:
+        refreshed = list(executor.map(_refresh, dependent_page_names))
+    print(json.dumps({
+        "pages": len(page_names),
+        "dependent_pages": len(dependent_page_names),
+        "refreshed_pages": sum(refreshed)
+    }))
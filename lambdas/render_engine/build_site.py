@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+
+import argparse
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import os
+import sys
+import urllib.parse
+
+import nlab_markdown_parser
+import render_engine
+import render_nlab_page
+
+"""
+Renders every page of the site from its source, without going through
+store_edit, for instance after a change to the parser or to the page template.
+
+Sources are read from a local directory, or from an S3 prefix given as
+s3://bucket/prefix, in which the path of each source relative to the directory
+or prefix is its page name, as for the sources stored by store_edit. The sources
+stored by store_edit already have their diagrams created, so no diagrams are
+created here. Rendered pages are written to the same relative paths within the
+output directory.
+
+A manifest in the output directory records the hash of the source of every page
+which was rendered, and a hash of the renderer, that is, of the code and
+page template used to render. A later build only renders pages whose source has
+changed or whose rendered page is missing, unless the renderer has changed, in
+which case every page is rendered again. For sources in S3, the manifest also
+records the ETag of each source, and a source whose ETag is unchanged is not
+even downloaded again. Pages whose source has been removed
+are removed from the output directory.
+
+This must be run from a directory laid out as the render engine is packaged
+(see the README), since the page template is read from the current directory,
+and with the same environment variables as the render engine. Each process of
+the pool starts its own NodeJS worker.
+"""
+
+_manifest_file_name = ".build_manifest.json"
+_renderer_file_extensions = [ ".js", ".py" ]
+
+_s3_client = None
+
+class FailedToBuildPageException(Exception):
+    pass
+
+def _renderer_version():
+    directories = sorted(set(
+        os.path.dirname(os.path.abspath(module.__file__))
+        for module in [
+            nlab_markdown_parser,
+            render_engine,
+            render_nlab_page
+        ]))
+    paths = [ os.path.abspath("page_template") ]
+    for directory in directories:
+        for file_name in sorted(os.listdir(directory)):
+            if os.path.splitext(file_name)[1] in _renderer_file_extensions:
+                paths.append(os.path.join(directory, file_name))
+    renderer_hash = hashlib.sha256()
+    for path in paths:
+        renderer_hash.update(os.path.basename(path).encode("utf-8"))
+        with open(path, "rb") as renderer_file:
+            renderer_hash.update(
+                hashlib.sha256(renderer_file.read()).digest())
+    return renderer_hash.hexdigest()
+
+def _split_s3_url(s3_url):
+    parsed_url = urllib.parse.urlparse(s3_url)
+    return parsed_url.netloc, parsed_url.path.strip("/")
+
+def _s3():
+    # Created on first use within each process of the pool, since clients
+    # cannot be shared between processes
+    global _s3_client
+    if _s3_client is None:
+        import boto3
+        _s3_client = boto3.client("s3")
+    return _s3_client
+
+def _page_names_and_etags(sources):
+    # The ETag of each source in S3, or None for a local source
+    if sources.startswith("s3://"):
+        bucket_name, prefix = _split_s3_url(sources)
+        paginator = _s3().get_paginator("list_objects_v2")
+        for list_response in paginator.paginate(
+                Bucket = bucket_name,
+                Prefix = prefix + "/"):
+            for source in list_response.get("Contents", []):
+                yield source["Key"][len(prefix) + 1:], source["ETag"]
+        return
+    for directory, _, file_names in os.walk(sources):
+        for file_name in file_names:
+            yield os.path.relpath(
+                os.path.join(directory, file_name),
+                sources).replace(os.sep, "/"), None
+
+def _read_source(sources, page_name):
+    if sources.startswith("s3://"):
+        bucket_name, prefix = _split_s3_url(sources)
+        response = _s3().get_object(
+            Bucket = bucket_name,
+            Key = "{}/{}".format(prefix, page_name))
+        body = response["Body"].read()
+        if response.get("ContentEncoding") == "gzip":
+            body = gzip.decompress(body)
+        return body.decode("utf-8")
+    with open(
+            os.path.join(sources, page_name),
+            "r",
+            encoding = "utf-8") as source_file:
+        return source_file.read()
+
+def _output_path(output, page_name):
+    return os.path.join(output, *page_name.split("/"))
+
+def _build_page(
+        sources,
+        output,
+        page_name,
+        etag,
+        previous_source_hash,
+        previous_etag):
+    # Returns the hash of the source of the page, and whether the page was
+    # rendered. A source with the same ETag as when it was last rendered is not
+    # read again
+    output_path = _output_path(output, page_name)
+    if (etag is not None) and (etag == previous_etag) and \
+            (previous_source_hash is not None) and \
+            os.path.exists(output_path):
+        return previous_source_hash, False
+    source = _read_source(sources, page_name)
+    source_hash = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    if (source_hash == previous_source_hash) and os.path.exists(output_path):
+        return source_hash, False
+    try:
+        rendered_page = render_engine.render_page(source, page_name)
+    except Exception as exception:
+        # The exceptions of the render engine cannot be sent back from a process
+        # of the pool, since they take more than one argument
+        raise FailedToBuildPageException(str(exception))
+    os.makedirs(os.path.dirname(output_path), exist_ok = True)
+    with open(output_path, "w", encoding = "utf-8") as page_file:
+        page_file.write(rendered_page)
+    return source_hash, True
+
+def _load_manifest(manifest_path):
+    try:
+        with open(manifest_path, "r") as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {
+            "renderer_version": None,
+            "pages": dict(),
+            "source_etags": dict()
+        }
+
+def _save_manifest(manifest_path, manifest):
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent = 2, sort_keys = True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+def build(sources, output, workers, force):
+    os.makedirs(output, exist_ok = True)
+    manifest_path = os.path.join(output, _manifest_file_name)
+    manifest = _load_manifest(manifest_path)
+    renderer_version = _renderer_version()
+    if force or (manifest["renderer_version"] != renderer_version):
+        previous_source_hashes = dict()
+    else:
+        previous_source_hashes = manifest["pages"]
+    # Manifests written before ETags were recorded have none
+    previous_etags = manifest.get("source_etags", dict())
+    etags = dict(_page_names_and_etags(sources))
+    page_names = sorted(etags)
+    page_names_set = set(page_names)
+    for removed_page_name in set(manifest["pages"]) - page_names_set:
+        try:
+            os.remove(_output_path(output, removed_page_name))
+        except FileNotFoundError:
+            pass
+    # Pages are only recorded in the manifest once they have been rendered
+    # with the current renderer, so an interrupted or failed build is resumed
+    # by the next one
+    manifest = {
+        "renderer_version": renderer_version,
+        "pages": {
+            page_name: source_hash
+            for page_name, source_hash in previous_source_hashes.items()
+            if page_name in page_names_set
+        },
+        "source_etags": {
+            page_name: etag
+            for page_name, etag in previous_etags.items()
+            if (page_name in page_names_set) and \
+                (page_name in previous_source_hashes)
+        }
+    }
+    rendered = 0
+    failures = dict()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers = workers) as executor:
+            futures = {
+                executor.submit(
+                    _build_page,
+                    sources,
+                    output,
+                    page_name,
+                    etags[page_name],
+                    previous_source_hashes.get(page_name),
+                    previous_etags.get(page_name)): page_name
+                for page_name in page_names
+            }
+            for future in concurrent.futures.as_completed(futures):
+                page_name = futures[future]
+                try:
+                    source_hash, was_rendered = future.result()
+                except Exception as exception:
+                    failures[page_name] = str(exception)
+                    manifest["pages"].pop(page_name, None)
+                    manifest["source_etags"].pop(page_name, None)
+                    print("{}: failed: {}".format(page_name, exception))
+                    continue
+                manifest["pages"][page_name] = source_hash
+                if etags[page_name] is None:
+                    manifest["source_etags"].pop(page_name, None)
+                else:
+                    manifest["source_etags"][page_name] = etags[page_name]
+                if was_rendered:
+                    rendered += 1
+                    print(page_name)
+    finally:
+        _save_manifest(manifest_path, manifest)
+    print("{} of {} pages rendered, {} failed".format(
+        rendered,
+        len(page_names),
+        len(failures)))
+    return failures
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description = "Render every page whose source or renderer has changed")
+    argument_parser.add_argument(
+        "sources",
+        help = "Directory of page sources, or an S3 prefix s3://bucket/prefix")
+    argument_parser.add_argument(
+        "output",
+        help = "Directory to write rendered pages to")
+    argument_parser.add_argument(
+        "--workers",
+        type = int,
+        default = os.cpu_count(),
+        help = "Number of pages to render at once")
+    argument_parser.add_argument(
+        "--force",
+        action = "store_true",
+        help = "Render every page, even if it is unchanged")
+    arguments = argument_parser.parse_args()
+    failures = build(
+        arguments.sources,
+        arguments.output,
+        arguments.workers,
+        arguments.force)
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
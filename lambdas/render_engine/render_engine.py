@@ -0,0 +1,153 @@
+import json
+import os
+import subprocess
+import threading
+import time
+
+import latex_parser
+import nlab_markdown_parser
+import render_nlab_page
+from nlab_parsing_errors import NLabSyntaxError, NotYetSupportedError
+
+"""
+Runs the whole rendering pipeline for a page (parse, LaTeX, sanitise, page
+template) within a single lambda, rather than making an HTTP request to a
+separate lambda for each stage.
+
+The parsing and templating are carried out in this process. KaTeX and DOMPurify
+are only available in NodeJS, so the LaTeX rendering and sanitising are carried
+out by a long-lived NodeJS worker process, which is started on first use and
+then kept for the lifetime of the lambda environment. Requests to the worker are
+newline-delimited JSON over its stdin and stdout.
+
+If the worker cannot be started or dies, RenderEngineUnavailableException is
+raised, and callers are expected to fall back to the HTTP chain.
+
+Callers may pass an object with a method record(stage, seconds, input_bytes,
+output_bytes) to render_page, to which the duration and the sizes of the input
+and output of each stage are passed.
+"""
+
+_worker_script = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "render_engine_worker.js")
+
+_worker = None
+_worker_lock = threading.Lock()
+
+class RenderEngineUnavailableException(Exception):
+    pass
+
+class FailedToParseException(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+class FailedToRenderLatexException(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+class FailedToSanitiseException(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+def _start_worker():
+    try:
+        return subprocess.Popen(
+            [ "node", _worker_script ],
+            stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE,
+            encoding = "utf-8")
+    except OSError as exception:
+        raise RenderEngineUnavailableException(str(exception))
+
+def _stop_worker():
+    global _worker
+    if _worker is not None:
+        _worker.kill()
+        _worker = None
+
+def _worker_request(request):
+    global _worker
+    with _worker_lock:
+        if (_worker is None) or (_worker.poll() is not None):
+            _worker = _start_worker()
+        try:
+            _worker.stdin.write(json.dumps(request) + "\n")
+            _worker.stdin.flush()
+            response = _worker.stdout.readline()
+        except OSError as exception:
+            _stop_worker()
+            raise RenderEngineUnavailableException(str(exception))
+        if not response:
+            _stop_worker()
+            raise RenderEngineUnavailableException(
+                "The render engine worker exited unexpectedly")
+    return json.loads(response)
+
+def _size(text):
+    return len(text.encode("utf-8"))
+
+def parse(source):
+    try:
+        return "\n".join(nlab_markdown_parser.Renderer().render_lines(source))
+    except (NLabSyntaxError, NotYetSupportedError) as exception:
+        raise FailedToParseException(400, str(exception))
+
+def parse_structured(source):
+    structured_document = latex_parser.StructuredDocumentWriter()
+    try:
+        nlab_markdown_parser.Renderer().render_to(source, structured_document)
+    except (NLabSyntaxError, NotYetSupportedError) as exception:
+        raise FailedToParseException(400, str(exception))
+    return structured_document.document()
+
+def render_latex_and_sanitise(parsed_source, timings = None):
+    # The parsed source may be HTML, or a structured document
+    response = _worker_request({ "source": parsed_source })
+    if response["status_code"] == 200:
+        if timings is not None:
+            if isinstance(parsed_source, str):
+                parsed_size = _size(parsed_source)
+            else:
+                parsed_size = _size(json.dumps(parsed_source))
+            timings.record(
+                "render_latex",
+                response["timings"]["render_latex"]["seconds"],
+                parsed_size,
+                response["timings"]["render_latex"]["output_bytes"])
+            timings.record(
+                "sanitise",
+                response["timings"]["sanitise"]["seconds"],
+                response["timings"]["render_latex"]["output_bytes"],
+                response["timings"]["sanitise"]["output_bytes"])
+        return response["body"]
+    if response["stage"] == "latex":
+        raise FailedToRenderLatexException(
+            response["status_code"],
+            response["body"])
+    raise FailedToSanitiseException(
+        response["status_code"],
+        response["body"])
+
+def render_page(source, page_name, timings = None):
+    start = time.perf_counter()
+    parsed_source = parse_structured(source)
+    if timings is not None:
+        timings.record(
+            "parse",
+            time.perf_counter() - start,
+            _size(source),
+            _size(json.dumps(parsed_source)))
+    content = render_latex_and_sanitise(parsed_source, timings)
+    start = time.perf_counter()
+    rendered_page = render_nlab_page.render(page_name, content)
+    if timings is not None:
+        timings.record(
+            "render_page",
+            time.perf_counter() - start,
+            _size(content),
+            _size(rendered_page))
+    return rendered_page
@@ -0,0 +1,61 @@
+const DOMPurify = require('isomorphic-dompurify')
+const katex = require('katex')
+const { performance } = require('perf_hooks')
+const readline = require('readline')
+
+const { render_latex } = require('./render_latex')
+
+function render_latex_and_sanitise(source) {
+    let latex_start = performance.now()
+    try {
+        var rendered = render_latex(source)
+    } catch (error) {
+        if (error instanceof katex.ParseError) {
+            console.error(error)
+            return {
+                stage: "latex",
+                status_code: 400,
+                body: DOMPurify.sanitize(error.message)
+            }
+        }
+        return {
+            stage: "latex",
+            status_code: 500,
+            body: "An unexpected error occurred"
+        }
+    }
+    let sanitise_start = performance.now()
+    try {
+        var sanitised = DOMPurify.sanitize(rendered)
+    } catch (error) {
+        return {
+            stage: "sanitise",
+            status_code: 500,
+            body: "An unexpected error occurred when sanitising"
+        }
+    }
+    // Durations in seconds, and output sizes in bytes, of the LaTeX rendering
+    // and the sanitising, which are recorded by render_engine
+    return {
+        stage: "sanitise",
+        status_code: 200,
+        body: sanitised,
+        timings: {
+            render_latex: {
+                seconds: (sanitise_start - latex_start) / 1000,
+                output_bytes: Buffer.byteLength(rendered)
+            },
+            sanitise: {
+                seconds: (performance.now() - sanitise_start) / 1000,
+                output_bytes: Buffer.byteLength(sanitised)
+            }
+        }
+    }
+}
+
+readline.createInterface({ input: process.stdin, terminal: false })
+    .on("line", line => {
+        let request = JSON.parse(line)
+        process.stdout.write(
+            JSON.stringify(render_latex_and_sanitise(request.source)) + "\n")
+    })
@@ -1,6 +1,29 @@
+const crypto = require('crypto')
 const DOMPurify = require('isomorphic-dompurify')
+const fs = require('fs')
 const katex = require('katex')
 const html_parser = require('node-html-parser')
+const os = require('os')
+const path = require('path')
+
+// Rendered formulas are cached in memory, and in files in /tmp, which are
+// shared by every process of the lambda environment, such as the render engine
+// workers of build_site. Both last only as long as the environment. The
+// version of KaTeX is part of the key, so that a new version is never served
+// formulas rendered by an old one. The files are kept to at most
+// max_formula_cache_directory_bytes, the least recently used being removed
+// first, so that they never fill /tmp
+const formula_cache_directory = path.join(
+    process.env.KATEX_CACHE_DIRECTORY || os.tmpdir(),
+    "katex_formulas")
+const max_cached_formulas = 20000
+const cached_formulas = new Map()
+const max_formula_cache_directory_bytes = 64 * 1024 * 1024
+// The directory is swept after this many bytes have been written to it by
+// this process, and when the process first writes to it, since other processes
+// may have filled it already
+const formula_cache_sweep_bytes = max_formula_cache_directory_bytes / 16
+let bytes_written_since_sweep = formula_cache_sweep_bytes
 
 function handle_cors(event) {
     headers = {}
@@ -61,24 +84,176 @@ function extract_source(event) {
 	null ]
 }
 
+function formula_cache_key(latex, display_mode) {
+    return crypto.createHash("sha256")
+        .update(katex.version + "\n" + display_mode + "\n" + latex)
+        .digest("hex")
+}
+
+function read_cached_formula(key) {
+    // The modification time of a file is when it was last used, which is
+    // what it is evicted by
+    let file = path.join(formula_cache_directory, key)
+    try {
+        var rendered = fs.readFileSync(file, "utf8")
+    } catch (error) {
+        return null
+    }
+    try {
+        let now = new Date()
+        fs.utimesSync(file, now, now)
+    } catch (error) {
+    }
+    return rendered
+}
+
+function sweep_formula_cache() {
+    // Removes the least recently used files until those left take up at most
+    // half of max_formula_cache_directory_bytes. Another process may remove a
+    // file at the same time, which is harmless
+    let files = []
+    let total_bytes = 0
+    for (let name of fs.readdirSync(formula_cache_directory)) {
+        if (name.endsWith(".tmp")) {
+            continue
+        }
+        try {
+            var stats = fs.statSync(path.join(formula_cache_directory, name))
+        } catch (error) {
+            continue
+        }
+        files.push([ stats.mtimeMs, stats.size, name ])
+        total_bytes += stats.size
+    }
+    if (total_bytes <= max_formula_cache_directory_bytes) {
+        return
+    }
+    files.sort((first, second) => first[0] - second[0])
+    for (let [ _, size, name ] of files) {
+        if (total_bytes <= max_formula_cache_directory_bytes / 2) {
+            break
+        }
+        try {
+            fs.unlinkSync(path.join(formula_cache_directory, name))
+        } catch (error) {
+        }
+        total_bytes -= size
+    }
+}
+
+function write_cached_formula(key, rendered) {
+    // Written to a temporary file and renamed, so that another process never
+    // reads a formula which is only partly written. The cache is only an
+    // optimisation, so a failure, for instance if /tmp is full, is ignored
+    let temporary_file = path.join(
+        formula_cache_directory,
+        key + "." + process.pid + ".tmp")
+    try {
+        fs.mkdirSync(formula_cache_directory, { recursive: true })
+        fs.writeFileSync(temporary_file, rendered)
+        fs.renameSync(temporary_file, path.join(formula_cache_directory, key))
+        bytes_written_since_sweep += Buffer.byteLength(rendered)
+        if (bytes_written_since_sweep >= formula_cache_sweep_bytes) {
+            bytes_written_since_sweep = 0
+            sweep_formula_cache()
+        }
+    } catch (error) {
+        console.error("Could not cache formula: " + error.message)
+    }
+}
+
+function remember_formula(key, rendered) {
+    // The least recently used formula is forgotten, a Map iterating in the
+    // order in which its keys were inserted
+    cached_formulas.delete(key)
+    cached_formulas.set(key, rendered)
+    if (cached_formulas.size > max_cached_formulas) {
+        cached_formulas.delete(cached_formulas.keys().next().value)
+    }
+}
+
+// Formulas which cannot be rendered are never cached, so that the ParseError
+// is thrown again every time
+function render_formula(latex, display_mode) {
+    let key = formula_cache_key(latex, display_mode)
+    let rendered = cached_formulas.get(key)
+    if (rendered === undefined) {
+        rendered = read_cached_formula(key)
+    }
+    if (rendered === null) {
+        rendered = katex.renderToString(
+            latex,
+            {
+                displayMode: display_mode,
+                throwOnError: true
+            }
+        )
+        write_cached_formula(key, rendered)
+    }
+    remember_formula(key, rendered)
+    return rendered
+}
+
+// Each distinct formula of a page is only rendered, or looked up in the cache,
+// once
+function page_formula_renderer() {
+    let page_formulas = new Map()
+    return (latex, display_mode) => {
+        let page_key = (display_mode ? "display\n" : "inline\n") + latex
+        let rendered = page_formulas.get(page_key)
+        if (rendered === undefined) {
+            rendered = render_formula(latex, display_mode)
+            page_formulas.set(page_key, rendered)
+        }
+        return rendered
+    }
+}
+
+// The number of a displayed equation, if the page was numbered when it was
+// parsed, which precedes the equation within its span
+function equation_number_html(equation_number) {
+    if (!equation_number) {
+        return ""
+    }
+    return "<span class=\"equation\">(" + equation_number + ")</span>"
+}
+
+// A document in the structured format of parse_nlab_source, of HTML fragments
+// and the formulas to be rendered between them. The rendered formulas are
+// spliced in between the fragments, without the HTML being parsed
+function render_structured_latex(document) {
+    let render_page_formula = page_formula_renderer()
+    let parts = [ document.fragments[0] ]
+    document.formulas.forEach((formula, index) => {
+        parts.push(equation_number_html(formula.equation_number))
+        parts.push(render_page_formula(formula.latex, formula.display_mode))
+        parts.push(document.fragments[index + 1])
+    })
+    return parts.join("")
+}
+
 function render_latex(source) {
+    if (typeof source !== "string") {
+        return render_structured_latex(source)
+    }
+    let render_page_formula = page_formula_renderer()
     var html_source = html_parser.parse(source)
     html_source.querySelectorAll(".latex").forEach(latex_source_span => {
         var display_mode = false
         if (latex_source_span.getAttribute("data-display-mode")) {
             display_mode = true
         }
-        latex_source_span.innerHTML = katex.renderToString(
-            latex_source_span.getAttribute("data-latex"),
-            {
-                displayMode: display_mode,
-                throwOnError: true
-            }
-        )
+        latex_source_span.innerHTML = equation_number_html(
+            latex_source_span.getAttribute("data-equation-number")) +
+            render_page_formula(
+                latex_source_span.getAttribute("data-latex"),
+                display_mode)
     })
     return html_source.innerHTML
 }
 
+exports.render_latex = render_latex
+
 exports.handler = async (event) => {
     let [ cors_response, headers ] = handle_cors(event)
     if (cors_response) {
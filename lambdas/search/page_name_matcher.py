@@ -0,0 +1,698 @@
+import itertools
+import re
+import time
+
+"""
+Matches a search expression, a regular expression in the syntax of the re
+module, against page names, in a time linear in the length of each page name,
+whatever the expression.
+
+The re module backtracks, so that an expression such as (a+)+$ takes a time
+exponential in the length of a page name which it fails to match. Instead, the
+expression is parsed here, and compiled to a non-deterministic automaton, which
+is run on each page name with every state it can be in tracked at once. The
+sets of states reached, and the transitions between them, are cached, so that
+the automaton is in effect turned into a deterministic one, a state at a time,
+as it is needed. The expression, the automaton and the cache are all of bounded
+size, so that no expression can take too much time or memory before the page
+names are even matched.
+
+Only the part of the syntax of the re module which does not need backtracking
+is supported: backreferences, lookahead and lookbehind assertions, inline flags
+and possessive quantifiers are not. An expression which contains them, or which
+is not a valid regular expression, is rejected.
+
+As has always been the case for search, a first character of the expression
+which is an ASCII letter matches both its lower and upper case. Whether an
+expression matches a page name is otherwise as for re.search.
+
+Many expressions are in fact a piece of text, or a piece of text which page
+names must begin with. These are recognised, so that they can be matched
+without the automaton. For the rest, text which every match contains is found
+where possible, so that the automaton need only be run on the page names which
+contain it. Pieces of text are searched for by the re module, with an
+expression which only lists them, and so cannot backtrack.
+"""
+
+_max_expression_length = 1000
+_max_states = 10000
+_max_cached_states = 10000
+_max_literals = 16
+
+_start = 0
+_word = 1
+_other = 2
+_end = 0
+
+class InvalidSearchExpressionException(Exception):
+    pass
+
+class UnsupportedSearchExpressionException(InvalidSearchExpressionException):
+    pass
+
+class SearchTimedOutException(Exception):
+    pass
+
+def _is_word_character(character):
+    return character.isalnum() or (character == "_")
+
+def _kind(character):
+    if character is None:
+        return _end
+    return _word if _is_word_character(character) else _other
+
+_classes = {
+    "d": lambda character: character.isdecimal(),
+    "D": lambda character: not character.isdecimal(),
+    "s": lambda character: character.isspace(),
+    "S": lambda character: not character.isspace(),
+    "w": _is_word_character,
+    "W": lambda character: not _is_word_character(character)
+}
+
+_character_escapes = {
+    "a": "\a",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+    "v": "\v"
+}
+
+_assertion_escapes = {
+    "A": "start",
+    "b": "word_boundary",
+    "B": "not_word_boundary",
+    "Z": "end"
+}
+
+"""
+The characters matched by a single character of an expression: a character
+itself, a . or a set of characters such as [a-z\\d].
+"""
+class _CharacterSet:
+    def __init__(self, characters = (), negated = False):
+        self.characters = set(characters)
+        self.ranges = []
+        self.classes = []
+        self.negated = negated
+        self.everything_but_newlines = False
+
+    def matches(self, character):
+        if self.everything_but_newlines:
+            return character != "\n"
+        matched = (character in self.characters) or \
+            any(low <= character <= high for low, high in self.ranges) or \
+            any(in_class(character) for in_class in self.classes)
+        return matched != self.negated
+
+    def literals(self):
+        # The characters matched, if there are few enough of them to be listed
+        if self.negated or self.everything_but_newlines or self.classes or \
+                (len(self.characters) > _max_literals):
+            return None
+        characters = set(self.characters)
+        for low, high in self.ranges:
+            if len(characters) + ord(high) - ord(low) >= _max_literals:
+                return None
+            characters.update(
+                chr(code) for code in range(ord(low), ord(high) + 1))
+        return sorted(characters)
+
+"""
+Parses a search expression into a tree, the nodes of which are tuples whose
+first element is one of "characters", "empty", "concatenation", "alternation",
+"repetition" and "assertion".
+"""
+class _Parser:
+    def __init__(self, expression):
+        self.expression = expression
+        self.position = 0
+
+    def _peek(self):
+        if self.position < len(self.expression):
+            return self.expression[self.position]
+        return None
+
+    def _next(self):
+        character = self._peek()
+        if character is None:
+            raise InvalidSearchExpressionException(
+                "The search expression ends unexpectedly")
+        self.position += 1
+        return character
+
+    def parse(self):
+        tree = self._alternation()
+        if self._peek() is not None:
+            raise InvalidSearchExpressionException(
+                "Unbalanced parenthesis at position {}".format(self.position))
+        return tree
+
+    def _alternation(self):
+        branches = [ self._concatenation() ]
+        while self._peek() == "|":
+            self.position += 1
+            branches.append(self._concatenation())
+        if len(branches) == 1:
+            return branches[0]
+        return ("alternation", branches)
+
+    def _concatenation(self):
+        items = []
+        while self._peek() not in [ None, "|", ")" ]:
+            if self._peek() in [ "*", "+", "?" ] or self._is_repetition():
+                raise InvalidSearchExpressionException(
+                    "Nothing to repeat at position {}".format(self.position))
+            # A group containing only an assertion can be repeated, as in the
+            # re module, but an assertion itself can not
+            grouped = (self._peek() == "(")
+            item = self._atom()
+            if self._peek() in [ "*", "+", "?" ] or self._is_repetition():
+                if (item[0] == "assertion") and not grouped:
+                    raise InvalidSearchExpressionException(
+                        "Nothing to repeat at position {}".format(
+                            self.position))
+                item = self._repetition(item)
+            items.append(item)
+        if not items:
+            return ("empty",)
+        if len(items) == 1:
+            return items[0]
+        return ("concatenation", items)
+
+    def _repetition_bounds(self):
+        # The bounds of a {m,n} at the position, or None if there is not one
+        # there, in which case the { is an ordinary character
+        if self._peek() != "{":
+            return None
+        end = self.expression.find("}", self.position)
+        if end == -1:
+            return None
+        bounds = self.expression[self.position + 1:end].split(",")
+        if (len(bounds) > 2) or \
+                not all(bound.isdigit() or (bound == "") for bound in bounds) \
+                or (bounds[0] == "" and len(bounds) == 1):
+            return None
+        if not all(bound.isascii() for bound in bounds):
+            return None
+        minimum = int(bounds[0]) if bounds[0] else 0
+        if len(bounds) == 1:
+            maximum = minimum
+        else:
+            maximum = int(bounds[1]) if bounds[1] else None
+        return minimum, maximum, end + 1
+
+    def _is_repetition(self):
+        return self._repetition_bounds() is not None
+
+    def _repetition(self, item):
+        quantifier = self._peek()
+        if quantifier == "{":
+            minimum, maximum, self.position = self._repetition_bounds()
+            if (maximum is not None) and (maximum < minimum):
+                raise InvalidSearchExpressionException(
+                    "Minimum repeat greater than maximum repeat")
+        else:
+            self.position += 1
+            minimum, maximum = {
+                "*": (0, None),
+                "+": (1, None),
+                "?": (0, 1)
+            }[quantifier]
+        # Whether a repetition is lazy makes no difference to whether there is
+        # a match, whereas a possessive one needs backtracking to be cut short
+        if self._peek() == "?":
+            self.position += 1
+        elif self._peek() == "+":
+            raise UnsupportedSearchExpressionException(
+                "Possessive repetitions are not supported in search")
+        if self._peek() in [ "*", "+", "?" ] or self._is_repetition():
+            raise InvalidSearchExpressionException(
+                "Multiple repeat at position {}".format(self.position))
+        return ("repetition", item, minimum, maximum)
+
+    def _atom(self):
+        at_start = (self.position == 0)
+        character = self._next()
+        if character == "(":
+            return self._group()
+        if character == "[":
+            return ("characters", self._character_set())
+        if character == ".":
+            character_set = _CharacterSet()
+            character_set.everything_but_newlines = True
+            return ("characters", character_set)
+        if character == "^":
+            return ("assertion", "start")
+        if character == "$":
+            return ("assertion", "end")
+        if character == "\\":
+            return self._escape()
+        if at_start and character.isascii() and character.isalpha():
+            return (
+                "characters",
+                _CharacterSet([ character.lower(), character.upper() ]))
+        return ("characters", _CharacterSet([ character ]))
+
+    def _group(self):
+        if self._peek() == "?":
+            self.position += 1
+            kind = self._next()
+            if kind == ":":
+                pass
+            elif (kind == "P") and (self._peek() == "<"):
+                end = self.expression.find(">", self.position)
+                if end == -1:
+                    raise InvalidSearchExpressionException(
+                        "Missing > in a group name")
+                self.position = end + 1
+            elif kind == "#":
+                end = self.expression.find(")", self.position)
+                if end == -1:
+                    raise InvalidSearchExpressionException(
+                        "Missing ) in a comment")
+                self.position = end + 1
+                return ("empty",)
+            else:
+                raise UnsupportedSearchExpressionException(
+                    "Groups beginning with (?{} are not supported ".format(
+                        kind) +
+                    "in search")
+        tree = self._alternation()
+        if self._peek() != ")":
+            raise InvalidSearchExpressionException(
+                "Missing ), unterminated subpattern")
+        self.position += 1
+        return tree
+
+    def _escaped_character(self, escaped):
+        # The character denoted by an escape which denotes a single character,
+        # or None
+        if escaped in _character_escapes:
+            return _character_escapes[escaped]
+        for prefix, digits in [ ("x", 2), ("u", 4), ("U", 8) ]:
+            if escaped == prefix:
+                code = self.expression[self.position:self.position + digits]
+                if (len(code) != digits) or any(
+                        digit not in "0123456789abcdefABCDEF"
+                        for digit in code):
+                    raise InvalidSearchExpressionException(
+                        "Incomplete escape \\{}{}".format(prefix, code))
+                self.position += digits
+                try:
+                    return chr(int(code, 16))
+                except (OverflowError, ValueError):
+                    raise InvalidSearchExpressionException(
+                        "Bad escape \\{}{}".format(prefix, code))
+        if escaped.isdigit():
+            raise UnsupportedSearchExpressionException(
+                "Backreferences and octal escapes are not supported in search")
+        if escaped.isascii() and escaped.isalpha():
+            return None
+        return escaped
+
+    def _escape(self):
+        escaped = self._next()
+        if escaped in _assertion_escapes:
+            return ("assertion", _assertion_escapes[escaped])
+        character_set = _CharacterSet()
+        if escaped in _classes:
+            character_set.classes.append(_classes[escaped])
+            return ("characters", character_set)
+        character = self._escaped_character(escaped)
+        if character is None:
+            raise InvalidSearchExpressionException(
+                "Bad escape \\{}".format(escaped))
+        return ("characters", _CharacterSet([ character ]))
+
+    def _set_member(self):
+        # A single character of a set, or None if it is a class such as \d,
+        # which is then added to the set
+        character = self._next()
+        if character != "\\":
+            return character, None
+        escaped = self._next()
+        if escaped in _classes:
+            return None, _classes[escaped]
+        if escaped == "b":
+            return "\b", None
+        character = self._escaped_character(escaped)
+        if character is None:
+            raise InvalidSearchExpressionException(
+                "Bad escape \\{}".format(escaped))
+        return character, None
+
+    def _character_set(self):
+        character_set = _CharacterSet()
+        if self._peek() == "^":
+            self.position += 1
+            character_set.negated = True
+        first = True
+        while True:
+            if self._peek() is None:
+                raise InvalidSearchExpressionException(
+                    "Unterminated character set")
+            if (self._peek() == "]") and not first:
+                self.position += 1
+                return character_set
+            first = False
+            low, in_class = self._set_member()
+            if in_class is not None:
+                character_set.classes.append(in_class)
+                continue
+            if (self._peek() == "-") and \
+                    (self.expression[self.position + 1:self.position + 2]
+                        not in [ "", "]" ]):
+                self.position += 1
+                high, in_class = self._set_member()
+                if in_class is not None:
+                    raise InvalidSearchExpressionException(
+                        "Bad character range")
+                if high < low:
+                    raise InvalidSearchExpressionException(
+                        "Bad character range {}-{}".format(low, high))
+                character_set.ranges.append((low, high))
+            else:
+                character_set.characters.add(low)
+
+def _bounded_product(alternatives, more_alternatives):
+    # Every concatenation of one of the first alternatives with one of the
+    # second, or None if there are too many
+    if len(alternatives) * len(more_alternatives) > _max_literals:
+        return None
+    return [
+        first + second
+        for first, second in itertools.product(
+            alternatives,
+            more_alternatives)
+    ]
+
+def _literals(tree):
+    # The strings matched by the tree, if it matches only a few, none of them
+    # with an assertion, or None
+    kind = tree[0]
+    if kind == "characters":
+        return tree[1].literals()
+    if kind == "empty":
+        return [ "" ]
+    if kind == "concatenation":
+        literals = [ "" ]
+        for item in tree[1]:
+            item_literals = _literals(item)
+            if item_literals is None:
+                return None
+            literals = _bounded_product(literals, item_literals)
+            if literals is None:
+                return None
+        return literals
+    if kind == "alternation":
+        literals = []
+        for branch in tree[1]:
+            branch_literals = _literals(branch)
+            if branch_literals is None:
+                return None
+            literals.extend(branch_literals)
+        literals = list(dict.fromkeys(literals))
+        return literals if len(literals) <= _max_literals else None
+    if (kind == "repetition") and (tree[2] == tree[3]) and \
+            (tree[2] <= _max_expression_length):
+        item_literals = _literals(tree[1])
+        if item_literals is None:
+            return None
+        literals = [ "" ]
+        for _ in range(tree[2]):
+            literals = _bounded_product(literals, item_literals)
+            if literals is None:
+                return None
+        return literals
+    return None
+
+def _literals_regex(literals):
+    return re.compile("|".join(re.escape(literal) for literal in literals))
+
+def _shortest(literals):
+    return min(len(literal) for literal in literals)
+
+def _required_literals(tree):
+    # Strings one of which every match of the tree contains, the longer the
+    # better. [ "" ] if none are known
+    literals = _literals(tree)
+    if literals is not None:
+        return literals
+    kind = tree[0]
+    if kind == "concatenation":
+        # Runs of items with literals, between which assertions, which match
+        # no characters, make no difference
+        candidates = []
+        run = [ "" ]
+        for item in tree[1]:
+            if item[0] == "assertion":
+                continue
+            item_literals = _literals(item)
+            if item_literals is not None:
+                longer_run = _bounded_product(run, item_literals)
+                if longer_run is not None:
+                    run = longer_run
+                    continue
+                candidates.append(run)
+                run = item_literals
+                continue
+            candidates.append(run)
+            candidates.append(_required_literals(item))
+            run = [ "" ]
+        candidates.append(run)
+        return max(candidates, key = _shortest)
+    if kind == "alternation":
+        literals = []
+        for branch in tree[1]:
+            literals.extend(_required_literals(branch))
+        literals = list(dict.fromkeys(literals))
+        return literals if len(literals) <= _max_literals else [ "" ]
+    if (kind == "repetition") and (tree[2] >= 1):
+        return _required_literals(tree[1])
+    return [ "" ]
+
+"""
+A non-deterministic automaton compiled from the tree of an expression. Each
+state is either a character set, followed by a single state, a list of states
+which may follow it without a character being matched, an assertion followed by
+a single state, or the state in which the expression has matched.
+"""
+class _Automaton:
+    def __init__(self, tree):
+        self.kinds = []
+        self.arguments = []
+        self.following = []
+        self.matched = self._add("matched", None, None)
+        self.start = self._compile(tree, self.matched)
+
+    def _add(self, kind, argument, following):
+        if len(self.kinds) >= _max_states:
+            raise InvalidSearchExpressionException(
+                "The search expression is too complex")
+        self.kinds.append(kind)
+        self.arguments.append(argument)
+        self.following.append(following)
+        return len(self.kinds) - 1
+
+    def _compile(self, tree, following):
+        # Returns the first state of the tree, followed by following. The
+        # states are added from the last to the first
+        kind = tree[0]
+        if kind == "characters":
+            return self._add("characters", tree[1], following)
+        if kind == "empty":
+            return following
+        if kind == "assertion":
+            return self._add("assertion", tree[1], following)
+        if kind == "concatenation":
+            for item in reversed(tree[1]):
+                following = self._compile(item, following)
+            return following
+        if kind == "alternation":
+            return self._add(
+                "split",
+                None,
+                [ self._compile(branch, following) for branch in tree[1] ])
+        _, item, minimum, maximum = tree
+        if maximum is None:
+            loop = self._add("split", None, None)
+            self.following[loop] = [ self._compile(item, loop), following ]
+            following = loop
+        else:
+            for _ in range(maximum - minimum):
+                following = self._add(
+                    "split",
+                    None,
+                    [ self._compile(item, following), following ])
+        for _ in range(minimum):
+            start = self._compile(item, following)
+            if start == following:
+                # The item matches nothing but the empty string
+                break
+            following = start
+        return following
+
+    def _holds(self, assertion, previous_kind, next_kind):
+        if assertion == "start":
+            return previous_kind == _start
+        if assertion == "end":
+            return next_kind == _end
+        at_boundary = (previous_kind == _word) != (next_kind == _word)
+        if assertion == "word_boundary":
+            return at_boundary
+        # As in the re module, \B never holds in an empty page name
+        return (not at_boundary) and \
+            not ((previous_kind == _start) and (next_kind == _end))
+
+    def closure(self, states, previous_kind, next_kind):
+        # The character states reached from the states without a character
+        # being matched, between characters of the kinds given, and whether
+        # the matched state is reached
+        reached = set()
+        character_states = []
+        pending = list(states)
+        while pending:
+            state = pending.pop()
+            if state in reached:
+                continue
+            reached.add(state)
+            kind = self.kinds[state]
+            if kind == "matched":
+                return character_states, True
+            if kind == "characters":
+                character_states.append(state)
+            elif kind == "split":
+                pending.extend(self.following[state])
+            elif self._holds(
+                    self.arguments[state],
+                    previous_kind,
+                    next_kind):
+                pending.append(self.following[state])
+        return character_states, False
+
+"""
+A set of states of the automaton reached after some characters of a page name,
+together with the kind of the last of them. Its transitions, on each character
+seen after it, are cached.
+"""
+class _SearchState:
+    def __init__(self, states, previous_kind):
+        self.states = states
+        self.previous_kind = previous_kind
+        self.transitions = dict()
+        self.matches_at_end = None
+        self.cached = False
+
+_matched = object()
+_unmatched = object()
+
+"""
+A compiled search expression.
+
+If the expression is only a few pieces of text, one of which page names must
+begin with, prefixes is a list of them; if it is only a few pieces of text, one
+of which page names must contain, literals_regex searches for them. Otherwise
+both are None, and matches should be called for each page name.
+"""
+class PageNameMatcher:
+    def __init__(self, search_expression):
+        if len(search_expression) > _max_expression_length:
+            raise InvalidSearchExpressionException(
+                "The search expression is too long")
+        tree = _Parser(search_expression).parse()
+        self.automaton = _Automaton(tree)
+        self.prefixes = None
+        # A match of an expression beginning with ^ can only begin at the
+        # beginning of a page name
+        self.anchored = (tree == ("assertion", "start"))
+        if (tree[0] == "concatenation") and \
+                (tree[1][0] == ("assertion", "start")):
+            self.prefixes = _literals(("concatenation", tree[1][1:]))
+            self.anchored = True
+        literals = _literals(tree)
+        self.literals_regex = None
+        if literals is not None:
+            self.literals_regex = _literals_regex(literals)
+        # Of no use if one of them is empty
+        required_literals = _required_literals(tree)
+        self.required_literals_regex = None
+        if all(required_literals):
+            self.required_literals_regex = _literals_regex(required_literals)
+        self.search_states = dict()
+        self.initial_search_state = self._search_state(
+            frozenset([ self.automaton.start ]),
+            _start)
+
+    def _search_state(self, states, previous_kind):
+        # Once too many have been cached, the states reached are no longer
+        # cached, so that matching continues, as slowly as the automaton itself
+        # runs, in bounded memory
+        key = (states, previous_kind)
+        search_state = self.search_states.get(key)
+        if search_state is not None:
+            return search_state
+        search_state = _SearchState(states, previous_kind)
+        if len(self.search_states) < _max_cached_states:
+            self.search_states[key] = search_state
+            search_state.cached = True
+        return search_state
+
+    def _transition(self, search_state, character):
+        next_kind = _kind(character)
+        character_states, matched = self.automaton.closure(
+            search_state.states,
+            search_state.previous_kind,
+            next_kind)
+        if matched:
+            return _matched
+        states = set(
+            self.automaton.following[state]
+            for state in character_states
+            if self.automaton.arguments[state].matches(character))
+        # Otherwise, the expression may begin to match at any character
+        if self.anchored:
+            if not states:
+                if search_state.cached:
+                    search_state.transitions[character] = _unmatched
+                return _unmatched
+        else:
+            states.add(self.automaton.start)
+        next_search_state = self._search_state(frozenset(states), next_kind)
+        if search_state.cached:
+            search_state.transitions[character] = next_search_state
+        return next_search_state
+
+    def _matches_at_end(self, search_state):
+        if search_state.matches_at_end is None:
+            search_state.matches_at_end = self.automaton.closure(
+                search_state.states,
+                search_state.previous_kind,
+                _end)[1]
+        return search_state.matches_at_end
+
+    def matches(self, page_name, deadline = None):
+        # Whether re.search would find a match of the expression in the page
+        # name. If a deadline, a time.monotonic() time, is given, it is checked
+        # before the page name is matched, and before every transition which is
+        # not cached, since each of those may take a time proportional to the
+        # size of the automaton
+        if (deadline is not None) and (time.monotonic() > deadline):
+            raise SearchTimedOutException()
+        if (self.required_literals_regex is not None) and \
+                (self.required_literals_regex.search(page_name) is None):
+            return False
+        search_state = self.initial_search_state
+        for character in page_name:
+            try:
+                search_state = search_state.transitions[character]
+            except KeyError:
+                if (deadline is not None) and (time.monotonic() > deadline):
+                    raise SearchTimedOutException()
+                search_state = self._transition(search_state, character)
+            if search_state is _matched:
+                return True
+            if search_state is _unmatched:
+                return False
+        return self._matches_at_end(search_state)
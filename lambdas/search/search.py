@@ -1,32 +1,112 @@
+import bisect
 import boto3
+import botocore.exceptions
 import json
 import os
-import re
-import string
+import time
+
+import page_name_matcher
 
 _s3_client = boto3.client("s3")
 
 _all_page_names_url = os.environ["ALL_PAGE_NAMES_URL"]
 _pages_bucket_name = os.environ["PAGES_BUCKET_NAME"]
 
+# The list of all pages is held between invocations, and only revalidated
+# against S3 once this long has passed since it last was
+_revalidation_seconds = 10
+# Page names are matched against an expression for at most this long
+_search_seconds = 2
+
 class NoSearchExpressionException(Exception):
     pass
 
+"""
+The names of all pages, written by update_all_pages_list, held across
+invocations of the lambda. The list is fetched again only if its ETag has
+changed, and otherwise S3 returns no body at all. The names are also held in
+order, with the position of each in the list, so that the names beginning with
+some text are found by a binary search.
+"""
+class _AllPageNames:
+    def __init__(self):
+        self.etag = None
+        self.revalidated_at = None
+        self.page_names = []
+        self.sorted_page_names = []
+        self.sorted_positions = []
+
+    def _load(self, response):
+        self.etag = response["ETag"]
+        self.page_names = [
+            page_name
+            for page_name in response["Body"].read().decode("utf-8").split("\n")
+            if page_name
+        ]
+        self.sorted_positions = sorted(
+            range(len(self.page_names)),
+            key = self.page_names.__getitem__)
+        self.sorted_page_names = [
+            self.page_names[position] for position in self.sorted_positions
+        ]
+
+    def current(self):
+        now = time.monotonic()
+        if (self.revalidated_at is not None) and \
+                (now - self.revalidated_at < _revalidation_seconds):
+            return self
+        conditions = dict()
+        if self.etag is not None:
+            conditions["IfNoneMatch"] = self.etag
+        try:
+            self._load(_s3_client.get_object(
+                Bucket = _pages_bucket_name,
+                Key = _all_page_names_url,
+                **conditions))
+        except botocore.exceptions.ClientError as exception:
+            if exception.response["Error"]["Code"] not in [
+                    "304",
+                    "NotModified" ]:
+                raise exception
+        self.revalidated_at = now
+        return self
+
+    def beginning_with(self, prefixes):
+        # In the order of the list
+        positions = []
+        for prefix in prefixes:
+            index = bisect.bisect_left(self.sorted_page_names, prefix)
+            while (index < len(self.sorted_page_names)) and \
+                    self.sorted_page_names[index].startswith(prefix):
+                positions.append(self.sorted_positions[index])
+                index += 1
+        return [
+            self.page_names[position]
+            for position in sorted(set(positions))
+        ]
+
+_all_page_names = _AllPageNames()
+
+def _matching(page_names, matcher):
+    deadline = time.monotonic() + _search_seconds
+    return [
+        page_name for page_name in page_names
+        if matcher.matches(page_name, deadline)
+    ]
+
 def search(search_expression):
-    all_page_names = _s3_client.get_object(
-        Bucket = _pages_bucket_name,
-        Key = _all_page_names_url)["Body"].read().decode("utf-8").split("\n")
     if not search_expression:
         raise NoSearchExpressionException()
-    if search_expression[0] in string.ascii_letters:
-        search_expression = "[{}|{}]{}".format(
-            search_expression[0].lower(),
-            search_expression[0].upper(),
-            search_expression[1:])
-    search_regex = re.compile(search_expression)
-    return json.dumps([
-        page_name for page_name in all_page_names if search_regex.search(
-            page_name)])
+    matcher = page_name_matcher.PageNameMatcher(search_expression)
+    all_page_names = _all_page_names.current()
+    if matcher.prefixes is not None:
+        return json.dumps(all_page_names.beginning_with(matcher.prefixes))
+    if matcher.literals_regex is not None:
+        return json.dumps([
+            page_name for page_name in all_page_names.page_names
+            if matcher.literals_regex.search(page_name)
+        ])
+    return json.dumps(_matching(all_page_names.page_names, matcher))
 
 def _handle_cors(event):
     headers = dict()
@@ -77,6 +157,22 @@ def lambda_handler(event, context):
             "headers": headers,
             "body": "No search expression provided"
         }
+    except page_name_matcher.InvalidSearchExpressionException as exception:
+        headers["Content-Type"] = "text/plain"
+        return {
+            "isBase64Encoded": False,
+            "statusCode": 400,
+            "headers": headers,
+            "body": "Invalid search expression: {}".format(exception)
+        }
+    except page_name_matcher.SearchTimedOutException:
+        headers["Content-Type"] = "text/plain"
+        return {
+            "isBase64Encoded": False,
+            "statusCode": 400,
+            "headers": headers,
+            "body": "The search expression took too long to match"
+        }
     except Exception:
         headers["Content-Type"] = "text/plain"
         return {
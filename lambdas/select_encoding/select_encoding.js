@@ -0,0 +1,49 @@
+// A CloudFront Function, associated with viewer requests, which serves the
+// brotli-encoded variant of a page, source or page fragment stored by
+// store_edit to clients which accept brotli. All other clients are served the
+// gzip-encoded object itself. CloudFront Functions only support ECMAScript
+// 5.1, so there is no let, const, or arrow functions here. The cache policy of
+// the distribution must include the Accept-Encoding header (normalised by
+// CloudFront) in the cache key.
+
+var BROTLI_VARIANTS_ROOT_URL = "/nlab/brotli"
+// The sources of the history are not here: once store_edit stores them as
+// delta chunks (DELTA_HISTORY_SOURCES_ROOT_URL), /nlab/history/source/ is
+// routed to the history_sources lambda, and there are no brotli variants of
+// them. Without delta chunks, "/nlab/history/source/" may be added here
+var ENCODED_ROOT_URLS = [
+    "/nlab/show/",
+    "/nlab/source/",
+    "/nlab/fragment/",
+    "/nlab/history/show/"
+]
+
+function accepts_brotli(request) {
+    var accept_encoding = request.headers["accept-encoding"]
+    if (!accept_encoding) {
+        return false
+    }
+    var encodings = accept_encoding.value.split(",")
+    for (var i = 0; i < encodings.length; i++) {
+        var encoding = encodings[i].split(";")
+        if ((encoding[0].trim() == "br") &&
+                ((encoding.length == 1) || (encoding[1].trim() != "q=0"))) {
+            return true
+        }
+    }
+    return false
+}
+
+function handler(event) {
+    var request = event.request
+    if (!accepts_brotli(request)) {
+        return request
+    }
+    for (var i = 0; i < ENCODED_ROOT_URLS.length; i++) {
+        if (request.uri.startsWith(ENCODED_ROOT_URLS[i])) {
+            request.uri = BROTLI_VARIANTS_ROOT_URL + request.uri
+            return request
+        }
+    }
+    return request
+}
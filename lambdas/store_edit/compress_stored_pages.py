@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+
+import argparse
+
+import store_edit
+
+"""
+Compresses every page and source, current and in the history, which was stored
+before store_edit began to store them gzip-encoded, and writes its brotli
+variant. The page itself is not minified again. This should be run before
+select_encoding is associated with the CloudFront distribution, since otherwise
+clients accepting brotli would be sent to variants which do not yet exist.
+"""
+
+def _compress(key, dry_run):
+    response = store_edit._s3_client.get_object(
+        Bucket = store_edit._pages_bucket_name,
+        Key = key)
+    if response.get("ContentEncoding"):
+        return False
+    if not dry_run:
+        put_object_request = {
+            "ACL": "public-read",
+            "Body": response["Body"].read(),
+            "ContentType": response["ContentType"],
+            "Key": key
+        }
+        if response.get("CacheControl"):
+            put_object_request["CacheControl"] = response["CacheControl"]
+        store_edit._put_objects(
+            store_edit._encoded_put_object_requests(put_object_request))
+    return True
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description = "Compress every stored page and source")
+    argument_parser.add_argument(
+        "--dry-run",
+        action = "store_true",
+        help = "Only print the objects which would be compressed")
+    arguments = argument_parser.parse_args()
+    compressed = 0
+    for root_url in [
+            store_edit._pages_root_url,
+            store_edit._sources_root_url,
+            store_edit._history_pages_root_url,
+            store_edit._history_sources_root_url ]:
+        for key in store_edit.stored_keys(root_url):
+            if _compress(key, arguments.dry_run):
+                print(key)
+                compressed += 1
+    print("{} objects {}".format(
+        compressed,
+        "to compress" if arguments.dry_run else "compressed"))
+
+if __name__ == "__main__":
+    main()
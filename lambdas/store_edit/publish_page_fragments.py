@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+
+import argparse
+
+import store_edit
+
+"""
+Writes the content-only fragment of every current page which was stored before
+store_edit began to write them, from the stored page itself. Until then,
+includes.js and new_context_menus.js fall back to fetching the whole page. The
+pages and fragments are those of the environment in which this is run, so that
+the fragments of context pages are written by running this with the
+environment of the store_edit which stores them.
+"""
+
+def _page_name(page_key):
+    return page_key[len(store_edit._pages_root_url) + 1:]
+
+def _publish(page_key, fragment_keys, dry_run):
+    fragment_key = store_edit.current_keys(_page_name(page_key))[2]
+    if fragment_key in fragment_keys:
+        return False
+    if not dry_run:
+        store_edit._put_objects(
+            store_edit._encoded_put_object_requests({
+                "ACL": "public-read",
+                "Body": store_edit._page_fragment(
+                    store_edit._read_object(page_key)).encode("utf-8"),
+                "CacheControl": store_edit._current_cache_control,
+                "ContentType": "text/html",
+                "Key": fragment_key
+            }))
+    return True
+
+def main():
+    argument_parser = argparse.ArgumentParser(
+        description = "Write the fragment of every stored page")
+    argument_parser.add_argument(
+        "--dry-run",
+        action = "store_true",
+        help = "Only print the pages whose fragments would be written")
+    arguments = argument_parser.parse_args()
+    # The fragments which exist are listed once, rather than looked for page by
+    # page
+    fragment_keys = set(store_edit.stored_keys(store_edit._fragments_root_url))
+    published = 0
+    for page_key in store_edit.stored_keys(store_edit._pages_root_url):
+        if _publish(page_key, fragment_keys, arguments.dry_run):
+            print(page_key)
+            published += 1
+    print("{} fragments {}".format(
+        published,
+        "to write" if arguments.dry_run else "written"))
+
+if __name__ == "__main__":
+    main()
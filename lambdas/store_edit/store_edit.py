@@ -1,41 +1,96 @@
 import boto3
-import botocore
+import botocore.config
+import botocore.exceptions
+import concurrent.futures
 import datetime
+import fcntl
+import gzip
+import html
 import json
 import os
-import pathlib
-import random
 import re
 import requests
+import time
 import urllib.parse
 
-_s3_client = boto3.client("s3")
-_cloudfront_client = boto3.client("cloudfront")
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-_cloudfront_distribution_id = os.environ["CLOUDFRONT_DISTRIBUTION_ID"]
+import edit_rendering
+
+_max_storage_workers = 16
+_return_stage_timings = os.environ.get("RETURN_STAGE_TIMINGS") == "true"
+# Current pages and sources are cached by CloudFront until they are invalidated
+# (see flush_invalidations) after an edit, but always revalidated by browsers
+_current_cache_control = "max-age=0, s-maxage=86400"
+
+_s3_client = boto3.client(
+    "s3",
+    config = botocore.config.Config(
+        max_pool_connections = _max_storage_workers))
+_sqs_client = boto3.client("sqs")
+
+_brotli_variants_root_url = os.environ["BROTLI_VARIANTS_ROOT_URL"]
+_delta_history_sources_root_url = os.environ.get(
+    "DELTA_HISTORY_SOURCES_ROOT_URL")
 _diagrams_root_url = os.environ["DIAGRAMS_ROOT_URL"]
+_fragments_root_url = os.environ["FRAGMENTS_ROOT_URL"]
 _history_metadata_root_url = os.environ["HISTORY_METADATA_ROOT_URL"]
 _history_pages_root_url = os.environ["HISTORY_PAGES_ROOT_URL"]
 _history_sources_root_url = os.environ["HISTORY_SOURCES_ROOT_URL"]
+_include_index_root_url = os.environ.get("INCLUDE_INDEX_ROOT_URL")
+_include_refresh_queue_url = os.environ.get("INCLUDE_REFRESH_QUEUE_URL")
+_invalidation_queue_url = os.environ["INVALIDATION_QUEUE_URL"]
+_latest_revision_pointers_root_url = os.environ[
+    "LATEST_REVISION_POINTERS_ROOT_URL"]
 _latest_revision_root_url = os.environ["LATEST_REVISION_ROOT_URL"]
 _max_registered_seconds = int(os.environ["MAX_REGISTERED_SECONDS"])
-_new_diagram_root_url = os.environ["NEW_DIAGRAM_ROOT_URL"]
 _pages_bucket_name = os.environ["PAGES_BUCKET_NAME"]
 _pages_root_url = os.environ["PAGES_ROOT_URL"]
-_parse_source_root_url = os.environ["PARSE_SOURCE_ROOT_URL"]
-_render_latex_root_url = os.environ["RENDER_LATEX_ROOT_URL"]
-_render_page_root_url = os.environ["RENDER_PAGE_ROOT_URL"]
 _sources_root_url = os.environ["SOURCES_ROOT_URL"]
+_submit_locks_root_url = os.environ["SUBMIT_LOCKS_ROOT_URL"]
+
+# If DELTA_HISTORY_SOURCES_ROOT_URL is set, the sources of revisions are stored
+# by delta_history (see history_sources), which must then be packaged with this
+if _delta_history_sources_root_url:
+    import delta_history
+    _delta_history = delta_history.DeltaHistory(
+        _s3_client,
+        _pages_bucket_name,
+        _delta_history_sources_root_url,
+        _history_sources_root_url)
+else:
+    _delta_history = None
+
+# If INCLUDE_INDEX_ROOT_URL is set, the pages which a page includes are expanded
+# into it when it is stored, rather than fetched by includes.js, and the pages
+# which include each page are recorded, so that they are refreshed (see
+# refresh_includes) whenever it is stored. INCLUDE_REFRESH_QUEUE_URL must then
+# be set too
+_max_include_depth = 8
+_page_inclusion_regex = re.compile(
+    r"<div class=\"page_inclusion\"\s*" +
+    r"data-page-to-include=\"([^\"]*)\">\s*</div>")
+_expanded_page_inclusion_regex = re.compile(
+    r"<div class=\"page_inclusion\" data-page-to-include=\"([^\"]*)\" " +
+    r"data-included=\"true\">")
 
-_last_check_time = datetime.datetime.now()
-_latex_diagrams_regex = re.compile(
-    r"(\\begin{tikzpicture}(.*?)\\end{tikzpicture})|" +
-        r"(\\begin{tikzcd}(.*?)\\end{tikzcd})|" +
-        r"(\\begin{xymatrix}(.*?)\\end{xymatrix})",
-    re.DOTALL)
+_minification_tag_regex = re.compile(r"<(?:[^>\"']|\"[^\"]*\"|'[^']*')*>")
+_minification_tag_name_regex = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)")
+_minification_whitespace_regex = re.compile(r"[ \t\n\r\f]{2,}")
+_page_content_start = "<span class=\"page_content_start\"></span>"
+_page_content_end = "<span class=\"page_content_end\"></span>"
 
-_root_submit_path = "/tmp/submitted"
-pathlib.Path(_root_submit_path).mkdir(exist_ok = True)
+_whitespace_preserving_elements = [
+    "annotation",
+    "code",
+    "pre",
+    "script",
+    "style",
+    "textarea"
+]
 
 class AuthorSyntaxException(Exception):
     def __init__(self, message):
@@ -47,46 +102,118 @@ class EditConflictException(Exception):
 class FailedToCleanUpException(Exception):
     pass
 
-class FailedToRenderDiagramException(Exception):
-    def __init__(self, status_code, message):
-        super().__init__(message)
-        self.status_code = status_code
-
-class FailedToParseException(Exception):
-    def __init__(self, status_code, message):
-        super().__init__(message)
-        self.status_code = status_code
-
-class FailedToRenderException(Exception):
-    def __init__(self, status_code, message):
-        super().__init__(message)
-        self.status_code = status_code
-
-class FailedToRenderLatexException(Exception):
-    def __init__(self, status_code, message):
-        super().__init__(message)
-        self.status_code = status_code
-
 def _edit_time():
     return datetime.datetime.utcnow().strftime("%B %d, %Y at %H:%M:%S (UTC)")
 
-def _remove_too_old_submits():
-    global _last_check_time
-    now = datetime.datetime.now()
-    if (now - _last_check_time).seconds > _max_registered_seconds:
-        for filename in os.listdir(_root_submit_path):
-            submit_time = datetime.datetime.fromtimestamp(os.path.getmtime(
-                "{}/{}".format(_root_submit_path, filename)))
-            if (now - submit_time).seconds > _max_registered_seconds:
-                os.remove("{}/{}".format(_root_submit_path, filename))
-    _last_check_time = now
-
 def _validate(revision_metadata):
     if len(revision_metadata["author"]) > 100:
         raise AuthorSyntaxException(
             "At most 100 characters can be used in an author name")
 
+def _is_stale(acquire_time):
+    # A lock older than this was left by a store which never finished, or is
+    # for a sandbox page, which has no history, and so can be taken
+    return time.time() - acquire_time > _max_registered_seconds
+
+"""
+Submit locks, each an object holding the time at which it was acquired. A lock
+is acquired by a single atomic create-if-absent write, or, if it is stale, by a
+write conditional on its ETag being unchanged, so that exactly one of any
+number of concurrent submits succeeds either way.
+"""
+class _S3SubmitLocks:
+    def _put(self, key, **condition):
+        try:
+            _s3_client.put_object(
+                Body = str(time.time()).encode("utf-8"),
+                Bucket = _pages_bucket_name,
+                Key = "{}/{}".format(_submit_locks_root_url, key),
+                **condition)
+            return True
+        except botocore.exceptions.ClientError as exception:
+            if exception.response["Error"]["Code"] in [
+                    "ConditionalRequestConflict",
+                    "PreconditionFailed" ]:
+                return False
+            raise exception
+
+    def acquire(self, key):
+        if self._put(key, IfNoneMatch = "*"):
+            return
+        try:
+            response = _s3_client.get_object(
+                Bucket = _pages_bucket_name,
+                Key = "{}/{}".format(_submit_locks_root_url, key))
+        except _s3_client.exceptions.NoSuchKey:
+            # Released in the meantime
+            if self._put(key, IfNoneMatch = "*"):
+                return
+            raise EditConflictException()
+        try:
+            acquire_time = float(response["Body"].read().decode("utf-8"))
+        except ValueError:
+            # Locks written before they held their acquire time
+            acquire_time = response["LastModified"].timestamp()
+        if not _is_stale(acquire_time) or \
+                not self._put(key, IfMatch = response["ETag"]):
+            raise EditConflictException()
+
+    def release(self, key):
+        _s3_client.delete_object(
+            Bucket = _pages_bucket_name,
+            Key = "{}/{}".format(_submit_locks_root_url, key))
+
+"""
+Stand-in for _S3SubmitLocks with the same semantics, backed by a local
+directory, for use when running outside of AWS. Used when SUBMIT_LOCKS_ROOT_URL
+is a file:// URL. A lock is a file, the modification time of which is the time
+at which it was acquired. Finding that a lock is stale and taking it over are
+two steps, so acquiring is serialised between processes by an exclusive lock on
+a file of the directory, which no lock can be named, since keys are quoted.
+"""
+class _LocalSubmitLocks:
+    def __init__(self, root_path):
+        self.root_path = root_path
+
+    def _path(self, key):
+        return os.path.join(
+            self.root_path,
+            urllib.parse.quote(key, safe = ""))
+
+    def acquire(self, key):
+        os.makedirs(self.root_path, exist_ok = True)
+        with open(os.path.join(self.root_path, ".acquire"), "a") as guard:
+            fcntl.flock(guard, fcntl.LOCK_EX)
+            try:
+                with open(self._path(key), "x"):
+                    pass
+                return
+            except FileExistsError:
+                pass
+            try:
+                if not _is_stale(os.path.getmtime(self._path(key))):
+                    raise EditConflictException()
+            except FileNotFoundError:
+                # Released in the meantime
+                pass
+            # Rewriting the lock sets its modification time to now
+            with open(self._path(key), "w"):
+                pass
+
+    def release(self, key):
+        os.remove(self._path(key))
+
+if _submit_locks_root_url.startswith("file://"):
+    _submit_locks = _LocalSubmitLocks(_submit_locks_root_url[len("file://"):])
+else:
+    _submit_locks = _S3SubmitLocks()
+
+def _submit_lock_key(page_name, revision_number):
+    return "{}/{}".format(page_name, revision_number)
+
 def _register_submit(page_name, revision_number):
+    # Revisions stored before submit locks were introduced have no lock, so
+    # are checked for directly
     try:
         _s3_client.head_object(
             Bucket = _pages_bucket_name,
@@ -97,82 +224,41 @@ def _register_submit(page_name, revision_number):
         raise EditConflictException()
     except _s3_client.exceptions.ClientError:
         pass
-    # The following, being backed by a filesystem, is a rigorous check,
-    # but only works over the lifetime of the lambda environment, i.e. a
-    # possibly relatively short period (the order of minutes) of time; it
-    # is for this reason that the above check is also needed
-    try:
-        pathlib.Path("{}/{}-{}".format(
-            _root_submit_path,
-            revision_number,
-            page_name)).touch(exist_ok = False)
-    except FileExistsError:
-        raise EditConflictException()
+    # Exactly one of any number of concurrent submits of the same revision,
+    # from any number of lambda environments, acquires the lock
+    _submit_locks.acquire(_submit_lock_key(page_name, revision_number))
 
 def _unregister_submit(page_name, revision_number):
-    os.remove("{}/{}-{}".format(
-        _root_submit_path,
-        revision_number,
-        page_name))
-
-def _replace_diagram_source_with_img_tag(metadata, diagram_source_match):
-    if diagram_source_match.group(1) is not None:
-        diagram_type = "tikz"
-        diagram = diagram_source_match.group(1)
-    elif diagram_source_match.group(3) is not None:
-        diagram_type = "tikzcd"
-        diagram = diagram_source_match.group(3)
-    elif diagram_source_match.group(5) is not None:
-        diagram_type = "xypic"
-        diagram = diagram_source_match.group(5)
-    response = requests.post(
-        _new_diagram_root_url,
-        json = {
-            "type": diagram_type,
-            "source": diagram,
-            "author": metadata["author"],
-            "ip_address": metadata["ip_address"]
-        }
-    )
-    if response.status_code != 200:
-        raise FailedToRenderDiagramException(
-            response.status_code,
-            "An error occurred when trying to render the following " +
-            "diagram.\n\n{}\n\nError: {}".format(
-                diagram,
-                response.text))
-    diagram_id = response.text
-    return "\n<img src=\"{}/{}\">".format(
-        _diagrams_root_url,
-        diagram_id)
-
-def _render_diagrams(revision_metadata, source):
-    return re.sub(
-        _latex_diagrams_regex,
-        lambda match: _replace_diagram_source_with_img_tag(
-            revision_metadata,
-            match),
-        source)
+    _submit_locks.release(_submit_lock_key(page_name, revision_number))
 
-def _store_in_history(revision_metadata, rendered_page, source):
-    _s3_client.put_object(
-        ACL = "public-read",
-        Body = rendered_page.encode("utf-8"),
-        Bucket = _pages_bucket_name,
-        ContentType = "text/html",
-        Key = "{}/{}/{}".format(
+def _is_sandbox(page_name):
+    return "sandbox" in page_name.lower()
+
+def _diagram_tag(response):
+    # The response of new_latex_diagram is the id of the diagram
+    return "\n<img src=\"{}/{}\">".format(_diagrams_root_url, response.text)
+
+def _render_diagrams(revision_metadata, source, timings):
+    return edit_rendering.render_diagrams(
+        revision_metadata,
+        source,
+        timings,
+        _diagram_tag)
+
+def _history_keys(page_name, revision_number):
+    return [
+        "{}/{}/{}".format(root_url, page_name, revision_number)
+        for root_url in [
             _history_pages_root_url,
-            revision_metadata["page_name"],
-            revision_metadata["revision_number"]))
-    _s3_client.put_object(
-        ACL = "public-read",
-        Body = source.encode("utf-8"),
-        Bucket = _pages_bucket_name,
-        ContentType = "text/plain; charset=utf-8",
-        Key = "{}/{}/{}".format(
             _history_sources_root_url,
-            revision_metadata["page_name"],
-            revision_metadata["revision_number"]))
+            _history_metadata_root_url
+        ]
+    ]
+
+def _history_put_object_requests(revision_metadata, rendered_page, source):
+    page_key, source_key, metadata_key = _history_keys(
+        revision_metadata["page_name"],
+        revision_metadata["revision_number"])
     metadata = json.dumps(
         {
             "author": revision_metadata["author"],
@@ -180,34 +266,196 @@ def _store_in_history(revision_metadata, rendered_page, source):
             "ip_address": revision_metadata["ip_address"]
         },
         indent = 2)
-    _s3_client.put_object(
-        Body = metadata.encode("utf-8"),
-        Bucket = _pages_bucket_name,
-        ContentType = "application/json",
-        Key = "{}/{}/{}".format(
-            _history_metadata_root_url,
+    if _delta_history is None:
+        source_put_object_requests = _encoded_put_object_requests({
+            "ACL": "public-read",
+            "Body": source.encode("utf-8"),
+            "ContentType": "text/plain; charset=utf-8",
+            "Key": source_key
+        })
+    else:
+        # The history already reaching this revision (or beyond) is what a
+        # concurrent submit of the same revision looks like from here
+        try:
+            source_put_object_requests = [
+                _delta_history.put_object_request(
+                    revision_metadata["page_name"],
+                    revision_metadata["revision_number"],
+                    source)
+            ]
+        except delta_history.NonConsecutiveRevisionException:
+            raise EditConflictException()
+    return [
+        *_encoded_put_object_requests({
+            "ACL": "public-read",
+            "Body": rendered_page.encode("utf-8"),
+            "ContentType": "text/html",
+            "Key": page_key
+        }),
+        *source_put_object_requests,
+        {
+            "Body": metadata.encode("utf-8"),
+            "ContentType": "application/json",
+            "Key": metadata_key
+        },
+        _latest_revision_pointer_put_object_request(
             revision_metadata["page_name"],
-            revision_metadata["revision_number"]))
+            revision_metadata["revision_number"])
+    ]
 
-def _remove_from_history(revision_metadata):
-    _s3_client.delete_object(
-        Bucket = _pages_bucket_name,
-        Key = "{}/{}/{}".format(
-            _history_pages_root_url,
-            revision_metadata["page_name"],
-            revision_metadata["revision_number"]))
-    _s3_client.delete_object(
-        Bucket = _pages_bucket_name,
-        Key = "{}/{}/{}".format(
-            _history_sources_root_url,
-            revision_metadata["page_name"],
-            revision_metadata["revision_number"]))
-    _s3_client.delete_object(
+def _latest_revision_pointer_key(page_name):
+    return "{}/{}".format(_latest_revision_pointers_root_url, page_name)
+
+def _latest_revision_pointer_put_object_request(page_name, revision_number):
+    return {
+        "Body": str(revision_number).encode("utf-8"),
+        "ContentType": "text/plain",
+        "Key": _latest_revision_pointer_key(page_name)
+    }
+
+def current_keys(page_name):
+    # The keys of the current page, source and fragment of the page
+    return [
+        "{}/{}".format(_pages_root_url, page_name),
+        "{}/{}".format(_sources_root_url, page_name),
+        "{}/{}".format(_fragments_root_url, page_name)
+    ]
+
+def stored_keys(root_url):
+    # Every key under the root URL, listed a page of keys at a time
+    paginator = _s3_client.get_paginator("list_objects_v2")
+    for list_response in paginator.paginate(
+            Bucket = _pages_bucket_name,
+            Prefix = "{}/".format(root_url)):
+        for stored_object in list_response.get("Contents", []):
+            yield stored_object["Key"]
+
+def _page_fragment(rendered_page):
+    # The content of the page alone, without the page template around it, which
+    # is all that includes.js and new_context_menus.js need. Empty if the page
+    # has no content markers. The pages which the page includes are not
+    # expanded in it, so that they are only ever expanded once, from their own
+    # fragments, into a page which includes it
+    rendered_page = _unexpanded_includes(rendered_page)
+    start = rendered_page.find(_page_content_start)
+    end = rendered_page.rfind(_page_content_end)
+    if (start == -1) or (end < start):
+        return ""
+    return rendered_page[start + len(_page_content_start):end]
+
+def _current_put_object_requests(page_name, rendered_page, source):
+    page_key, source_key, fragment_key = current_keys(page_name)
+    return _encoded_put_object_requests({
+            "ACL": "public-read",
+            "Body": rendered_page.encode("utf-8"),
+            "CacheControl": _current_cache_control,
+            "ContentType": "text/html",
+            "Key": page_key
+        }) + \
+        _encoded_put_object_requests({
+            "ACL": "public-read",
+            "Body": source.encode("utf-8"),
+            "CacheControl": _current_cache_control,
+            "ContentType": "text/plain; charset=utf-8",
+            "Key": source_key
+        }) + \
+        _encoded_put_object_requests({
+            "ACL": "public-read",
+            "Body": _page_fragment(rendered_page).encode("utf-8"),
+            "CacheControl": _current_cache_control,
+            "ContentType": "text/html",
+            "Key": fragment_key
+        })
+
+def _brotli_variant_key(key):
+    return "{}/{}".format(_brotli_variants_root_url, key)
+
+def _encoded_put_object_requests(put_object_request):
+    # The object itself is stored gzip-encoded, which every client accepts.
+    # A brotli-encoded variant is stored under a separate root, which CloudFront
+    # serves instead to clients which accept it (see select_encoding). The gzip
+    # timestamp is fixed so that the same body always compresses to the same
+    # bytes
+    body = put_object_request["Body"]
+    encoded_put_object_requests = [
+        dict(
+            put_object_request,
+            Body = gzip.compress(body, mtime = 0),
+            ContentEncoding = "gzip")
+    ]
+    if brotli is not None:
+        encoded_put_object_requests.append(
+            dict(
+                put_object_request,
+                Body = brotli.compress(body),
+                ContentEncoding = "br",
+                Key = _brotli_variant_key(put_object_request["Key"])))
+    return encoded_put_object_requests
+
+def _read_object(key):
+    # Objects stored before pages were compressed have no content encoding
+    response = _s3_client.get_object(Bucket = _pages_bucket_name, Key = key)
+    body = response["Body"].read()
+    if response.get("ContentEncoding") == "gzip":
+        body = gzip.decompress(body)
+    return body.decode("utf-8")
+
+def _put_object(put_object_request):
+    start = time.perf_counter()
+    _s3_client.put_object(Bucket = _pages_bucket_name, **put_object_request)
+    return time.perf_counter() - start
+
+def _put_objects(put_object_requests):
+    # The objects are written concurrently. Every write is waited for, even if
+    # one of them fails, so that nothing is still being written once a
+    # rollback begins. Returns the time in seconds taken to write each object
+    timings = dict()
+    exceptions = []
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers = _max_storage_workers) as executor:
+        futures = {
+            executor.submit(_put_object, put_object_request):
+                put_object_request["Key"]
+            for put_object_request in put_object_requests
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                timings[futures[future]] = future.result()
+            except Exception as exception:
+                exceptions.append(exception)
+    if exceptions:
+        raise exceptions[0]
+    return timings
+
+def _delete_objects(keys):
+    response = _s3_client.delete_objects(
         Bucket = _pages_bucket_name,
-        Key = "{}/{}/{}".format(
-            _history_metadata_root_url,
+        Delete = {
+            "Objects": [ { "Key": key } for key in keys ],
+            "Quiet": True
+        })
+    if response.get("Errors"):
+        raise FailedToCleanUpException()
+
+def _remove_from_history(revision_metadata):
+    # The latest revision pointer is removed too, so that the latest revision
+    # is afterwards found from the history itself. It is rewritten by
+    # _remove_as_current
+    page_key, source_key, metadata_key = _history_keys(
+        revision_metadata["page_name"],
+        revision_metadata["revision_number"])
+    _delete_objects([
+        page_key,
+        source_key,
+        metadata_key,
+        _brotli_variant_key(page_key),
+        _brotli_variant_key(source_key),
+        _latest_revision_pointer_key(revision_metadata["page_name"])
+    ])
+    if _delta_history is not None:
+        _delta_history.remove_revision(
             revision_metadata["page_name"],
-            revision_metadata["revision_number"]))
+            revision_metadata["revision_number"])
 
 def _remove_as_current(page_name):
     response = requests.get(
@@ -215,131 +463,349 @@ def _remove_as_current(page_name):
             _latest_revision_root_url,
             page_name))
     if response.status_code == 404:
-        _s3_client.delete_object(
-            Bucket = _pages_bucket_name,
-            Key = "{}/{}".format(
-                _pages_root_url,
-                page_name))
-        _s3_client.delete_object(
-            Bucket = _pages_bucket_name,
-            Key = "{}/{}".format(
-                _sources_root_url,
-                page_name))
+        _delete_objects([
+            key_or_variant_key
+            for key in current_keys(page_name)
+            for key_or_variant_key in [ key, _brotli_variant_key(key) ]
+        ])
         return
     elif response.status_code != 200:
         raise FailedToCleanUpException()
     previous_revision_number = response.text
-    previous_page = _s3_client.get_object(
-            Bucket = _pages_bucket_name,
-            Key = "{}/{}/{}".format(
-                _history_pages_root_url,
-                page_name,
-                previous_revision_number))["Body"].read().decode("utf-8")
-    previous_source = _s3_client.get_object(
+    previous_page_key, previous_source_key, _ = _history_keys(
+        page_name,
+        previous_revision_number)
+    previous_page = _read_object(previous_page_key)
+    if _delta_history is None:
+        previous_source = _read_object(previous_source_key)
+    else:
+        previous_source = _delta_history.source(
+            page_name,
+            int(previous_revision_number))
+    _put_objects(
+        _current_put_object_requests(
+            page_name,
+            previous_page,
+            previous_source) +
+        [ _latest_revision_pointer_put_object_request(
+            page_name,
+            previous_revision_number) ])
+
+def _queue_invalidation(keys):
+    # The edit has been stored by now, so it is not failed if this fails: the
+    # current page is then only stale at the edge until its cache expires
+    try:
+        _sqs_client.send_message(
+            QueueUrl = _invalidation_queue_url,
+            MessageBody = json.dumps({
+                "paths": [
+                    "/" + urllib.parse.quote(key_or_variant_key)
+                    for key in keys
+                    for key_or_variant_key in [ key, _brotli_variant_key(key) ]
+                ]
+            }))
+    except Exception as exception:
+        print("Failed to queue invalidation of {}: {}".format(keys, exception))
+
+def _collapse_whitespace(text):
+    return _minification_whitespace_regex.sub(
+        lambda match: "\n" if "\n" in match.group() else " ",
+        text)
+
+def _minify(rendered_page):
+    # Only runs of whitespace between tags are shortened, and never within
+    # elements in which whitespace is significant: in particular the TeX source
+    # which KaTeX keeps in an annotation element. A single whitespace character
+    # is always kept, so that no words or inline elements run together. Tags
+    # themselves, and so attributes, are left untouched
+    minified = []
+    open_whitespace_preserving_elements = []
+    position = 0
+    for tag in _minification_tag_regex.finditer(rendered_page):
+        text = rendered_page[position:tag.start()]
+        if not open_whitespace_preserving_elements:
+            text = _collapse_whitespace(text)
+        minified.append(text)
+        minified.append(tag.group())
+        position = tag.end()
+        tag_name = _minification_tag_name_regex.match(tag.group())
+        if tag_name is None:
+            continue
+        is_closing_tag = (tag_name.group(1) == "/")
+        name = tag_name.group(2).lower()
+        if is_closing_tag:
+            if open_whitespace_preserving_elements and \
+                    (open_whitespace_preserving_elements[-1] == name):
+                open_whitespace_preserving_elements.pop()
+        elif (name in _whitespace_preserving_elements) and \
+                not tag.group().endswith("/>"):
+            open_whitespace_preserving_elements.append(name)
+    text = rendered_page[position:]
+    if not open_whitespace_preserving_elements:
+        text = _collapse_whitespace(text)
+    minified.append(text)
+    return "".join(minified)
+
+def _page_inclusion(escaped_page_name, content = None):
+    if content is None:
+        return (
+            "<div class=\"page_inclusion\" " +
+            "data-page-to-include=\"{}\">\n</div>".format(escaped_page_name))
+    return (
+        "<div class=\"page_inclusion\" " +
+        "data-page-to-include=\"{}\" data-included=\"true\">".format(
+            escaped_page_name) +
+        content +
+        "</div>")
+
+def _end_of_div(rendered_page, position):
+    # The position just after the closing tag of the div whose opening tag ends
+    # at position
+    depth = 1
+    for tag in _minification_tag_regex.finditer(rendered_page, position):
+        tag_name = _minification_tag_name_regex.match(tag.group())
+        if (tag_name is None) or (tag_name.group(2).lower() != "div"):
+            continue
+        if tag_name.group(1) == "/":
+            depth -= 1
+            if depth == 0:
+                return tag.end()
+        elif not tag.group().endswith("/>"):
+            depth += 1
+    return len(rendered_page)
+
+def _unexpanded_includes(rendered_page):
+    # The page with each expanded inclusion, and everything expanded within
+    # it, replaced by the placeholder which the parser renders for it
+    if "data-included=\"true\"" not in rendered_page:
+        return rendered_page
+    unexpanded = []
+    position = 0
+    while True:
+        inclusion = _expanded_page_inclusion_regex.search(
+            rendered_page,
+            position)
+        if inclusion is None:
+            break
+        unexpanded.append(rendered_page[position:inclusion.start()])
+        unexpanded.append(_page_inclusion(inclusion.group(1)))
+        position = _end_of_div(rendered_page, inclusion.end())
+    unexpanded.append(rendered_page[position:])
+    return "".join(unexpanded)
+
+def _read_fragment(page_name):
+    # None if the page does not exist, or was stored before fragments were
+    try:
+        return _read_object(current_keys(page_name)[2])
+    except _s3_client.exceptions.NoSuchKey:
+        return None
+
+def _read_fragments(page_names, fragments):
+    page_names = [
+        page_name for page_name in dict.fromkeys(page_names)
+        if page_name not in fragments
+    ]
+    if not page_names:
+        return
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers = _max_storage_workers) as executor:
+        for page_name, fragment in zip(
+                page_names,
+                executor.map(_read_fragment, page_names)):
+            fragments[page_name] = fragment
+
+def _expand(
+        rendered_page,
+        including_page_names,
+        fragments,
+        included_page_names):
+    # A page which includes itself, directly or not, is not expanded within
+    # itself, and pages are not expanded beyond _max_include_depth inclusions
+    # deep. Such inclusions, and those of pages without a fragment, are left
+    # to includes.js
+    inclusions = list(_page_inclusion_regex.finditer(rendered_page))
+    if (not inclusions) or (len(including_page_names) > _max_include_depth):
+        return rendered_page
+    page_names = {
+        inclusion.group(1): html.unescape(inclusion.group(1))
+        for inclusion in inclusions
+    }
+    _read_fragments(
+        [
+            page_name for page_name in page_names.values()
+            if page_name not in including_page_names
+        ],
+        fragments)
+    def expanded(inclusion):
+        page_name = page_names[inclusion.group(1)]
+        if page_name in including_page_names:
+            return inclusion.group()
+        # Recorded even if the page has no fragment yet, so that the including
+        # page is refreshed once it is created
+        included_page_names.add(page_name)
+        if fragments[page_name] is None:
+            return inclusion.group()
+        return _page_inclusion(
+            inclusion.group(1),
+            _expand(
+                fragments[page_name],
+                including_page_names + [ page_name ],
+                fragments,
+                included_page_names))
+    return _page_inclusion_regex.sub(expanded, rendered_page)
+
+def _expanded_includes(page_name, rendered_page):
+    # Returns the page with the content of each page which it includes, and of
+    # each page which they include in turn, in place of its inclusion, and the
+    # names of all of these pages. Any inclusions expanded before are expanded
+    # again, from the current fragments of the pages
+    included_page_names = set()
+    expanded = _expand(
+        _unexpanded_includes(rendered_page),
+        [ page_name ],
+        dict(),
+        included_page_names)
+    return expanded, included_page_names
+
+def _include_index_key(*names):
+    # Page names may contain a /, so are quoted
+    return "/".join(
+        [ _include_index_root_url ] +
+        [ urllib.parse.quote(name, safe = "") for name in names ])
+
+def _dependent_page_names(page_name):
+    # The pages which include the page, directly or not
+    prefix = _include_index_key("included_by", page_name) + "/"
+    paginator = _s3_client.get_paginator("list_objects_v2")
+    for list_response in paginator.paginate(
             Bucket = _pages_bucket_name,
-            Key = "{}/{}/{}".format(
-                _history_sources_root_url,
-                page_name,
-                previous_revision_number))["Body"].read().decode("utf-8")
-    _store_as_current(page_name, previous_page, previous_source)
+            Prefix = prefix):
+        for stored_object in list_response.get("Contents", []):
+            yield urllib.parse.unquote(stored_object["Key"][len(prefix):])
 
-def _store_as_current(page_name, rendered_page, source):
-    _s3_client.put_object(
-        ACL = "public-read",
-        Body = rendered_page.encode("utf-8"),
-        Bucket = _pages_bucket_name,
-        CacheControl = "no-cache",
-        ContentType = "text/html",
-        Key = "{}/{}".format(_pages_root_url, page_name))
-    """
-    _cloudfront_client.create_invalidation(
-        DistributionId = _cloudfront_distribution_id,
-        InvalidationBatch = {
-            "Paths": {
-                "Quantity": 1,
-                "Items": [ "/{}/{}".format(
-                    _pages_root_url,
-                    urllib.parse.quote(page_name)) ]
-            },
-            "CallerReference": str(random.randrange(1, 10**6))
-        }
-    )
-    """
-    _s3_client.put_object(
-        ACL = "public-read",
-        Body = source,
-        Bucket = _pages_bucket_name,
-        CacheControl = "no-cache",
-        ContentType = "text/plain; charset=utf-8",
-        Key = "{}/{}".format(_sources_root_url, page_name))
-    """
-    _cloudfront_client.create_invalidation(
-        DistributionId = _cloudfront_distribution_id,
-        InvalidationBatch = {
-            "Paths": {
-                "Quantity": 1,
-                "Items": [ "/{}/{}".format(
-                    _sources_root_url,
-                    urllib.parse.quote(page_name)) ]
-            },
-            "CallerReference": str(random.randrange(1, 10**6))
+def _update_include_index(page_name, included_page_names):
+    # The index holds an empty object for each including and included page,
+    # so that pages stored concurrently never write to the same object, and a
+    # list of the pages which each page includes, from which the objects of
+    # pages which it no longer includes are found
+    includes_key = _include_index_key("includes", page_name)
+    try:
+        previously_included_page_names = set(
+            json.loads(_read_object(includes_key)))
+    except _s3_client.exceptions.NoSuchKey:
+        previously_included_page_names = set()
+    if included_page_names == previously_included_page_names:
+        return
+    _put_objects([
+        {
+            "Body": b"",
+            "Key": _include_index_key(
+                "included_by",
+                included_page_name,
+                page_name)
         }
-    )
-    """
-
-def _render_page(source, page_name):
-    response = requests.put(
-        _parse_source_root_url,
-        json = {
-            "source": source
-        })
-    if response.status_code != 200:
-        raise FailedToParseException(response.status_code, response.text)
+        for included_page_name in
+            included_page_names - previously_included_page_names
+    ])
+    removed_page_names = previously_included_page_names - included_page_names
+    if removed_page_names:
+        _delete_objects([
+            _include_index_key("included_by", removed_page_name, page_name)
+            for removed_page_name in removed_page_names
+        ])
+    _put_object({
+        "Body": json.dumps(sorted(included_page_names)).encode("utf-8"),
+        "ContentType": "application/json",
+        "Key": includes_key
+    })
 
-    response = requests.put(
-        _render_latex_root_url,
-        json = {
-            "source": response.text
-        })
-    if response.status_code != 200:
-        raise FailedToRenderLatexException(response.status_code, response.text)
-
-    response = requests.put(
-        _render_page_root_url,
-        json = {
-            "page_name": page_name,
-            "parsed_source": response.text
-        })
-    if response.status_code != 200:
-        raise FailedToRenderException(response.status_code, response.text)
-    return response.text
+def _record_includes(page_name, included_page_names):
+    # The edit has been stored by now, so it is not failed if this fails: the
+    # pages which include this one are then only refreshed when they are next
+    # stored, or refreshed for another page
+    try:
+        _update_include_index(page_name, included_page_names)
+    except Exception as exception:
+        print("Failed to index the includes of {}: {}".format(
+            page_name,
+            exception))
+    try:
+        _sqs_client.send_message(
+            QueueUrl = _include_refresh_queue_url,
+            MessageBody = json.dumps({ "page_name": page_name }))
+    except Exception as exception:
+        print("Failed to queue refresh of the pages including {}: {}".format(
+            page_name,
+            exception))
 
-def store(revision_metadata, source):
+def store(revision_metadata, source, timings):
     _validate(revision_metadata)
     page_name = revision_metadata["page_name"]
-    source_with_created_diagrams = _render_diagrams(revision_metadata, source)
-    rendered_page = _render_page(source_with_created_diagrams, page_name)
-    revision_number = revision_metadata["revision_number"]
-    _register_submit(page_name, revision_number)
-    try:
-        if "sandbox" not in page_name.lower():
-            _store_in_history(
-                revision_metadata,
-                rendered_page,
-                source_with_created_diagrams)
-        _store_as_current(
-            page_name,
+    source_with_created_diagrams = _render_diagrams(
+        revision_metadata,
+        source,
+        timings)
+    rendered_page = edit_rendering.render_page(
+        source_with_created_diagrams,
+        page_name,
+        timings)
+    with timings.stage("minify", len(rendered_page.encode("utf-8"))) as sizes:
+        rendered_page = _minify(rendered_page)
+        sizes["output_bytes"] = len(rendered_page.encode("utf-8"))
+    if _include_index_root_url:
+        with timings.stage(
+                "expand_includes",
+                len(rendered_page.encode("utf-8"))) as sizes:
+            rendered_page, included_page_names = _expanded_includes(
+                page_name,
+                rendered_page)
+            sizes["output_bytes"] = len(rendered_page.encode("utf-8"))
+    # The requests are built before the submit is registered, since building
+    # them can fail, reading the latest chunk of the history for instance,
+    # which would otherwise leave the submit registered. A chunk is only
+    # written if it has not changed since it was read, so that it is read
+    # before registering is harmless
+    put_object_requests = _current_put_object_requests(
+        page_name,
+        rendered_page,
+        source_with_created_diagrams)
+    if not _is_sandbox(page_name):
+        put_object_requests += _history_put_object_requests(
+            revision_metadata,
             rendered_page,
             source_with_created_diagrams)
+    revision_number = revision_metadata["revision_number"]
+    with timings.stage("register_submit"):
+        _register_submit(page_name, revision_number)
+    try:
+        storage_timings = _put_objects(put_object_requests)
     except Exception as exception:
         try:
             _remove_from_history(revision_metadata)
             _remove_as_current(page_name)
+            _queue_invalidation(current_keys(page_name))
             _unregister_submit(page_name, revision_number)
         except Exception as clean_up_exception:
             raise clean_up_exception from exception
         raise exception
-    _remove_too_old_submits()
+    for put_object_request in put_object_requests:
+        timings.record(
+            "s3_put",
+            storage_timings[put_object_request["Key"]],
+            len(put_object_request["Body"]),
+            detail = put_object_request["Key"])
+    # A sandbox page has no history, so the same revision number is submitted
+    # again by its next edit, which its lock would otherwise refuse. Other
+    # locks are kept, since they are what refuses a concurrent submit of the
+    # same revision which checked the history before it was stored
+    if _is_sandbox(page_name):
+        with timings.stage("unregister_submit"):
+            _unregister_submit(page_name, revision_number)
+    with timings.stage("queue_invalidation"):
+        _queue_invalidation(current_keys(page_name))
+    if _include_index_root_url:
+        with timings.stage("record_includes"):
+            _record_includes(page_name, included_page_names)
 
 def _handle_cors(event):
     headers = dict()
@@ -406,11 +872,16 @@ def _extract_revision_metadata_and_source(event, headers):
             None,
             None)
 
-def _render_store_and_handle_errors(revision_metadata, source, headers):
+def _render_store_and_handle_errors(
+        revision_metadata,
+        source,
+        headers,
+        timings):
     try:
         store(
             revision_metadata,
-            source)
+            source,
+            timings)
     except AuthorSyntaxException as exception:
         headers["Content-Type"] = "text/plain"
         return {
@@ -435,10 +906,10 @@ def _render_store_and_handle_errors(revision_metadata, source, headers):
                 "merged source").format(revision_metadata["revision_number"])
         }
     except (
-            FailedToParseException,
-            FailedToRenderDiagramException,
-            FailedToRenderLatexException,
-            FailedToRenderException) as exception:
+            edit_rendering.FailedToParseException,
+            edit_rendering.FailedToRenderDiagramException,
+            edit_rendering.FailedToRenderLatexException,
+            edit_rendering.FailedToRenderException) as exception:
         headers["Content-Type"] = "text/plain"
         return {
             "isBase64Encoded": False,
@@ -464,10 +935,23 @@ def lambda_handler(event, context):
         _extract_revision_metadata_and_source(event, headers)
     if response is not None:
         return response
-    response = _render_store_and_handle_errors(
-        revision_metadata,
-        source,
-        headers)
+    timings = edit_rendering.StageTimings()
+    status_code = 500
+    try:
+        response = _render_store_and_handle_errors(
+            revision_metadata,
+            source,
+            headers,
+            timings)
+        status_code = 200 if response is None else response["statusCode"]
+    finally:
+        timings.log(
+            page_name = revision_metadata["page_name"],
+            revision_number = revision_metadata["revision_number"],
+            status_code = status_code)
+    if _return_stage_timings:
+        # An error response has the same headers dictionary, so also gets this
+        headers["Server-Timing"] = timings.server_timing_header()
     if response is not None:
         return response
     if not headers:
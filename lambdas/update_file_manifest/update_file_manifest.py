@@ -0,0 +1,241 @@
+import boto3
+import botocore.exceptions
+import json
+import os
+import random
+import re
+import struct
+import time
+import urllib.parse
+
+_s3_client = boto3.client("s3")
+
+_file_manifest_url = os.environ["FILE_MANIFEST_URL"]
+_files_root_url = os.environ["FILES_ROOT_URL"]
+_pages_bucket_name = os.environ["PAGES_BUCKET_NAME"]
+
+# Enough for the dimensions of PNG, GIF and SVG files, and of almost all JPEG
+# ones
+_header_size = 65536
+_max_attempts = 5
+
+_jpeg_start_of_frame_markers = [
+    marker for marker in range(0xc0, 0xd0)
+    if marker not in [ 0xc4, 0xc8, 0xcc ]
+]
+_svg_tag_regex = re.compile(rb"<svg\b[^>]*>", re.DOTALL)
+_svg_length_regex = r"""\b{}\s*=\s*["']\s*([0-9.]+)\s*(px)?\s*["']"""
+_svg_width_regex = re.compile(_svg_length_regex.format("width").encode())
+_svg_height_regex = re.compile(_svg_length_regex.format("height").encode())
+_svg_view_box_regex = re.compile(
+    rb"""\bviewBox\s*=\s*["']\s*[-0-9.]+[\s,]+[-0-9.]+[\s,]+([0-9.]+)""" +
+    rb"""[\s,]+([0-9.]+)\s*["']""")
+
+"""
+Maintains the manifest of the files of the site, used by the parser to check
+that the file of an imagefromfile block exists without a request to the site for
+every block. The manifest is a single JSON object, which maps the name of every
+file to its size, its content type, and, for PNG, GIF, JPEG and SVG images whose
+dimensions can be read from the beginning of the file, its intrinsic width and
+height in pixels.
+
+This is triggered by S3 when a file is uploaded or deleted. The current state
+of each file in the event is looked up, rather than relying upon the type of the
+event, so that events handled out of order still leave the manifest correct.
+The manifest is updated conditionally on it not having changed since it was
+read, and read again and updated again if it has, so that concurrent uploads do
+not lose one another. If invoked with an event without any records, for instance
+by hand, the manifest is rebuilt from every file.
+"""
+
+def _png_dimensions(header):
+    if (header[:8] != b"\x89PNG\r\n\x1a\n") or (header[12:16] != b"IHDR"):
+        return None
+    return struct.unpack(">II", header[16:24])
+
+def _gif_dimensions(header):
+    if header[:6] not in [ b"GIF87a", b"GIF89a" ]:
+        return None
+    return struct.unpack("<HH", header[6:10])
+
+def _jpeg_dimensions(header):
+    if header[:2] != b"\xff\xd8":
+        return None
+    position = 2
+    while position + 9 <= len(header):
+        if header[position] != 0xff:
+            return None
+        marker = header[position + 1]
+        if marker == 0xff:
+            # Padding
+            position += 1
+        elif (marker == 0x01) or (0xd0 <= marker <= 0xd8):
+            # Markers without a length
+            position += 2
+        elif marker in _jpeg_start_of_frame_markers:
+            height, width = struct.unpack(
+                ">HH",
+                header[position + 5:position + 9])
+            return width, height
+        else:
+            position += 2 + struct.unpack(
+                ">H",
+                header[position + 2:position + 4])[0]
+    return None
+
+def _svg_dimensions(header):
+    tag_match = _svg_tag_regex.search(header)
+    if tag_match is None:
+        return None
+    tag = tag_match.group(0)
+    width_match = _svg_width_regex.search(tag)
+    height_match = _svg_height_regex.search(tag)
+    if (width_match is not None) and (height_match is not None):
+        return (
+            round(float(width_match.group(1))),
+            round(float(height_match.group(1))))
+    # Only the aspect ratio is known, which is what matters for laying out
+    # the page
+    view_box_match = _svg_view_box_regex.search(tag)
+    if view_box_match is None:
+        return None
+    return (
+        round(float(view_box_match.group(1))),
+        round(float(view_box_match.group(2))))
+
+def _dimensions(header):
+    for dimensions in [
+            _png_dimensions,
+            _gif_dimensions,
+            _jpeg_dimensions,
+            _svg_dimensions ]:
+        try:
+            result = dimensions(header)
+        except (struct.error, ValueError):
+            result = None
+        if result is not None:
+            return result
+    return None
+
+def _file_information(key, size):
+    # Returns None if the file does not exist
+    get_object_arguments = {
+        "Bucket": _pages_bucket_name,
+        "Key": key
+    }
+    if size > 0:
+        get_object_arguments["Range"] = "bytes=0-{}".format(_header_size - 1)
+    try:
+        response = _s3_client.get_object(**get_object_arguments)
+    except _s3_client.exceptions.NoSuchKey:
+        return None
+    file_information = {
+        "size": size,
+        "content_type": response.get("ContentType")
+    }
+    header = response["Body"].read()
+    dimensions = _dimensions(header)
+    if (dimensions is None) and (size > _header_size) and \
+            header.startswith(b"\xff\xd8"):
+        # A JPEG with a large block of metadata before its frame
+        dimensions = _jpeg_dimensions(_s3_client.get_object(
+            Bucket = _pages_bucket_name,
+            Key = key)["Body"].read())
+    if dimensions is not None:
+        file_information["width"], file_information["height"] = dimensions
+    return file_information
+
+def _current_file_information(key):
+    try:
+        size = _s3_client.head_object(
+            Bucket = _pages_bucket_name,
+            Key = key)["ContentLength"]
+    except botocore.exceptions.ClientError as exception:
+        if exception.response["Error"]["Code"] in [ "404", "NoSuchKey" ]:
+            return None
+        raise exception
+    return _file_information(key, size)
+
+def _file_name(key):
+    return key[len(_files_root_url) + 1:]
+
+def _read_manifest():
+    # Returns the manifest and its ETag, or an empty manifest and None if there
+    # is no manifest yet
+    try:
+        response = _s3_client.get_object(
+            Bucket = _pages_bucket_name,
+            Key = _file_manifest_url)
+    except _s3_client.exceptions.NoSuchKey:
+        return dict(), None
+    return json.loads(response["Body"].read().decode("utf-8")), response["ETag"]
+
+def _write_manifest(manifest, etag):
+    put_object_request = {
+        "Body": json.dumps(
+            manifest,
+            separators = (",", ":"),
+            sort_keys = True).encode("utf-8"),
+        "Bucket": _pages_bucket_name,
+        "CacheControl": "max-age=0, s-maxage=60",
+        "ContentType": "application/json",
+        "Key": _file_manifest_url
+    }
+    if etag is None:
+        put_object_request["IfNoneMatch"] = "*"
+    else:
+        put_object_request["IfMatch"] = etag
+    _s3_client.put_object(**put_object_request)
+
+def _update_manifest(updates):
+    # The updates map file names to their information, or to None for files
+    # which no longer exist
+    for attempt in range(_max_attempts):
+        manifest, etag = _read_manifest()
+        for file_name, file_information in updates.items():
+            if file_information is None:
+                manifest.pop(file_name, None)
+            else:
+                manifest[file_name] = file_information
+        try:
+            _write_manifest(manifest, etag)
+            return len(manifest)
+        except botocore.exceptions.ClientError as exception:
+            if exception.response["Error"]["Code"] not in [
+                    "ConditionalRequestConflict",
+                    "PreconditionFailed" ]:
+                raise exception
+        time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+    raise Exception(
+        "Manifest changed by others {} times whilst updating it".format(
+            _max_attempts))
+
+def _rebuild_manifest():
+    manifest = dict()
+    paginator = _s3_client.get_paginator("list_objects_v2")
+    for list_response in paginator.paginate(
+            Bucket = _pages_bucket_name,
+            Prefix = _files_root_url + "/"):
+        for file in list_response.get("Contents", []):
+            file_information = _file_information(file["Key"], file["Size"])
+            if file_information is not None:
+                manifest[_file_name(file["Key"])] = file_information
+    _, etag = _read_manifest()
+    _write_manifest(manifest, etag)
+    return len(manifest)
+
+def lambda_handler(event, context):
+    records = event.get("Records", [])
+    if not records:
+        files = _rebuild_manifest()
+        print(json.dumps({ "rebuilt": True, "files": files }))
+        return
+    updates = dict()
+    for record in records:
+        key = urllib.parse.unquote_plus(record["s3"]["object"]["key"])
+        if key.startswith(_files_root_url + "/"):
+            updates[_file_name(key)] = _current_file_information(key)
+    if not updates:
+        return
+    files = _update_manifest(updates)
+    print(json.dumps({ "updated": sorted(updates), "files": files }))
@@ -2,10 +2,13 @@ import boto3
 import json
 import os
 import requests
+import urllib.parse
 
 _s3_client = boto3.client("s3")
+_sqs_client = boto3.client("sqs")
 
 _history_all_root_url = os.environ["HISTORY_ALL_ROOT_URL"]
+_invalidation_queue_url = os.environ["INVALIDATION_QUEUE_URL"]
 _pages_bucket_name = os.environ["PAGES_BUCKET_NAME"]
 _render_page_history_root_url = os.environ["RENDER_PAGE_HISTORY_ROOT_URL"]
 
@@ -32,12 +35,31 @@ def _store(page_name, rendered_history_page):
         ACL = "public-read",
         Body = rendered_history_page.encode("utf-8"),
         Bucket = _pages_bucket_name,
-        CacheControl = "no-cache",
+        CacheControl = "max-age=0, s-maxage=86400",
         ContentType = "text/html",
         Key = "{}/{}".format(
             _history_all_root_url,
             page_name))
 
+def _queue_invalidation(page_name):
+    # The history page has been stored by now, so the request is not failed if
+    # this fails: the history page is then only stale at the edge until its
+    # cache expires
+    try:
+        _sqs_client.send_message(
+            QueueUrl = _invalidation_queue_url,
+            MessageBody = json.dumps({
+                "paths": [
+                    "/" + urllib.parse.quote("{}/{}".format(
+                        _history_all_root_url,
+                        page_name))
+                ]
+            }))
+    except Exception as exception:
+        print("Failed to queue invalidation of {}: {}".format(
+            page_name,
+            exception))
+
 def _handle_cors(event):
     headers = dict()
     try:
@@ -74,6 +96,7 @@ def lambda_handler(event, context):
     try:
         rendered_history_page = _render_history_page(page_name)
         _store(page_name, rendered_history_page)
+        _queue_invalidation(page_name)
     except FailedToRenderException as exception:
         headers["Content-Type"] = "text/plain"
         return  {